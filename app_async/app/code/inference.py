@@ -1,4 +1,9 @@
-from typing import Any, Tuple, cast
+import os
+import re
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple, cast
+
+import torch
 from torch import Tensor
 from transformers.modeling_utils import PreTrainedModel
 from transformers.models.auto.modeling_auto import AutoModelForSeq2SeqLM
@@ -7,13 +12,148 @@ from transformers.models.t5.tokenization_t5 import T5Tokenizer
 from torch import device
 from torch.cuda import is_available as gpu_available
 
+from context_window import ContextWindow
+
 model_id = "mrm8488/t5-base-finetuned-question-generation-ap"
 num_texts = 1  # Number of input texts to decode
 num_beams = 4  # Number of beams per input text
-max_encoder_length = 32  # Maximum input token length
+# Encoder budget of a prompt, long contexts are cut around the answer to fit
+max_encoder_length = int(os.environ.get("MAX_INPUT_TOKENS", 512))
 max_decoder_length = 32
 inference_device = device("cuda") if gpu_available() else device("cpu")
 
+# Bounds of the number of input texts generated together
+min_chunk_size = 1
+max_chunk_size = int(os.environ.get("MAX_CHUNK_SIZE", 64))
+initial_chunk_size = int(os.environ.get("INITIAL_CHUNK_SIZE", 8))
+# Share of the device memory a larger chunk must leave free
+min_free_memory = float(os.environ.get("MIN_FREE_MEMORY", 0.1))
+
+
+class ChunkSizeController:
+    """
+    Additive increase, multiplicative decrease of the chunk size: it grows by a
+    quarter after a chunk that went through when the memory left fits the
+    extra texts, and halves on out of memory errors. It then never grows back
+    to the size that ran out of memory. It lives across requests, each job
+    starts from the size the previous ones settled on.
+    """
+
+    def __init__(
+        self, initial: int, minimum: int, maximum: int, min_free: float = 0.1
+    ) -> None:
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_free = min_free
+        # Largest size since the last out of memory error
+        self.ceiling = maximum
+
+    def grow(
+        self,
+        chunk_texts: int,
+        chunk_memory: Optional[int],
+        free_memory: int,
+        total_memory: int,
+    ) -> None:
+        """
+        Grows after a chunk of `chunk_texts` texts which needed `chunk_memory`
+        bytes at its peak (None when unknown), if the `free_memory` left
+        would still be above `min_free` of `total_memory` after the growth.
+        """
+        size = min(self.size + max(self.size // 4, 1), self.ceiling)
+        needed = 0.0
+        if chunk_memory is not None and chunk_texts > 0:
+            needed = chunk_memory / chunk_texts * (size - self.size)
+        if free_memory - needed >= total_memory * self.min_free:
+            self.size = max(size, self.size)
+
+    def shrink(self, failed: int) -> bool:
+        """
+        Halves the size after a chunk of `failed` texts ran out of memory,
+        False when it is already at its minimum
+        """
+        size = min(self.size, failed)
+        if size <= self.minimum:
+            return False
+        self.ceiling = max(min(self.ceiling, size - 1), self.minimum)
+        self.size = max(size // 2, self.minimum)
+        return True
+
+
+chunk_size = ChunkSizeController(
+    initial_chunk_size, min_chunk_size, max_chunk_size, min_free_memory
+)
+
+
+# Inputs are the "answer: ... context: ..." prompts built by the lambda
+PROMPT = re.compile(r"answer: (?P<answer>.*?) context: (?P<context>.*)", re.DOTALL)
+
+
+def windowed(tokenizer: T5Tokenizer, texts: List[str]) -> List[str]:
+    """The prompts with their context fit in `max_encoder_length` tokens"""
+    windows: Dict[str, ContextWindow] = {}
+    results: List[str] = []
+    for text in texts:
+        match = PROMPT.fullmatch(text)
+        if match is None:
+            results.append(text)
+            continue
+        context = match.group("context")
+        if context not in windows:
+            windows[context] = ContextWindow(tokenizer, context, max_encoder_length)
+        results.append(windows[context].prompt(match.group("answer")))
+    return results
+
+
+# CUDA caching allocator, CPU allocator of torch
+OUT_OF_MEMORY_MESSAGES = ("out of memory", "DefaultCPUAllocator", "alloc_cpu")
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    cuda_out_of_memory = getattr(torch.cuda, "OutOfMemoryError", None)
+    if isinstance(error, MemoryError) or (
+        cuda_out_of_memory is not None and isinstance(error, cuda_out_of_memory)
+    ):
+        return True
+    message = str(error)
+    return any(text in message for text in OUT_OF_MEMORY_MESSAGES)
+
+
+def memory_info() -> Tuple[int, int]:
+    """Free and total bytes of the memory generation runs in"""
+    if gpu_available():
+        return torch.cuda.mem_get_info()
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    return (
+        os.sysconf("SC_AVPHYS_PAGES") * page_size,
+        os.sysconf("SC_PHYS_PAGES") * page_size,
+    )
+
+
+def generate_chunk(
+    model: PreTrainedModel,
+    tokenizer: T5Tokenizer,
+    texts: List[str],
+    parameters: dict,
+) -> List[str]:
+    # Padded to the longest text of the chunk only
+    batch = tokenizer(
+        texts,
+        max_length=max_encoder_length,
+        truncation=True,
+        padding="longest",
+        return_tensors="pt",
+    ).to(inference_device)
+
+    output = model.generate(
+        inputs=cast(Tensor, batch["input_ids"]),
+        attention_mask=cast(Tensor, batch["attention_mask"]),
+        **parameters
+    )
+    return tokenizer.batch_decode(output, skip_special_tokens=True)
+
+
 def model_fn(model_dir: str):
     model_id = "mrm8488/t5-base-finetuned-question-generation-ap"
     model: PreTrainedModel = AutoModelForSeq2SeqLM.from_pretrained(model_id)
@@ -27,23 +167,51 @@ def predict_fn(data: Any, model_tokenizer: Tuple[PreTrainedModel, T5Tokenizer]):
     # destruct model, tokenizer and model config
     model, tokenizer = model_tokenizer
 
-    texts = data["inputs"]
+    texts = windowed(tokenizer, data["inputs"])
     parameters = data["parameters"]
+    n_outputs = parameters.get("num_return_sequences", 1)
 
-    batch = tokenizer(
-        texts,
-        max_length=max_decoder_length,
-        truncation=True,
-        padding="max_length",
-        return_tensors="pt",
-    ).to(inference_device)
+    # Texts of similar lengths go together, chunks need less padding
+    order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+    outputs: List[List[str]] = [[] for _ in texts]
 
-    # with torch.inference_mode():
-    output = model.generate(
-        inputs=cast(Tensor, batch["input_ids"]),        
-        **parameters
-    )
+    start = 0
+    with torch.inference_mode():
+        while start < len(order):
+            chunk = order[start : start + chunk_size.size]
+            chunk_start = perf_counter()
+            if gpu_available():
+                torch.cuda.reset_peak_memory_stats()
+                allocated = torch.cuda.memory_allocated()
+            try:
+                results = generate_chunk(
+                    model, tokenizer, [texts[idx] for idx in chunk], parameters
+                )
+            except (RuntimeError, MemoryError) as error:
+                if not is_out_of_memory(error) or not chunk_size.shrink(len(chunk)):
+                    raise
+                print("CHUNK OUT OF MEMORY", len(chunk), "->", chunk_size.size)
+                if gpu_available():
+                    torch.cuda.empty_cache()
+                continue
 
-    results = [tokenizer.decode(t, skip_special_tokens=True) for t in output]
+            for chunk_idx, text_idx in enumerate(chunk):
+                outputs[text_idx] = results[
+                    chunk_idx * n_outputs : (chunk_idx + 1) * n_outputs
+                ]
+            print(
+                "CHUNK",
+                {
+                    "texts": len(chunk),
+                    "done": start + len(chunk),
+                    "total": len(texts),
+                    "seconds": round(perf_counter() - chunk_start, 3),
+                },
+            )
+            start += len(chunk)
+            chunk_memory: Optional[int] = None
+            if gpu_available():
+                chunk_memory = torch.cuda.max_memory_allocated() - allocated
+            chunk_size.grow(len(chunk), chunk_memory, *memory_info())
 
-    return results
+    return [result for text_outputs in outputs for result in text_outputs]
@@ -1,9 +1,9 @@
+import asyncio
 import os
-import boto3
 import json
 from typing import Any, TypedDict, Literal
-from botocore.exceptions import ClientError
-from time import sleep
+
+from fan_out import AsyncInferenceClient, InferenceFailed
 
 ResponseHeaders = TypedDict(
     "ResponseHeaders",
@@ -34,7 +34,12 @@ class ResponseMetadata(TypedDict):
     RetryAttempts: int
 
 
-class Response(TypedDict):
+class OptionalResponse(TypedDict, total=False):
+    # Only when the endpoint has an S3 failure path
+    FailureLocation: str
+
+
+class Response(OptionalResponse):
     ResponseMetadata: ResponseMetadata
     OutputLocation: str
     InferenceId: str
@@ -98,10 +103,33 @@ class ReceivedEvent(TypedDict):
 
 ENDPOINT_NAME = os.environ["ENDPOINT_NAME"]
 INPUT_BUCKET = os.environ["INPUT_BUCKET"]
-
-sagemaker_runtime = boto3.client("runtime.sagemaker")  # type: ignore
-s3_resource = boto3.resource("s3")
-s3_input_bucket = s3_resource.Object(INPUT_BUCKET, "temp_input_file.json")
+# Comma separated arns of the endpoint success and error topics, the output
+# bucket is polled when it is not set. Each execution environment subscribes a
+# queue of its own, named after NOTIFICATION_QUEUE_PREFIX, to them.
+NOTIFICATION_TOPICS = [
+    topic for topic in os.environ.get("NOTIFICATION_TOPICS", "").split(",") if topic
+]
+NOTIFICATION_QUEUE_PREFIX = os.environ.get(
+    "NOTIFICATION_QUEUE_PREFIX", "async-notifications"
+)
+# Seconds to wait for a notification before polling the output bucket
+NOTIFICATION_TIMEOUT = float(os.environ.get("NOTIFICATION_TIMEOUT", 30))
+# Seconds to wait for the inference, keep it under the lambda timeout
+RESULT_TIMEOUT = float(os.environ.get("RESULT_TIMEOUT", 25))
+# Inputs of a request are split into jobs of at most MAX_INPUTS_PER_JOB inputs,
+# at most MAX_IN_FLIGHT of them run at once.
+MAX_INPUTS_PER_JOB = int(os.environ.get("MAX_INPUTS_PER_JOB", 32))
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 8))
+
+client = AsyncInferenceClient(
+    ENDPOINT_NAME,
+    INPUT_BUCKET,
+    NOTIFICATION_TOPICS,
+    NOTIFICATION_QUEUE_PREFIX,
+    max_in_flight=MAX_IN_FLIGHT,
+    max_inputs_per_job=MAX_INPUTS_PER_JOB,
+    notification_timeout=NOTIFICATION_TIMEOUT,
+)
 
 
 def lambda_handler(event: ReceivedEvent, context: Any):
@@ -113,40 +141,32 @@ def lambda_handler(event: ReceivedEvent, context: Any):
         for answer in payload["answers"][ctx_idx]:
             inputs.append(f"answer: {answer} context: {ctx}")
 
-    json_data = {
-        "inputs": inputs,
-        "parameters": {
-            "max_length": 128,
-            "min_length": 2,
-            "early_stopping": True,
-            "num_beams": 4,
-            "temperature": 1.0,
-            "num_return_sequences": 4,
-            "top_k": 0,
-            "top_p": 0.92,
-            "repetition_penalty": 2.0,
-            "length_penalty": 1.0,
-        },
+    parameters = {
+        "max_length": 128,
+        "min_length": 2,
+        "early_stopping": True,
+        "num_beams": 4,
+        "temperature": 1.0,
+        "num_return_sequences": 4,
+        "top_k": 0,
+        "top_p": 0.92,
+        "repetition_penalty": 2.0,
+        "length_penalty": 1.0,
     }
-    s3_input_bucket.put(Body=json.dumps(json_data))
-
-    response: Response = sagemaker_runtime.invoke_endpoint_async(
-        EndpointName=ENDPOINT_NAME,
-        InputLocation="s3://" + INPUT_BUCKET + "/temp_input_file.json",
-        ContentType="application/json",
-    )
-    print(response)
-
-    s3_bucket, s3_key = response["OutputLocation"].split("/")[-2:]
-    print(s3_bucket, s3_key)
-    results = None
-
-    while results is None:
-        try:
-            results = s3_resource.Object(s3_bucket, s3_key).get()
-            print(results)
-        except ClientError:
-            sleep(0.5)
-
-    res_str: str = results["Body"].read().decode("utf-8")
-    return {"results": json.loads(res_str)}
+
+    try:
+        results = asyncio.run(client.generate(inputs, parameters, RESULT_TIMEOUT))
+    except TimeoutError as error:
+        return {"statusCode": 504, "body": json.dumps({"error": str(error)})}
+    except InferenceFailed as error:
+        print("INFERENCE FAILED", error.completion)
+        return {
+            "statusCode": 500,
+            "body": json.dumps(
+                {
+                    "error": str(error),
+                    "errorOutputLocation": error.completion.failure_location,
+                }
+            ),
+        }
+    return {"results": results}
@@ -0,0 +1,80 @@
+import json
+from dataclasses import dataclass
+from time import monotonic, sleep
+from typing import Any, Optional
+
+from botocore.exceptions import ClientError
+
+MISSING_OBJECT_CODES = ("404", "NoSuchKey", "NotFound")
+
+
+@dataclass
+class Completion:
+    succeeded: bool
+    output_location: Optional[str]
+    failure_location: Optional[str] = None
+    failure_reason: Optional[str] = None
+
+
+def split_s3_uri(uri: str) -> tuple[str, str]:
+    bucket, _, key = uri[len("s3://") :].partition("/")
+    return bucket, key
+
+
+def parse_notification(body: str) -> dict[str, Any]:
+    """SageMaker notification of an SQS message, with or without the SNS envelope"""
+    message = json.loads(body)
+    if message.get("Type") == "Notification":
+        message = json.loads(message["Message"])
+    return message
+
+
+def notification_completion(
+    notification: dict[str, Any], failure_location: Optional[str]
+) -> Completion:
+    response_parameters = notification.get("responseParameters", {})
+    if notification.get("invocationStatus") == "Completed":
+        return Completion(True, response_parameters.get("outputLocation"))
+    return Completion(
+        False,
+        None,
+        failure_location=response_parameters.get("failureLocation", failure_location),
+        failure_reason=notification.get("failureReason"),
+    )
+
+
+def _exists(s3: Any, location: str) -> bool:
+    bucket, key = split_s3_uri(location)
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in MISSING_OBJECT_CODES:
+            return False
+        raise
+    return True
+
+
+def poll_output(
+    s3: Any,
+    output_location: str,
+    failure_location: Optional[str],
+    deadline: float,
+    initial_delay: float = 0.1,
+    max_delay: float = 2.0,
+) -> Optional[Completion]:
+    """
+    HEADs the output (and failure) object with an exponential backoff until one
+    of them exists or `deadline` passes. Checks at least once.
+    """
+    delay = initial_delay
+    while True:
+        if _exists(s3, output_location):
+            return Completion(True, output_location)
+        if failure_location is not None and _exists(s3, failure_location):
+            return Completion(False, None, failure_location=failure_location)
+
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return None
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
@@ -0,0 +1,395 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from time import monotonic, time
+from typing import Any, Optional
+from uuid import uuid4
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from completion import (
+    Completion,
+    notification_completion,
+    parse_notification,
+    poll_output,
+    split_s3_uri,
+)
+
+INPUT_PREFIX = "inputs"
+# Tag of a notification queue, the last time its environment was invoked
+HEARTBEAT_TAG = "heartbeat"
+MISSING_QUEUE_CODES = ("AWS.SimpleQueueService.NonExistentQueue", "QueueDoesNotExist")
+
+
+class InferenceFailed(Exception):
+    def __init__(self, completion: Completion) -> None:
+        super().__init__(completion.failure_reason or "Inference failed")
+        self.completion = completion
+
+
+@dataclass
+class Job:
+    inference_id: str
+    input_key: str
+    output_location: str = ""
+    failure_location: Optional[str] = None
+
+
+def chunks(inputs: list[str], size: int) -> list[list[str]]:
+    return [inputs[start : start + size] for start in range(0, len(inputs), size)]
+
+
+class NotificationRoute:
+    """
+    Notification queue of this execution environment, subscribed to the
+    endpoint topics with a filter on the inference id prefix of its jobs:
+    concurrent lambdas never receive each other's notifications. The queues of
+    environments not invoked for `stale_seconds` are deleted, along with their
+    subscriptions, by the next environment to create its own.
+    """
+
+    def __init__(
+        self,
+        sqs: Any,
+        sns: Any,
+        topic_arns: list[str],
+        queue_prefix: str,
+        stale_seconds: float = 3600,
+    ) -> None:
+        self.sqs = sqs
+        self.sns = sns
+        self.topic_arns = topic_arns
+        self.queue_prefix = queue_prefix
+        self.stale_seconds = stale_seconds
+        self.id_prefix = uuid4().hex[:16]
+        self.queue_url: Optional[str] = None
+
+    def inference_id(self) -> str:
+        return f"{self.id_prefix}-{uuid4().hex}"
+
+    def ensure(self) -> str:
+        """Url of the queue, created on first use and again once swept"""
+        if self.queue_url is not None:
+            try:
+                self.sqs.tag_queue(
+                    QueueUrl=self.queue_url, Tags={HEARTBEAT_TAG: str(int(time()))}
+                )
+                return self.queue_url
+            except ClientError as error:
+                if error.response["Error"]["Code"] not in MISSING_QUEUE_CODES:
+                    raise
+        self.sweep()
+        self.queue_url = self._create()
+        return self.queue_url
+
+    def _queue_arn(self, queue_url: str) -> str:
+        return self.sqs.get_queue_attributes(
+            QueueUrl=queue_url, AttributeNames=["QueueArn"]
+        )["Attributes"]["QueueArn"]
+
+    def _create(self) -> str:
+        # A deleted queue name can not be reused right away
+        self.id_prefix = uuid4().hex[:16]
+        queue_url = self.sqs.create_queue(
+            QueueName=f"{self.queue_prefix}-{self.id_prefix}",
+            # Notifications of jobs which timed out are not worth keeping around
+            Attributes={"MessageRetentionPeriod": "300"},
+            tags={HEARTBEAT_TAG: str(int(time()))},
+        )["QueueUrl"]
+        queue_arn = self._queue_arn(queue_url)
+        policy = {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": "Allow",
+                    "Principal": {"Service": "sns.amazonaws.com"},
+                    "Action": "sqs:SendMessage",
+                    "Resource": queue_arn,
+                    "Condition": {"ArnEquals": {"aws:SourceArn": self.topic_arns}},
+                }
+            ],
+        }
+        self.sqs.set_queue_attributes(
+            QueueUrl=queue_url, Attributes={"Policy": json.dumps(policy)}
+        )
+        filter_policy = {"inferenceId": [{"prefix": f"{self.id_prefix}-"}]}
+        for topic_arn in self.topic_arns:
+            self.sns.subscribe(
+                TopicArn=topic_arn,
+                Protocol="sqs",
+                Endpoint=queue_arn,
+                Attributes={
+                    "RawMessageDelivery": "true",
+                    "FilterPolicyScope": "MessageBody",
+                    "FilterPolicy": json.dumps(filter_policy),
+                },
+            )
+        return queue_url
+
+    def sweep(self) -> None:
+        """Deletes the queues and subscriptions of stale environments"""
+        now = time()
+        stale: dict[str, str] = {}
+        queue_urls = self.sqs.list_queues(QueueNamePrefix=f"{self.queue_prefix}-")
+        for queue_url in queue_urls.get("QueueUrls", []):
+            try:
+                tags = self.sqs.list_queue_tags(QueueUrl=queue_url).get("Tags", {})
+                if now - float(tags.get(HEARTBEAT_TAG, 0)) > self.stale_seconds:
+                    stale[self._queue_arn(queue_url)] = queue_url
+            except ClientError:
+                # Swept by another environment meanwhile
+                continue
+        if not stale:
+            return
+        paginator = self.sns.get_paginator("list_subscriptions_by_topic")
+        for topic_arn in self.topic_arns:
+            for page in paginator.paginate(TopicArn=topic_arn):
+                for subscription in page["Subscriptions"]:
+                    if subscription["Endpoint"] in stale:
+                        self.sns.unsubscribe(
+                            SubscriptionArn=subscription["SubscriptionArn"]
+                        )
+        for queue_url in stale.values():
+            try:
+                self.sqs.delete_queue(QueueUrl=queue_url)
+            except ClientError:
+                continue
+
+
+class NotificationWaiter:
+    """
+    Single long poller of the notification queue of this process for all the
+    jobs it has in flight, it resolves their futures by inference id.
+    Notifications of jobs it gave up on are deleted.
+    """
+
+    def __init__(self, sqs: Any, queue_url: str, wait_seconds: int = 5) -> None:
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.wait_seconds = wait_seconds
+        self.pending: dict[
+            str, tuple[asyncio.AbstractEventLoop, "asyncio.Future[dict[str, Any]]"]
+        ] = {}
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def expect(self, inference_id: str) -> "asyncio.Future[dict[str, Any]]":
+        """Future of the notification of `inference_id`, call it before invoking"""
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[dict[str, Any]]" = loop.create_future()
+        with self.lock:
+            self.pending[inference_id] = (loop, future)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._poll, daemon=True)
+                self.thread.start()
+        return future
+
+    def forget(self, inference_id: str) -> None:
+        with self.lock:
+            self.pending.pop(inference_id, None)
+
+    def _resolve(
+        self, inference_id: str, notification: Any, failed: bool = False
+    ) -> None:
+        with self.lock:
+            entry = self.pending.pop(inference_id, None)
+        if entry is None:
+            return
+        loop, future = entry
+
+        def set_future() -> None:
+            if future.done():
+                return
+            if failed:
+                future.set_exception(notification)
+            else:
+                future.set_result(notification)
+
+        loop.call_soon_threadsafe(set_future)
+
+    def _poll(self) -> None:
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+            try:
+                response = self.sqs.receive_message(
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=10,
+                    WaitTimeSeconds=self.wait_seconds,
+                )
+            except ClientError as error:
+                # Every waiting job falls back to polling its output
+                with self.lock:
+                    inference_ids = list(self.pending)
+                for inference_id in inference_ids:
+                    self._resolve(inference_id, error, failed=True)
+                continue
+
+            for message in response.get("Messages", []):
+                # The queue only gets notifications of this process' jobs, the
+                # ones no longer pending timed out
+                self.sqs.delete_message(
+                    QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"]
+                )
+                try:
+                    notification = parse_notification(message["Body"])
+                except (KeyError, ValueError):
+                    continue
+                self._resolve(notification.get("inferenceId", ""), notification)
+
+
+class AsyncInferenceClient:
+    """
+    Splits the inputs of a request into async inference jobs of at most
+    `max_inputs_per_job` inputs. Every job gets its own input object, so
+    concurrent requests never overwrite each other. At most `max_in_flight`
+    jobs run at once over a shared pool of connections, and their outputs are
+    gathered back in input order.
+
+    With `notification_topics`, a job waits for the endpoint's notification on
+    the queue of this environment for up to `notification_timeout` seconds,
+    then polls its output like it does without them.
+    """
+
+    def __init__(
+        self,
+        endpoint_name: str,
+        input_bucket: str,
+        notification_topics: Optional[list[str]] = None,
+        notification_queue_prefix: str = "async-notifications",
+        max_in_flight: int = 8,
+        max_inputs_per_job: int = 32,
+        notification_timeout: float = 30,
+    ) -> None:
+        self.endpoint_name = endpoint_name
+        self.input_bucket = input_bucket
+        self.max_in_flight = max_in_flight
+        self.max_inputs_per_job = max_inputs_per_job
+        self.notification_timeout = notification_timeout
+        # boto3 clients are thread safe, one connection per worker thread
+        config = Config(max_pool_connections=max_in_flight)
+        self.sagemaker = boto3.client("runtime.sagemaker", config=config)
+        self.s3 = boto3.client("s3", config=config)
+        self.route: Optional[NotificationRoute] = None
+        self.waiter: Optional[NotificationWaiter] = None
+        if notification_topics:
+            sqs = boto3.client("sqs")
+            self.route = NotificationRoute(
+                sqs, boto3.client("sns"), notification_topics, notification_queue_prefix
+            )
+            self.waiter = NotificationWaiter(sqs, "")
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def _submit(self, job: Job, inputs: list[str], parameters: dict[str, Any]) -> None:
+        self.s3.put_object(
+            Bucket=self.input_bucket,
+            Key=job.input_key,
+            Body=json.dumps({"inputs": inputs, "parameters": parameters}),
+        )
+        response = self.sagemaker.invoke_endpoint_async(
+            EndpointName=self.endpoint_name,
+            InputLocation=f"s3://{self.input_bucket}/{job.input_key}",
+            ContentType="application/json",
+            InferenceId=job.inference_id,
+        )
+        job.output_location = response["OutputLocation"]
+        job.failure_location = response.get("FailureLocation")
+
+    def _fetch(self, job: Job) -> list[Any]:
+        bucket, key = split_s3_uri(job.output_location)
+        body = self.s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+        return json.loads(body.decode("utf-8"))
+
+    def _delete_input(self, job: Job) -> None:
+        try:
+            self.s3.delete_object(Bucket=self.input_bucket, Key=job.input_key)
+        except ClientError as error:
+            print("INPUT NOT DELETED", job.input_key, repr(error))
+
+    async def _wait(
+        self,
+        job: Job,
+        notification: "Optional[asyncio.Future[dict[str, Any]]]",
+        deadline: float,
+    ) -> Optional[Completion]:
+        if notification is not None:
+            timeout = min(deadline - monotonic(), self.notification_timeout)
+            try:
+                return notification_completion(
+                    await asyncio.wait_for(notification, timeout=max(timeout, 0)),
+                    job.failure_location,
+                )
+            except asyncio.TimeoutError:
+                # The notification may have been lost, poll the output until the
+                # deadline
+                print("NOTIFICATION TIMEOUT", job.inference_id)
+            except ClientError as error:
+                print("NOTIFICATION QUEUE UNAVAILABLE", repr(error))
+        poll = partial(
+            poll_output, self.s3, job.output_location, job.failure_location, deadline
+        )
+        return await asyncio.get_running_loop().run_in_executor(self.executor, poll)
+
+    async def _run_job(
+        self,
+        inputs: list[str],
+        parameters: dict[str, Any],
+        deadline: float,
+        waiter: Optional[NotificationWaiter],
+    ) -> list[Any]:
+        loop = asyncio.get_running_loop()
+        inference_id = self.route.inference_id() if self.route else uuid4().hex
+        job = Job(inference_id, f"{INPUT_PREFIX}/{inference_id}.json")
+        notification = waiter.expect(inference_id) if waiter else None
+        try:
+            await loop.run_in_executor(
+                self.executor, partial(self._submit, job, inputs, parameters)
+            )
+            completion = await self._wait(job, notification, deadline)
+            if completion is None:
+                raise TimeoutError(f"Inference {inference_id} did not complete in time")
+            if not completion.succeeded:
+                raise InferenceFailed(completion)
+            return await loop.run_in_executor(self.executor, partial(self._fetch, job))
+        finally:
+            if waiter is not None:
+                waiter.forget(inference_id)
+            # Failed and timed out jobs leave no input behind either
+            await loop.run_in_executor(self.executor, partial(self._delete_input, job))
+
+    async def _notification_waiter(self) -> Optional[NotificationWaiter]:
+        """The waiter on the queue of this environment, None to poll outputs"""
+        if self.route is None or self.waiter is None:
+            return None
+        try:
+            # Recreated when it was swept while this environment was frozen
+            self.waiter.queue_url = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.route.ensure
+            )
+        except ClientError as error:
+            print("NOTIFICATION QUEUE UNAVAILABLE", repr(error))
+            return None
+        return self.waiter
+
+    async def generate(
+        self, inputs: list[str], parameters: dict[str, Any], timeout: float
+    ) -> list[Any]:
+        deadline = monotonic() + timeout
+        slots = asyncio.Semaphore(self.max_in_flight)
+        waiter = await self._notification_waiter()
+
+        async def run(job_inputs: list[str]) -> list[Any]:
+            async with slots:
+                return await self._run_job(job_inputs, parameters, deadline, waiter)
+
+        outputs = await asyncio.gather(
+            *(run(job_inputs) for job_inputs in chunks(inputs, self.max_inputs_per_job))
+        )
+        return [output for job_outputs in outputs for output in job_outputs]
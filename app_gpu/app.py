@@ -1,117 +1,200 @@
+import asyncio
 import json
+import os
+import subprocess
+import sys
 from pathlib import Path
-from typing import Any, Literal
+from typing import Any, AsyncIterator, Optional
 
 import uvicorn
-from fastapi import FastAPI
-from pydantic import BaseModel
-from torch.cuda import is_available as gpu_available
-from transformers.modeling_utils import PreTrainedModel
-from transformers.models.auto.modeling_auto import AutoModelForSeq2SeqLM
-from transformers.models.auto.tokenization_auto import AutoTokenizer
-from transformers.pipelines.text2text_generation import \
-    Text2TextGenerationPipeline
-from transformers.tokenization_utils import PreTrainedTokenizer
-
-Text2TextPipelineOutput = list[list[dict[Literal["generated_text"], str]]]
-
-DEFAULT_GENERATOR_OPTIONS = {
-    "max_length": 128,
-    "min_length": 2,
-    "early_stopping": True,
-    "num_beams": 1,
-    "batch_size": 16,
-    "temperature": 1.0,
-    "num_return_sequences": 1,
-    "top_k": 0,
-    "top_p": 0.92,
-    "repetition_penalty": 2.0,
-    "length_penalty": 1.0,
-}
-
-
-class MultipleText2TextGenerationPipeline(Text2TextGenerationPipeline):
-    def __call__(self, *args: list[Any], **kwargs: Any):
-        result: Text2TextPipelineOutput = super(
-            Text2TextGenerationPipeline, self
-        ).__call__(*args, **kwargs)
-        flatten_results: list[str] = []
-        for result_list in result:
-            for result_dict in result_list:
-                flatten_results.append(
-                    result_dict["generated_text"].replace("question: ", "")
-                )
-        return flatten_results
-
-
-class T5QuestionGenerator:
-    def __init__(self) -> None:
-        self.tokenizer: PreTrainedTokenizer
-        self.model: PreTrainedModel
-        self.weights_cache_folder = Path(__file__).parent.joinpath("models")
-        self.model_checkpoint = "mrm8488/t5-base-finetuned-question-generation-ap"
-        self.pipeline: MultipleText2TextGenerationPipeline
-
-    def load(self):
-        model = AutoModelForSeq2SeqLM.from_pretrained(self.weights_cache_folder)
-        tokenizer = AutoTokenizer.from_pretrained(self.weights_cache_folder)
-
-        tokenizer.save_pretrained(self.weights_cache_folder)
-        model.save_pretrained(self.weights_cache_folder)
-
-        self.pipeline = MultipleText2TextGenerationPipeline(
-            model=model, tokenizer=tokenizer, device=0 if gpu_available() else -1
-        )
-
-    def __call__(
-        self, answers: list[list[str]], contexts: list[str]
-    ) -> list[list[str]]:
-        input_texts: list[str] = []
-        answer_mapping: list[int] = []
-        generated_questions: list[list[str]] = []
-
-        for ctx_idx, ctx in enumerate(contexts):
-            generated_questions.append([])
-            for a in answers[ctx_idx]:
-                input_texts.append(f"answer: {a} context: {ctx}")
-                answer_mapping.append(ctx_idx)
-
-        output_texts: list[str] = self.pipeline(
-            input_texts, **DEFAULT_GENERATOR_OPTIONS
-        )
-
-        n_inputs_texts = len(input_texts)
-        step = DEFAULT_GENERATOR_OPTIONS["num_return_sequences"]
-        for input_text_idx in range(n_inputs_texts):
-            question_batch_start = input_text_idx * step
-            question_batch_end = question_batch_start + step
-            question_batch = output_texts[question_batch_start:question_batch_end]
-
-            fact_idx = answer_mapping[input_text_idx]
-            generated_questions[fact_idx].extend(question_batch)
-
-        return generated_questions
-
-
-model = T5QuestionGenerator()
-model.load()
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+from batching import MicroBatcher
+from question_generation import GenerationCache, T5QuestionGenerator
+from question_generation.metrics import enable_multiprocess, exposition, track_request
+from question_generation.profiling import authorized, profile_processes
+from question_generation.replica_pool import ReplicaPool
+from question_generation.schema import Question
+
+# Generated questions are cached per prompt and generator options, set
+# GENERATION_CACHE_PATH to also keep them in a sqlite file across restarts.
+GENERATION_CACHE_SIZE = int(os.environ.get("GENERATION_CACHE_SIZE", 4096))
+GENERATION_CACHE_TTL = float(os.environ.get("GENERATION_CACHE_TTL", 24 * 3600))
+GENERATION_CACHE_PATH = os.environ.get("GENERATION_CACHE_PATH")
+
+# Upper bound of (answer, context) pairs per generator call and maximum time a
+# request waits for others to join its batch.
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 32))
+MAX_BATCH_WAIT_MS = float(os.environ.get("MAX_BATCH_WAIT_MS", 10))
+
+# Number of model worker processes, 0 keeps the model in the server process
+N_REPLICAS = int(os.environ.get("N_REPLICAS", 0))
+
+WEIGHTS_CACHE_FOLDER = Path(__file__).parent.joinpath("models")
+
+# Engine serving the model ("torch", "torchscript", ...), "auto" picks the
+# fastest one on this host.
+ENGINE = os.environ.get("ENGINE", "auto")
+
+# Encoder budget of a prompt, long contexts are cut around the answer to fit
+MAX_INPUT_TOKENS = int(os.environ.get("MAX_INPUT_TOKENS", 512))
+
+# Bearer token of the profiling endpoint, which is disabled when it is not set
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+# Longest profiling session, in seconds
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 60))
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def load_model() -> T5QuestionGenerator:
+    model = T5QuestionGenerator(
+        WEIGHTS_CACHE_FOLDER,
+        engine=ENGINE,
+        max_input_tokens=MAX_INPUT_TOKENS,
+        cache=GenerationCache(
+            max_entries=GENERATION_CACHE_SIZE,
+            ttl_seconds=GENERATION_CACHE_TTL,
+            disk_path=GENERATION_CACHE_PATH,
+        ),
+    )
+    model.load()
+    return model
+
+
+# Replica processes import this module again, they must not load a model here
+if N_REPLICAS > 0:
+    enable_multiprocess()
+pool = ReplicaPool(load_model, N_REPLICAS) if N_REPLICAS > 0 else None
+model = load_model() if pool is None else None
+
+batcher = MicroBatcher(
+    model or pool,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=MAX_BATCH_WAIT_MS,
+    max_concurrent_batches=max(N_REPLICAS, 1),
+)
 
 app = FastAPI()
-
-
-class Question(BaseModel):
-    answers: list[list[str]]
-    contexts: list[str]
+profile_lock = asyncio.Lock()
+
+
+@app.on_event("startup")
+def start_batcher():
+    if pool is not None:
+        if ENGINE == "auto":
+            # Calibrates once for all the replicas, which read its selection
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "question_generation.calibration",
+                    str(WEIGHTS_CACHE_FOLDER),
+                ],
+                check=True,
+            )
+        pool.start()
+    batcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    await batcher.stop()
+    if pool is not None:
+        pool.stop()
 
 
 @app.get("/status")
 def get_status():
-    return {"status": "ok"}
+    status: dict[str, Any] = {"status": "ok", "shared_pairs": batcher.shared_pairs}
+    if model is not None:
+        status["cache"] = model.cache.stats()
+    if pool is not None:
+        status["replicas"] = pool.status()
+    return status
+
+
+@app.get("/metrics")
+def get_metrics():
+    body, content_type = exposition()
+    return Response(body, media_type=content_type)
+
+
+@app.post("/debug/profile")
+async def profile(
+    requests: Optional[int] = None,
+    seconds: Optional[float] = None,
+    authorization: str = Header(""),
+):
+    """
+    Profiles the next `requests` generator calls of every replica, or the next
+    `seconds`. Returns a zip of Chrome traces (torch.profiler) and folded
+    python stacks (flamegraph.pl, speedscope), one of each per process.
+    """
+    if not PROFILE_TOKEN:
+        raise HTTPException(404)
+    if not authorized(authorization, PROFILE_TOKEN):
+        raise HTTPException(401)
+    if not requests and not seconds:
+        raise HTTPException(400, "Set requests or seconds")
+    if profile_lock.locked():
+        raise HTTPException(409, "A profiling session is already running")
+    async with profile_lock:
+        body = await profile_processes(
+            pool, requests, min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        )
+    return Response(
+        body,
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="profile.zip"'},
+    )
+
+
+async def stream_questions(question: Question) -> AsyncIterator[str]:
+    """
+    Yields one json line per context, in completion order. A failure ends the
+    stream with an {"error": ...} line, the status being already sent.
+    """
+
+    async def generate(ctx_idx: int) -> tuple[int, list[str]]:
+        (questions,) = await batcher.submit(
+            [question.answers[ctx_idx]],
+            [question.contexts[ctx_idx]],
+            **question.parameters.options(),
+        )
+        return ctx_idx, questions
+
+    tasks = [
+        asyncio.ensure_future(generate(ctx_idx))
+        for ctx_idx in range(len(question.contexts))
+    ]
+    # Until the last line is sent, not only until the response starts
+    with track_request():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                ctx_idx, questions = await next_done
+                yield json.dumps({"index": ctx_idx, "questions": questions}) + "\n"
+        except Exception as error:
+            print("STREAM FAILED", repr(error))
+            yield json.dumps({"error": str(error) or type(error).__name__}) + "\n"
+        finally:
+            # The client went away, no need to generate the remaining contexts
+            for task in tasks:
+                task.cancel()
 
 
 @app.post("/")
-def handler(question: Question):
-    res = model(question.answers, question.contexts)
+async def handler(question: Question, request: Request):
+    if NDJSON_CONTENT_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_questions(question), media_type=NDJSON_CONTENT_TYPE
+        )
+
+    with track_request():
+        res = await batcher.submit(
+            question.answers, question.contexts, **question.parameters.options()
+        )
     return {
         "statusCode": 200,
         "body": json.dumps(res),
@@ -0,0 +1,208 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable, Optional
+
+from question_generation.generation_cache import cache_key, is_cacheable
+from question_generation.context_window import prompt
+
+GenerateFn = Callable[..., list[list[str]]]
+
+
+@dataclass
+class PendingRequest:
+    answers: list[list[str]]
+    contexts: list[str]
+    options: dict[str, Any]
+    future: "asyncio.Future[list[list[str]]]"
+
+    @property
+    def n_pairs(self) -> int:
+        return sum(len(answers) for answers in self.answers)
+
+
+@dataclass
+class InFlightPair:
+    """Generation of an (answer, context) pair, awaited by `waiters` requests"""
+
+    future: "asyncio.Future[list[list[str]]]"
+    waiters: int = 0
+
+
+class MicroBatcher:
+    """
+    Coalesces the (answer, context) pairs of concurrent requests into a single
+    generator call. A batch is flushed when it holds `max_batch_size` pairs or
+    when `max_wait_ms` elapsed since its first request, whichever comes first.
+    Only requests with the same generator options are merged together.
+    The generator runs on worker threads, at most `max_concurrent_batches` at
+    once (one per model replica), so the event loop keeps accepting requests
+    (which will form the next batches) while it runs.
+    Pairs are queued one by one: a pair already queued or being generated
+    with the same options is not queued again, its requests share the result.
+    """
+
+    def __init__(
+        self,
+        generate: GenerateFn,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 10.0,
+        max_concurrent_batches: int = 1,
+    ) -> None:
+        self.generate = generate
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max_concurrent_batches
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_batches)
+        self.queue: "asyncio.Queue[PendingRequest]"
+        self.slots: asyncio.Semaphore
+        self._carry: Optional[PendingRequest] = None
+        self._worker: Optional["asyncio.Task[None]"] = None
+        self._batches: "set[asyncio.Task[None]]" = set()
+        self.in_flight: dict[str, InFlightPair] = {}
+        self.shared_pairs = 0
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for task in list(self._batches):
+            task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def submit(
+        self, answers: list[list[str]], contexts: list[str], **options: Any
+    ) -> list[list[str]]:
+        if len(answers) != len(contexts):
+            raise ValueError("answers and contexts must have the same length")
+        if not contexts:
+            return []
+        loop = asyncio.get_running_loop()
+        # Sampled generations differ from one call to the next
+        shareable = is_cacheable(options)
+        pairs: list[list[InFlightPair]] = []
+        for context, context_answers in zip(contexts, answers):
+            pairs.append([])
+            for answer in context_answers:
+                key = cache_key(prompt(answer, context), options)
+                pair = self.in_flight.get(key) if shareable else None
+                if pair is None or pair.future.cancelled():
+                    pair = InFlightPair(loop.create_future())
+                    if shareable:
+                        self.in_flight[key] = pair
+                        pair.future.add_done_callback(partial(self._forget, key, pair))
+                    self.queue.put_nowait(
+                        PendingRequest([[answer]], [context], options, pair.future)
+                    )
+                else:
+                    self.shared_pairs += 1
+                pair.waiters += 1
+                pairs[-1].append(pair)
+
+        try:
+            results: list[list[str]] = []
+            for context_pairs in pairs:
+                results.append([])
+                for pair in context_pairs:
+                    # Other requests may wait for it, it must outlive this one
+                    (questions,) = await asyncio.shield(pair.future)
+                    results[-1].extend(questions)
+            return results
+        except asyncio.CancelledError:
+            # Pairs no request waits for anymore are skipped by the batches
+            for context_pairs in pairs:
+                for pair in context_pairs:
+                    pair.waiters -= 1
+                    if pair.waiters == 0:
+                        pair.future.cancel()
+            raise
+
+    def _forget(self, key: str, pair: InFlightPair, _: "asyncio.Future[Any]") -> None:
+        if self.in_flight.get(key) is pair:
+            del self.in_flight[key]
+
+    async def _next_request(self) -> PendingRequest:
+        if self._carry is not None:
+            request, self._carry = self._carry, None
+            return request
+        return await self.queue.get()
+
+    async def _collect(self) -> list[PendingRequest]:
+        loop = asyncio.get_running_loop()
+        first = await self._next_request()
+        batch = [first]
+        n_pairs = first.n_pairs
+        deadline = loop.time() + self.max_wait
+
+        while n_pairs < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if (
+                request.options != first.options
+                or n_pairs + request.n_pairs > self.max_batch_size
+            ):
+                # Keep it for the next batch, a single oversized request still
+                # goes through alone.
+                self._carry = request
+                break
+            batch.append(request)
+            n_pairs += request.n_pairs
+
+        return [request for request in batch if not request.future.done()]
+
+    async def _run(self) -> None:
+        while True:
+            # Requests keep queuing up while every slot is busy
+            await self.slots.acquire()
+            batch = await self._collect()
+            if not batch:
+                self.slots.release()
+                continue
+            task = asyncio.create_task(self._process(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batch_done)
+
+    def _batch_done(self, task: "asyncio.Task[None]") -> None:
+        self._batches.discard(task)
+        self.slots.release()
+
+    async def _process(self, batch: list[PendingRequest]) -> None:
+        loop = asyncio.get_running_loop()
+        answers: list[list[str]] = []
+        contexts: list[str] = []
+        for request in batch:
+            answers.extend(request.answers)
+            contexts.extend(request.contexts)
+
+        try:
+            results = await loop.run_in_executor(
+                self.executor,
+                partial(self.generate, answers, contexts, **batch[0].options),
+            )
+        except Exception as error:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(error)
+            return
+
+        offset = 0
+        for request in batch:
+            n_contexts = len(request.contexts)
+            if not request.future.done():
+                request.future.set_result(results[offset : offset + n_contexts])
+            offset += n_contexts
@@ -1,252 +1,153 @@
+import asyncio
 import os
-# from time import perf_counter
-from typing import Any, List, Optional, cast
+from functools import partial
+from time import perf_counter
+from typing import Callable, List, Optional, cast
 
 # import numpy as np
 import tensorflow  # type: ignore
 import torch
 import torch.neuron
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import Response
 from pydantic import BaseModel
-from torch.nn import functional as F
-from transformers.generation_utils import GenerationMixin
-from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
-from transformers.modeling_utils import PreTrainedModel
-from transformers.models.t5.configuration_t5 import T5Config
-from transformers.models.t5.modeling_t5 import T5ForConditionalGeneration
-from transformers.models.t5.tokenization_t5 import T5Tokenizer
+from transformers.models.t5.tokenization_t5_fast import T5TokenizerFast
+
+from context_window import windowed_prompts
+from metrics import (
+    enable_multiprocess,
+    exposition,
+    observe_input_tokens,
+    observe_model_load,
+    timed,
+    track_request,
+)
+from neuron_generation import NeuronBucketedGeneration, traced_shapes
+from profiling import authorized, profile_processes, profiled
+from replica_pool import ReplicaPool
 
 print("PATH", os.getcwd())
 model_id = "mrm8488/t5-base-finetuned-question-generation-ap"
-num_texts = 1  # Number of input texts to decode
 num_beams = 4  # Number of beams per input text
-max_encoder_length = 32  # Maximum input token length
 max_decoder_length = 32
-
-
-def reduce(hidden: torch.Tensor, index: int):
-    _, n_length, _ = hidden.shape
-
-    # Create selection mask
-    mask = torch.arange(n_length, dtype=torch.float32) == index
-    mask = mask.view(1, -1, 1)
-
-    # Broadcast mask
-    masked = torch.multiply(hidden, mask)
-
-    # Reduce along 1st dimension
-    summed = torch.sum(masked, 1)
-    return torch.unsqueeze(summed, 1)
-
-
-class NeuronEncoder(torch.nn.Module):
-    def __init__(self, model: T5ForConditionalGeneration):
-        super().__init__()
-        self.encoder = model.encoder
-        self.encoder.main_input_name = model.main_input_name
-
-    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
-        return self.encoder(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            return_dict=False,
-            output_hidden_states=False,
-            output_attentions=False,
-        )
-
-
-class NeuronDecoder(torch.nn.Module):
-    def __init__(self, model: T5ForConditionalGeneration, max_length: int):
-        super().__init__()
-        self.weight = cast(torch.Tensor, model.shared.weight.clone().detach())
-        self.decoder = model.decoder
-        self.max_length = max_length
-
-    def forward(
-        self,
-        input_ids: torch.Tensor,
-        attention_mask: torch.Tensor,
-        encoder_outputs: torch.Tensor,
-        index: int,
-    ):
-        # Invoke the decoder
-        (hidden,) = self.decoder(
-            input_ids=input_ids,
-            encoder_hidden_states=encoder_outputs,
-            return_dict=False,
-            use_cache=False,
-        )
-
-        # Reduce decoder outputs to the specified index (current iteration)
-        hidden = reduce(hidden, index)
-
-        # Compute final linear layer for token probabilities
-        logits = F.linear(hidden, self.weight)
-        return logits
-
-
-class NeuronGeneration(PreTrainedModel, GenerationMixin):
-    def trace(
-        self,
-        model: T5ForConditionalGeneration,
-        num_texts: int,
-        num_beams: int,
-        max_encoder_length: int,
-        max_decoder_length: int,
-    ) -> None:
-        """
-        Traces the encoder and decoder modules for use on Neuron.
-        This function fixes the network to the given sizes. Once the model has been
-        compiled to a given size, the inputs to these networks must always be of
-        fixed size.
-        Args:
-            model (GenerationMixin): The transformer-type generator model to trace
-            num_texts (int): The number of input texts to translate at once
-            num_beams (int): The number of beams to computer per text
-            max_encoder_length (int): The maximum number of encoder tokens
-            max_encoder_length (int): The maximum number of decoder tokens
-        """
-        self.config.max_decoder_length = max_decoder_length
-
-        # Trace the encoder
-        inputs = (
-            torch.ones((num_texts, max_encoder_length), dtype=torch.long),
-            torch.ones((num_texts, max_encoder_length), dtype=torch.long),
-        )
-        encoder = NeuronEncoder(model)
-        self.encoder = cast(NeuronEncoder, torch.neuron.trace(encoder, inputs))
-
-        # Trace the decoder (with expanded inputs)
-        batch_size = num_texts * num_beams
-        inputs = (
-            torch.ones((batch_size, max_decoder_length), dtype=torch.long),
-            torch.ones((batch_size, max_encoder_length), dtype=torch.long),
-            torch.ones(
-                (batch_size, max_encoder_length, model.config.d_model),
-                dtype=torch.float,
-            ),
-            torch.tensor(0),
-        )
-        decoder = NeuronDecoder(model, max_decoder_length)
-        self.decoder = cast(NeuronDecoder, torch.neuron.trace(decoder, inputs))
-
-    # ------------------------------------------------------------------------
-    # Encoder/Decoder Invocation
-    # ------------------------------------------------------------------------
-
-    def prepare_inputs_for_generation(
-        self,
-        input_ids: torch.Tensor,
-        encoder_outputs: BaseModelOutput,
-        attention_mask: Optional[BaseModelOutput] = None,
-        **model_kwargs: Any,
-    ):
-        # Pad the inputs for Neuron
-        current_length = input_ids.shape[1]
-        pad_size = self.config.max_decoder_length - current_length
-        return dict(
-            input_ids=F.pad(input_ids, (0, pad_size)),
-            attention_mask=attention_mask,
-            encoder_outputs=encoder_outputs.last_hidden_state,
-            current_length=torch.tensor(current_length - 1),
-        )
-
-    def get_encoder(self):
-        """Helper to invoke the encoder and wrap the results in the expected structure"""
-
-        def encode(**kwargs: Any):
-            input_ids = kwargs["input_ids"]
-            attention_mask = kwargs.get("attention_mask", torch.ones_like(input_ids))
-            (output,) = self.encoder(input_ids, attention_mask)
-            return BaseModelOutput(
-                last_hidden_state=output,
+# Shape of the models traced before buckets, a single NeuronGeneration saved
+# without a buckets.json manifest. Retrace the buckets to serve longer inputs.
+single_shape = (1, 32)
+# Number of model worker processes, each on its own NeuronCore. 0 keeps the
+# model in the server process
+n_replicas = int(os.environ.get("N_REPLICAS", 0))
+# Bearer token of the profiling endpoint, which is disabled when it is not set
+profile_token = os.environ.get("PROFILE_TOKEN", "")
+# Longest profiling session, in seconds
+profile_max_seconds = float(os.environ.get("PROFILE_MAX_SECONDS", 60))
+
+
+def infer(
+    model: NeuronBucketedGeneration, tokenizer: T5TokenizerFast, texts: List[str]
+) -> List[List[str]]:
+    with profiled(), timed("generate"):
+        # Only truncate to the largest bucket, the model pads to the selected one
+        with timed("tokenize"):
+            batch = tokenizer(
+                texts,
+                max_length=model.max_encoder_length,
+                truncation=True,
+                padding=True,
+                return_tensors="pt",
             )
-
-        return encode
-
-    def __call__(
-        self,
-        input_ids: torch.Tensor,
-        attention_mask: torch.Tensor,
-        encoder_outputs: BaseModelOutput,
-        current_length: int,
-        **kwargs: Any,
-    ):
-        """Helper to invoke the decoder and wrap the results in the expected structure"""
-        logits = self.decoder(
-            input_ids, attention_mask, encoder_outputs, current_length
+        observe_input_tokens(int(batch["attention_mask"].sum()))
+        # with torch.inference_mode():
+        output = model.generate(
+            inputs=cast(torch.Tensor, batch["input_ids"]),
+            attention_mask=cast(torch.Tensor, batch["attention_mask"]),
+            max_length=max_decoder_length,
+            num_beams=num_beams,
+            num_return_sequences=num_beams,
         )
-        return Seq2SeqLMOutput(logits=logits)
-
-    # ------------------------------------------------------------------------
-    # Serialization
-    # ------------------------------------------------------------------------
-
-    def save_pretrained(self, directory: str):
-        if os.path.isfile(directory):
-            print(f"Provided path ({directory}) should be a directory, not a file")
-            return
-        os.makedirs(directory, exist_ok=True)
-        torch.jit.save(self.encoder, os.path.join(directory, "encoder.pt"))
-        torch.jit.save(self.decoder, os.path.join(directory, "decoder.pt"))
-        self.config.save_pretrained(directory)
-
-    @classmethod
-    def from_pretrained(cls, directory: str):
-        config = T5Config.from_pretrained(directory)
-        obj = cls(config)
-        obj.main_input_name = "input_ids"
-        obj.encoder = torch.jit.load(os.path.join(directory, "encoder.pt"))
-        obj.encoder.main_input_name = "input_ids"
-        obj.decoder = torch.jit.load(os.path.join(directory, "decoder.pt"))
-        obj.decoder.main_input_name = "decoder_input_ids"
-        return obj
-
-    @property
-    def device(self):
-        return torch.device("cpu")
-
-
-def infer(model: NeuronGeneration, tokenizer: T5Tokenizer, text: str):
-    # Truncate and pad the max length to ensure that the token size is compatible with fixed-sized encoder (Not necessary for pure CPU execution)
-    batch = tokenizer(
-        text,
-        max_length=max_decoder_length,
-        truncation=True,
-        padding="max_length",
-        return_tensors="pt",
-    )
-    # with torch.inference_mode():
-    output = model.generate(
-        inputs=cast(torch.Tensor, batch["input_ids"]),
-        max_length=max_decoder_length,
-        num_beams=num_beams,
-        num_return_sequences=num_beams,
-    )
-    results = [tokenizer.decode(t, skip_special_tokens=True) for t in output]
+        with timed("detokenize"):
+            results = tokenizer.batch_decode(output, skip_special_tokens=True)
 
-    return results
+    # num_beams sequences per text, in the same order as the texts
+    return [
+        results[text_idx * num_beams : (text_idx + 1) * num_beams]
+        for text_idx in range(len(texts))
+    ]
 
 
 # model_cpu = cast(T5ForConditionalGeneration, T5ForConditionalGeneration.from_pretrained(model_id))
-tokenizer_cpu = cast(T5Tokenizer, T5Tokenizer.from_pretrained(model_id))
-
-# model_neuron = NeuronGeneration(model_cpu.config)
-# model_neuron.trace(
+# The Rust tokenizer encodes and decodes whole batches, from the tokenizer.json
+# saved with the model or converted from the SentencePiece model of model_id
+tokenizer_path = "./models" if os.path.exists("./models/tokenizer.json") else model_id
+tokenizer_cpu = cast(T5TokenizerFast, T5TokenizerFast.from_pretrained(tokenizer_path))
+
+# Buckets use NeuronCachedGeneration, which only feeds the last token to the
+# decoder at each step
+# model_neuron = NeuronBucketedGeneration.trace(
 #     model=model_cpu,
-#     num_texts=num_texts,
+#     shapes=[(1, 32), (1, 64), (1, 128), (4, 32), (4, 64)],
 #     num_beams=num_beams,
-#     max_encoder_length=max_encoder_length,
 #     max_decoder_length=max_decoder_length,
 # )
 
 # model_neuron.save_pretrained("./models")
 # tokenizer_cpu.save_pretrained("./models")
-model_neuron = NeuronGeneration.from_pretrained("./models")
 
 
+def load_neuron_model() -> NeuronBucketedGeneration:
+    start = perf_counter()
+    model_neuron = NeuronBucketedGeneration.from_pretrained(
+        "./models", single_shape=single_shape, num_beams=num_beams
+    )
+    observe_model_load("neuron", perf_counter() - start)
+    return model_neuron
+
+
+def load_model() -> Callable[[List[str]], List[List[str]]]:
+    return partial(infer, load_neuron_model(), tokenizer_cpu)
+
+
+# Replica processes import this module again, they must not load a model here
+if n_replicas > 0:
+    enable_multiprocess()
+pool = (
+    ReplicaPool(load_model, n_replicas, visible_cores_env="NEURON_RT_VISIBLE_CORES")
+    if n_replicas > 0
+    else None
+)
+if pool is None:
+    model_neuron = load_neuron_model()
+    generate: Callable[[List[str]], List[List[str]]] = partial(
+        infer, model_neuron, tokenizer_cpu
+    )
+    max_encoder_length = model_neuron.max_encoder_length
+else:
+    generate = pool
+    # The replicas load the shapes listed in the manifest
+    max_encoder_length = max(
+        length for _, length in traced_shapes("./models", single_shape)
+    )
+# Encoder budget of a prompt, long contexts are cut around the answer to fit
+# rather than truncated. Defaults to the longest loaded bucket, a smaller
+# budget keeps requests in smaller buckets.
+max_input_tokens = min(
+    int(os.environ.get("MAX_INPUT_TOKENS", max_encoder_length)), max_encoder_length
+)
+
 app = FastAPI()
+profile_lock = asyncio.Lock()
+
+
+@app.on_event("startup")
+def start_pool():
+    if pool is not None:
+        pool.start()
+
+
+@app.on_event("shutdown")
+def stop_pool():
+    if pool is not None:
+        pool.stop()
 
 
 class Question(BaseModel):
@@ -256,19 +157,66 @@ class Question(BaseModel):
 
 @app.get("/status")
 def status():
+    if pool is not None:
+        return {"status": "ok", "replicas": pool.status()}
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+def metrics():
+    body, content_type = exposition()
+    return Response(body, media_type=content_type)
+
+
+@app.post("/debug/profile")
+async def profile(
+    requests: Optional[int] = None,
+    seconds: Optional[float] = None,
+    authorization: str = Header(""),
+):
+    """
+    Profiles the next `requests` generate calls of every replica, or the next
+    `seconds`. Returns a zip of Chrome traces (torch.profiler) and folded
+    python stacks (flamegraph.pl, speedscope), one of each per process.
+    """
+    if not profile_token:
+        raise HTTPException(404)
+    if not authorized(authorization, profile_token):
+        raise HTTPException(401)
+    if not requests and not seconds:
+        raise HTTPException(400, "Set requests or seconds")
+    if profile_lock.locked():
+        raise HTTPException(409, "A profiling session is already running")
+    async with profile_lock:
+        body = await profile_processes(
+            pool, requests, min(seconds or profile_max_seconds, profile_max_seconds)
+        )
+    return Response(
+        body,
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="profile.zip"'},
+    )
+
+
 @app.post("/")
 def handler(question: Question):
-    all_results = []
-
-    for ctx_idx, context in enumerate(question.contexts):
-        for answer in question.answers[ctx_idx]:
-            res = infer(
-                model_neuron, tokenizer_cpu, f"answer: {answer} context: {context}"
-            )
-            all_results.append(res)
+    texts: List[str] = []
+
+    # The request lasts from windowing the contexts to the last question
+    with track_request():
+        with timed("window"):
+            for ctx_idx, context in enumerate(question.contexts):
+                texts.extend(
+                    windowed_prompts(
+                        tokenizer_cpu,
+                        question.answers[ctx_idx],
+                        context,
+                        max_input_tokens,
+                    )
+                )
+
+        # A single generate call per bucket sized batch of texts
+        all_results = generate(texts) if texts else []
 
     return {"results": all_results}
 
@@ -0,0 +1,704 @@
+import copy
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
+
+import torch
+from torch.nn import functional as F
+from transformers.generation_utils import GenerationMixin
+from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
+from transformers.modeling_utils import PreTrainedModel
+from transformers.models.t5.configuration_t5 import T5Config
+from transformers.models.t5.modeling_t5 import T5Attention, T5ForConditionalGeneration
+
+from metrics import observe_batch_size, timed
+
+TraceFn = Callable[[torch.nn.Module, Tuple[torch.Tensor, ...]], torch.nn.Module]
+
+
+def neuron_trace(module: torch.nn.Module, inputs: Tuple[torch.Tensor, ...]):
+    # Only available on Neuron hosts, CPU tests pass torch.jit.trace instead
+    import torch.neuron
+
+    return torch.neuron.trace(module, inputs)
+
+
+def reduce(hidden: torch.Tensor, index: int):
+    _, n_length, _ = hidden.shape
+
+    # Create selection mask
+    mask = torch.arange(n_length, dtype=torch.float32) == index
+    mask = mask.view(1, -1, 1)
+
+    # Broadcast mask
+    masked = torch.multiply(hidden, mask)
+
+    # Reduce along 1st dimension
+    summed = torch.sum(masked, 1)
+    return torch.unsqueeze(summed, 1)
+
+
+class NeuronEncoder(torch.nn.Module):
+    def __init__(self, model: T5ForConditionalGeneration):
+        super().__init__()
+        self.encoder = model.encoder
+        self.encoder.main_input_name = model.main_input_name
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        return self.encoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            return_dict=False,
+            output_hidden_states=False,
+            output_attentions=False,
+        )
+
+
+class NeuronDecoder(torch.nn.Module):
+    def __init__(self, model: T5ForConditionalGeneration, max_length: int):
+        super().__init__()
+        self.weight = cast(torch.Tensor, model.shared.weight.clone().detach())
+        self.decoder = model.decoder
+        self.max_length = max_length
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        encoder_outputs: torch.Tensor,
+        index: int,
+    ):
+        # Invoke the decoder
+        (hidden,) = self.decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_outputs,
+            return_dict=False,
+            use_cache=False,
+        )
+
+        # Reduce decoder outputs to the specified index (current iteration)
+        hidden = reduce(hidden, index)
+
+        # Compute final linear layer for token probabilities
+        logits = F.linear(hidden, self.weight)
+        return logits
+
+
+class NeuronGeneration(PreTrainedModel, GenerationMixin):
+    def trace(
+        self,
+        model: T5ForConditionalGeneration,
+        num_texts: int,
+        num_beams: int,
+        max_encoder_length: int,
+        max_decoder_length: int,
+        trace_fn: TraceFn = neuron_trace,
+    ) -> None:
+        """
+        Traces the encoder and decoder modules for use on Neuron.
+        This function fixes the network to the given sizes. Once the model has been
+        compiled to a given size, the inputs to these networks must always be of
+        fixed size.
+        Args:
+            model (GenerationMixin): The transformer-type generator model to trace
+            num_texts (int): The number of input texts to translate at once
+            num_beams (int): The number of beams to computer per text
+            max_encoder_length (int): The maximum number of encoder tokens
+            max_encoder_length (int): The maximum number of decoder tokens
+            trace_fn (TraceFn): Tracing function, torch.jit.trace to run on CPU
+        """
+        self.config.max_decoder_length = max_decoder_length
+
+        # Trace the encoder
+        inputs = (
+            torch.ones((num_texts, max_encoder_length), dtype=torch.long),
+            torch.ones((num_texts, max_encoder_length), dtype=torch.long),
+        )
+        encoder = NeuronEncoder(model)
+        self.encoder = cast(NeuronEncoder, trace_fn(encoder, inputs))
+
+        # Trace the decoder (with expanded inputs)
+        batch_size = num_texts * num_beams
+        inputs = (
+            torch.ones((batch_size, max_decoder_length), dtype=torch.long),
+            torch.ones((batch_size, max_encoder_length), dtype=torch.long),
+            torch.ones(
+                (batch_size, max_encoder_length, model.config.d_model),
+                dtype=torch.float,
+            ),
+            torch.tensor(0),
+        )
+        decoder = NeuronDecoder(model, max_decoder_length)
+        self.decoder = cast(NeuronDecoder, trace_fn(decoder, inputs))
+        self._set_input_names()
+
+    def _set_input_names(self) -> None:
+        """Names `generate` looks up on the model and its networks"""
+        self.main_input_name = "input_ids"
+        self.encoder.main_input_name = "input_ids"
+        self.decoder.main_input_name = "decoder_input_ids"
+
+    # ------------------------------------------------------------------------
+    # Encoder/Decoder Invocation
+    # ------------------------------------------------------------------------
+
+    def prepare_inputs_for_generation(
+        self,
+        input_ids: torch.Tensor,
+        encoder_outputs: BaseModelOutput,
+        attention_mask: Optional[BaseModelOutput] = None,
+        **model_kwargs: Any,
+    ):
+        # Pad the inputs for Neuron
+        current_length = input_ids.shape[1]
+        pad_size = self.config.max_decoder_length - current_length
+        return dict(
+            input_ids=F.pad(input_ids, (0, pad_size)),
+            attention_mask=attention_mask,
+            encoder_outputs=encoder_outputs.last_hidden_state,
+            current_length=torch.tensor(current_length - 1),
+        )
+
+    def get_encoder(self):
+        """Helper to invoke the encoder and wrap the results in the expected structure"""
+
+        def encode(**kwargs: Any):
+            input_ids = kwargs["input_ids"]
+            attention_mask = kwargs.get("attention_mask", torch.ones_like(input_ids))
+            with timed("encode"):
+                (output,) = self.encoder(input_ids, attention_mask)
+            return BaseModelOutput(
+                last_hidden_state=output,
+            )
+
+        return encode
+
+    def __call__(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        encoder_outputs: BaseModelOutput,
+        current_length: int,
+        **kwargs: Any,
+    ):
+        """Helper to invoke the decoder and wrap the results in the expected structure"""
+        with timed("decode_step"):
+            logits = self.decoder(
+                input_ids, attention_mask, encoder_outputs, current_length
+            )
+        return Seq2SeqLMOutput(logits=logits)
+
+    # ------------------------------------------------------------------------
+    # Serialization
+    # ------------------------------------------------------------------------
+
+    def save_pretrained(self, directory: str):
+        if os.path.isfile(directory):
+            print(f"Provided path ({directory}) should be a directory, not a file")
+            return
+        os.makedirs(directory, exist_ok=True)
+        torch.jit.save(self.encoder, os.path.join(directory, "encoder.pt"))
+        torch.jit.save(self.decoder, os.path.join(directory, "decoder.pt"))
+        self.config.save_pretrained(directory)
+
+    @classmethod
+    def from_pretrained(cls, directory: str):
+        config = T5Config.from_pretrained(directory)
+        if getattr(config, "cached_decoder", False) and cls is NeuronGeneration:
+            return NeuronCachedGeneration.from_pretrained(directory)
+        obj = cls(config)
+        obj.encoder = torch.jit.load(os.path.join(directory, "encoder.pt"))
+        obj.decoder = torch.jit.load(os.path.join(directory, "decoder.pt"))
+        obj._set_input_names()
+        return obj
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+
+# ----------------------------------------------------------------------------
+# Cached decoding
+# ----------------------------------------------------------------------------
+
+
+def split_heads(states: torch.Tensor, attention: T5Attention) -> torch.Tensor:
+    batch_size = states.shape[0]
+    states = states.view(
+        batch_size, -1, attention.n_heads, attention.key_value_proj_dim
+    )
+    return states.transpose(1, 2)
+
+
+def attend(
+    attention: T5Attention,
+    query: torch.Tensor,
+    keys: torch.Tensor,
+    values: torch.Tensor,
+    position_bias: torch.Tensor,
+) -> torch.Tensor:
+    # T5 does not scale the attention scores
+    scores = torch.matmul(query, keys.transpose(3, 2)) + position_bias
+    weights = F.softmax(scores.float(), dim=-1).type_as(scores)
+    output = torch.matmul(weights, values).transpose(1, 2)
+    return attention.o(output.reshape(output.shape[0], -1, attention.inner_dim))
+
+
+class NeuronCrossAttentionCache(torch.nn.Module):
+    """Projects the encoder outputs to the cross attention keys and values of
+    every decoder layer, stacked as (layers, 2, batch, heads, encoder_length, d_kv)
+    """
+
+    def __init__(self, model: T5ForConditionalGeneration):
+        super().__init__()
+        self.attentions = torch.nn.ModuleList(
+            [block.layer[1].EncDecAttention for block in model.decoder.block]
+        )
+
+    def forward(self, encoder_outputs: torch.Tensor):
+        return torch.stack(
+            [
+                torch.stack(
+                    [
+                        split_heads(attention.k(encoder_outputs), attention),
+                        split_heads(attention.v(encoder_outputs), attention),
+                    ]
+                )
+                for attention in self.attentions
+            ]
+        )
+
+
+class NeuronCachedDecoder(torch.nn.Module):
+    """
+    Runs a single decoding step for the token at `index`. Self attention keys
+    and values of the previous steps are carried in a fixed size tensor of shape
+    (layers, 2, batch, heads, max_length, d_kv) where the new token is written
+    at `index`, so every step has the same shapes and processes one token.
+    """
+
+    def __init__(self, model: T5ForConditionalGeneration, max_length: int):
+        super().__init__()
+        self.decoder = model.decoder
+        self.lm_head = model.lm_head
+        self.max_length = max_length
+        self.scale = (
+            model.model_dim**-0.5 if model.config.tie_word_embeddings else 1.0
+        )
+        self_attention = cast(
+            T5Attention, model.decoder.block[0].layer[0].SelfAttention
+        )
+        with torch.no_grad():
+            position_bias = self_attention.compute_bias(max_length, max_length)
+        # (heads, query position, key position)
+        self.register_buffer("position_bias", position_bias[0].detach())
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        cross_attention_cache: torch.Tensor,
+        self_attention_cache: torch.Tensor,
+        index: torch.Tensor,
+    ):
+        min_value = torch.finfo(torch.float32).min
+        positions = torch.arange(self.max_length)
+        write_mask = (positions == index).view(1, 1, -1, 1)
+
+        # Bias of the query at `index`, without the positions not decoded yet
+        causal_mask = torch.where(
+            positions <= index, torch.tensor(0.0), torch.tensor(min_value)
+        )
+        self_bias = reduce(self.position_bias, index).unsqueeze(0) + causal_mask
+        cross_bias = (1.0 - attention_mask[:, None, None, :].float()) * min_value
+
+        hidden = self.decoder.embed_tokens(input_ids)
+        layers_cache: List[torch.Tensor] = []
+        for layer_idx, block in enumerate(self.decoder.block):
+            self_attention = block.layer[0].SelfAttention
+            normed = block.layer[0].layer_norm(hidden)
+            keys = torch.where(
+                write_mask,
+                split_heads(self_attention.k(normed), self_attention),
+                self_attention_cache[layer_idx, 0],
+            )
+            values = torch.where(
+                write_mask,
+                split_heads(self_attention.v(normed), self_attention),
+                self_attention_cache[layer_idx, 1],
+            )
+            layers_cache.append(torch.stack([keys, values]))
+            query = split_heads(self_attention.q(normed), self_attention)
+            hidden = hidden + attend(self_attention, query, keys, values, self_bias)
+
+            cross_attention = block.layer[1].EncDecAttention
+            normed = block.layer[1].layer_norm(hidden)
+            query = split_heads(cross_attention.q(normed), cross_attention)
+            hidden = hidden + attend(
+                cross_attention,
+                query,
+                cross_attention_cache[layer_idx, 0],
+                cross_attention_cache[layer_idx, 1],
+                cross_bias,
+            )
+
+            hidden = block.layer[2](hidden)
+
+        hidden = self.decoder.final_layer_norm(hidden) * self.scale
+        logits = self.lm_head(hidden)
+        return logits, torch.stack(layers_cache)
+
+
+class NeuronCachedGeneration(NeuronGeneration):
+    def trace(
+        self,
+        model: T5ForConditionalGeneration,
+        num_texts: int,
+        num_beams: int,
+        max_encoder_length: int,
+        max_decoder_length: int,
+        trace_fn: TraceFn = neuron_trace,
+    ) -> None:
+        """
+        Same as `NeuronGeneration.trace` but the decoder only processes the last
+        generated token at each step, attending over cached keys and values.
+        Produces three networks: the encoder, the cross attention projection
+        (run once per generation) and the cached decoder step.
+        """
+        self.config.max_decoder_length = max_decoder_length
+        self.config.cached_decoder = True
+
+        inputs = (
+            torch.ones((num_texts, max_encoder_length), dtype=torch.long),
+            torch.ones((num_texts, max_encoder_length), dtype=torch.long),
+        )
+        encoder = NeuronEncoder(model)
+        self.encoder = cast(NeuronEncoder, trace_fn(encoder, inputs))
+
+        batch_size = num_texts * num_beams
+        encoder_outputs = torch.ones(
+            (batch_size, max_encoder_length, model.config.d_model), dtype=torch.float
+        )
+        cross_attention = NeuronCrossAttentionCache(model)
+        self.cross_attention = cast(
+            NeuronCrossAttentionCache, trace_fn(cross_attention, (encoder_outputs,))
+        )
+
+        inputs = (
+            torch.ones((batch_size, 1), dtype=torch.long),
+            torch.ones((batch_size, max_encoder_length), dtype=torch.long),
+            cross_attention(encoder_outputs),
+            self._empty_cache(batch_size),
+            torch.tensor(0),
+        )
+        decoder = NeuronCachedDecoder(model, max_decoder_length)
+        self.decoder = cast(NeuronCachedDecoder, trace_fn(decoder, inputs))
+        self._set_input_names()
+
+    def _empty_cache(self, batch_size: int) -> torch.Tensor:
+        return torch.zeros(
+            (
+                self.config.num_decoder_layers,
+                2,
+                batch_size,
+                self.config.num_heads,
+                self.config.max_decoder_length,
+                self.config.d_kv,
+            )
+        )
+
+    def prepare_inputs_for_generation(
+        self,
+        input_ids: torch.Tensor,
+        encoder_outputs: BaseModelOutput,
+        attention_mask: Optional[torch.Tensor] = None,
+        past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        **model_kwargs: Any,
+    ):
+        encoder_hidden_states = cast(torch.Tensor, encoder_outputs.last_hidden_state)
+        if attention_mask is None:
+            attention_mask = torch.ones(
+                encoder_hidden_states.shape[:2], dtype=torch.long
+            )
+        past = past or model_kwargs.get("past_key_values")
+        if past is None:
+            # First step, project the encoder outputs once for all the steps
+            past = (
+                self._empty_cache(input_ids.shape[0]),
+                self.cross_attention(encoder_hidden_states),
+            )
+        return dict(
+            input_ids=input_ids[:, -1:],
+            attention_mask=attention_mask,
+            encoder_outputs=encoder_outputs,
+            past=past,
+            current_length=torch.tensor(input_ids.shape[1] - 1),
+        )
+
+    def __call__(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        encoder_outputs: BaseModelOutput,
+        past: Tuple[torch.Tensor, torch.Tensor],
+        current_length: torch.Tensor,
+        **kwargs: Any,
+    ):
+        self_attention_cache, cross_attention_cache = past
+        with timed("decode_step"):
+            logits, self_attention_cache = self.decoder(
+                input_ids,
+                attention_mask,
+                cross_attention_cache,
+                self_attention_cache,
+                current_length,
+            )
+        return Seq2SeqLMOutput(
+            logits=logits, past_key_values=(self_attention_cache, cross_attention_cache)
+        )
+
+    def _reorder_cache(
+        self, past: Tuple[torch.Tensor, torch.Tensor], beam_idx: torch.Tensor
+    ):
+        self_attention_cache, cross_attention_cache = past
+        # Beams are only reordered within a text, they all share the same
+        # cross attention keys and values
+        return self_attention_cache.index_select(2, beam_idx), cross_attention_cache
+
+    def save_pretrained(self, directory: str):
+        super().save_pretrained(directory)
+        if os.path.isdir(directory):
+            torch.jit.save(
+                self.cross_attention, os.path.join(directory, "cross_attention.pt")
+            )
+
+    @classmethod
+    def from_pretrained(cls, directory: str):
+        obj = super().from_pretrained(directory)
+        obj.cross_attention = torch.jit.load(
+            os.path.join(directory, "cross_attention.pt")
+        )
+        return obj
+
+
+# ----------------------------------------------------------------------------
+# Shape buckets
+# ----------------------------------------------------------------------------
+
+BUCKETS_MANIFEST = "buckets.json"
+
+
+def read_manifest(directory: str) -> Dict[str, Any]:
+    with open(os.path.join(directory, BUCKETS_MANIFEST)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def traced_shapes(
+    directory: str, single_shape: Optional[Tuple[int, int]] = None
+) -> List[Tuple[int, int]]:
+    """
+    Shapes `NeuronBucketedGeneration.from_pretrained` would load from
+    `directory`, without loading the models
+    """
+    if not os.path.exists(os.path.join(directory, BUCKETS_MANIFEST)):
+        if single_shape is None:
+            raise FileNotFoundError(f"No {BUCKETS_MANIFEST} in {directory}")
+        return [single_shape]
+    return [
+        (bucket["num_texts"], bucket["max_encoder_length"])
+        for bucket in read_manifest(directory)["buckets"]
+    ]
+
+
+class NeuronBucketedGeneration:
+    """
+    Set of generators compiled for several (num_texts, max_encoder_length)
+    shapes. Texts are grouped by length and each group is dispatched to the
+    smallest bucket fitting it, padded to its shape, so short inputs stay cheap
+    and long ones do not need to be truncated to a single small shape.
+    """
+
+    def __init__(
+        self, buckets: Dict[Tuple[int, int], NeuronGeneration], num_beams: int
+    ) -> None:
+        self.buckets = buckets
+        self.num_beams = num_beams
+        self.pad_token_id: int = next(iter(buckets.values())).config.pad_token_id
+
+    @property
+    def max_encoder_length(self) -> int:
+        return max(max_encoder_length for _, max_encoder_length in self.buckets)
+
+    @classmethod
+    def trace(
+        cls,
+        model: T5ForConditionalGeneration,
+        shapes: List[Tuple[int, int]],
+        num_beams: int,
+        max_decoder_length: int,
+        cached_decoder: bool = True,
+        trace_fn: TraceFn = neuron_trace,
+    ) -> "NeuronBucketedGeneration":
+        """
+        Traces one generator per shape.
+        Args:
+            model (T5ForConditionalGeneration): The model to trace
+            shapes (list[tuple[int, int]]): (num_texts, max_encoder_length) buckets
+            num_beams (int): The number of beams to computer per text
+            max_decoder_length (int): The maximum number of decoder tokens
+            cached_decoder (bool): Trace NeuronCachedGeneration buckets
+            trace_fn (TraceFn): Tracing function, torch.jit.trace to run on CPU
+        """
+        generation_cls = NeuronCachedGeneration if cached_decoder else NeuronGeneration
+        buckets: Dict[Tuple[int, int], NeuronGeneration] = {}
+        for num_texts, max_encoder_length in sorted(set(shapes)):
+            generation = generation_cls(copy.deepcopy(model.config))
+            generation.trace(
+                model,
+                num_texts=num_texts,
+                num_beams=num_beams,
+                max_encoder_length=max_encoder_length,
+                max_decoder_length=max_decoder_length,
+                trace_fn=trace_fn,
+            )
+            buckets[(num_texts, max_encoder_length)] = generation
+        return cls(buckets, num_beams)
+
+    def select_bucket(self, num_texts: int, length: int) -> Tuple[int, int]:
+        fitting = [
+            (bucket_texts * bucket_length, bucket_length, bucket_texts)
+            for bucket_texts, bucket_length in self.buckets
+            if bucket_texts >= num_texts and bucket_length >= length
+        ]
+        if not fitting:
+            raise ValueError(
+                f"No bucket fits {num_texts} texts of {length} tokens, "
+                f"available buckets are {sorted(self.buckets)}"
+            )
+        _, bucket_length, bucket_texts = min(fitting)
+        return bucket_texts, bucket_length
+
+    def _pad_to_bucket(
+        self, tensor: torch.Tensor, bucket: Tuple[int, int], value: int
+    ) -> torch.Tensor:
+        num_texts, max_encoder_length = bucket
+        tensor = F.pad(tensor, (0, max_encoder_length - tensor.shape[1]), value=value)
+        # Fill the missing texts with copies of the last one, dropped afterwards
+        missing_texts = num_texts - tensor.shape[0]
+        return torch.cat([tensor, tensor[-1:].expand(missing_texts, -1)])
+
+    def generate(
+        self,
+        inputs: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        **generate_kwargs: Any,
+    ) -> torch.Tensor:
+        if attention_mask is None:
+            attention_mask = torch.ones_like(inputs)
+
+        # Longest texts first, each chunk is then filled with the texts that fit
+        # the bucket length of its first one
+        lengths = attention_mask.sum(1)
+        order = torch.argsort(lengths, descending=True).tolist()
+        text_outputs: List[torch.Tensor] = [torch.empty(0)] * inputs.shape[0]
+
+        start = 0
+        while start < len(order):
+            # Inputs are right padded, drop the padding the bucket does not need
+            length = int(lengths[order[start]])
+            max_num_texts = max(
+                (
+                    num_texts
+                    for num_texts, bucket_length in self.buckets
+                    if bucket_length >= length
+                ),
+                default=0,
+            )
+            if max_num_texts == 0:
+                raise ValueError(
+                    f"Inputs of {length} tokens are longer than the largest bucket "
+                    f"({self.max_encoder_length} tokens)"
+                )
+
+            chunk = order[start : start + max_num_texts]
+            start += len(chunk)
+            bucket = self.select_bucket(len(chunk), length)
+            observe_batch_size(len(chunk))
+            output = self.buckets[bucket].generate(
+                inputs=self._pad_to_bucket(
+                    inputs[chunk, :length], bucket, self.pad_token_id
+                ),
+                attention_mask=self._pad_to_bucket(
+                    attention_mask[chunk, :length], bucket, 0
+                ),
+                **generate_kwargs,
+            )
+            sequences_per_text = output.shape[0] // bucket[0]
+            for chunk_idx, text_idx in enumerate(chunk):
+                text_outputs[text_idx] = output[
+                    chunk_idx
+                    * sequences_per_text : (chunk_idx + 1)
+                    * sequences_per_text
+                ]
+
+        output_length = max(output.shape[1] for output in text_outputs)
+        return torch.cat(
+            [
+                F.pad(
+                    output,
+                    (0, output_length - output.shape[1]),
+                    value=self.pad_token_id,
+                )
+                for output in text_outputs
+            ]
+        )
+
+    def save_pretrained(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        manifest: Dict[str, Any] = {"num_beams": self.num_beams, "buckets": []}
+        for (num_texts, max_encoder_length), generation in self.buckets.items():
+            bucket_directory = f"{num_texts}x{max_encoder_length}"
+            generation.save_pretrained(os.path.join(directory, bucket_directory))
+            manifest["buckets"].append(
+                {
+                    "num_texts": num_texts,
+                    "max_encoder_length": max_encoder_length,
+                    "directory": bucket_directory,
+                }
+            )
+        with open(os.path.join(directory, BUCKETS_MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        directory: str,
+        single_shape: Optional[Tuple[int, int]] = None,
+        num_beams: int = 1,
+    ) -> "NeuronBucketedGeneration":
+        """
+        Loads the buckets saved by `save_pretrained`. A directory without a
+        manifest holding a single NeuronGeneration (traced before buckets) is
+        loaded as one bucket of shape `single_shape`, (num_texts,
+        max_encoder_length), when it is given.
+        """
+        if not os.path.exists(os.path.join(directory, BUCKETS_MANIFEST)):
+            if single_shape is None:
+                raise FileNotFoundError(
+                    f"No {BUCKETS_MANIFEST} in {directory}, trace the buckets with "
+                    "NeuronBucketedGeneration.trace and save them"
+                )
+            print("SINGLE SHAPE MODEL", directory, single_shape)
+            generation = NeuronGeneration.from_pretrained(directory)
+            return cls({single_shape: generation}, num_beams)
+        manifest = read_manifest(directory)
+        buckets = {
+            (
+                bucket["num_texts"],
+                bucket["max_encoder_length"],
+            ): NeuronGeneration.from_pretrained(
+                os.path.join(directory, bucket["directory"])
+            )
+            for bucket in manifest["buckets"]
+        }
+        return cls(buckets, manifest["num_beams"])
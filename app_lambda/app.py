@@ -1,101 +1,78 @@
 import json
+import os
 from pathlib import Path
-from typing import Any, Literal
 
-from torch.cuda import is_available as gpu_available
-from transformers import (AutoModelForSeq2SeqLM, AutoTokenizer,
-                          Text2TextGenerationPipeline)
-from transformers.modeling_utils import PreTrainedModel
-from transformers.models.auto.tokenization_auto import AutoTokenizer
-from transformers.tokenization_utils import PreTrainedTokenizer
-
-Text2TextPipelineOutput = list[list[dict[Literal["generated_text"], str]]]
-
-DEFAULT_GENERATOR_OPTIONS = {
-    "max_length": 128,
-    "min_length": 2,
-    "early_stopping": True,
-    "num_beams": 1,
-    "batch_size": 16,
-    "temperature": 1.0,
-    "num_return_sequences": 1,
-    "top_k": 0,
-    "top_p": 0.92,
-    "repetition_penalty": 2.0,
-    "length_penalty": 1.0,
-}
-
-
-class MultipleText2TextGenerationPipeline(Text2TextGenerationPipeline):
-    def __call__(self, *args: list[Any], **kwargs: Any):
-        result: Text2TextPipelineOutput = super(
-            Text2TextGenerationPipeline, self
-        ).__call__(*args, **kwargs)
-        flatten_results: list[str] = []
-        for result_list in result:
-            for result_dict in result_list:
-                flatten_results.append(
-                    result_dict["generated_text"].replace("question: ", "")
-                )
-        return flatten_results
-
-
-class T5QuestionGenerator:
-    def __init__(self) -> None:
-        self.tokenizer: PreTrainedTokenizer
-        self.model: PreTrainedModel
-        self.weights_cache_folder = Path(__file__).parent.joinpath("models")
-        self.model_checkpoint = "mrm8488/t5-base-finetuned-question-generation-ap"
-
-    def load(self):
-        model = AutoModelForSeq2SeqLM.from_pretrained(self.weights_cache_folder)
-        tokenizer = AutoTokenizer.from_pretrained(self.weights_cache_folder)
-
-        # tokenizer.save_pretrained(self.weights_cache_folder)
-        # model.save_pretrained(self.weights_cache_folder)
-        
-        self.pipeline = MultipleText2TextGenerationPipeline(
-            model=model, tokenizer=tokenizer,device=0 if gpu_available() else -1
-        )
-
-    def __call__(
-        self, answers: list[list[str]], contexts: list[str]
-    ) -> list[list[str]]:
-        input_texts: list[str] = []
-        answer_mapping: list[int] = []
-        generated_questions: list[list[str]] = []
-
-        for ctx_idx, ctx in enumerate(contexts):
-            generated_questions.append([])
-            for a in answers[ctx_idx]:
-                input_texts.append(f"answer: {a} context: {ctx}")
-                answer_mapping.append(ctx_idx)
-
-        output_texts: list[str] = self.pipeline(
-            input_texts, **DEFAULT_GENERATOR_OPTIONS
-        )
-
-        n_inputs_texts = len(input_texts)
-        step = DEFAULT_GENERATOR_OPTIONS["num_return_sequences"]
-        for input_text_idx in range(n_inputs_texts):
-            question_batch_start = input_text_idx * step
-            question_batch_end = question_batch_start + step
-            question_batch = output_texts[question_batch_start:question_batch_end]
-
-            fact_idx = answer_mapping[input_text_idx]
-            generated_questions[fact_idx].extend(question_batch)
-
-        return generated_questions
-
-
-model = T5QuestionGenerator()
-model.load()
+from pydantic import ValidationError
+
+from question_generation import GenerationCache, StartupProfiler, T5QuestionGenerator
+from question_generation.profiling import start_profile
+from question_generation.schema import Question
+from question_generation.sqs_batch import handle_sqs_batch, is_sqs_event, make_sink
+
+profiler = StartupProfiler()
+
+# Generated questions are cached per prompt and generator options, set
+# GENERATION_CACHE_PATH to also keep them in a sqlite file across restarts.
+GENERATION_CACHE_SIZE = int(os.environ.get("GENERATION_CACHE_SIZE", 4096))
+GENERATION_CACHE_TTL = float(os.environ.get("GENERATION_CACHE_TTL", 24 * 3600))
+GENERATION_CACHE_PATH = os.environ.get("GENERATION_CACHE_PATH")
+
+# Defers torch / transformers imports and the model load to the first request,
+# the init phase then only runs this module.
+LAZY_LOAD = os.environ.get("LAZY_LOAD", "0") == "1"
+
+# Engine serving the model ("torch", "torchscript", ...), "auto" picks the
+# fastest one on this host. Fixed by default: the image is read only, a
+# calibration could not be recorded and would rerun on every cold start.
+ENGINE = os.environ.get("ENGINE", "torch")
+
+# Encoder budget of a prompt, long contexts are cut around the answer to fit
+MAX_INPUT_TOKENS = int(os.environ.get("MAX_INPUT_TOKENS", 512))
+
+# Where questions generated from SQS records are written: s3://bucket/prefix,
+# an SQS queue url, or nothing to log them.
+RESULT_SINK = os.environ.get("RESULT_SINK", "")
+
+# Profiles the first PROFILE_REQUESTS generator calls of each execution
+# environment, their Chrome traces and python stacks are written to
+# PROFILE_DIRECTORY.
+PROFILE_REQUESTS = int(os.environ.get("PROFILE_REQUESTS", 0))
+PROFILE_DIRECTORY = os.environ.get("PROFILE_DIRECTORY", "/tmp/profile")
+
+
+model = T5QuestionGenerator(
+    Path(__file__).parent.joinpath("models"),
+    engine=ENGINE,
+    max_input_tokens=MAX_INPUT_TOKENS,
+    cache=GenerationCache(
+        max_entries=GENERATION_CACHE_SIZE,
+        ttl_seconds=GENERATION_CACHE_TTL,
+        disk_path=GENERATION_CACHE_PATH,
+    ),
+    profiler=profiler,
+)
+if not LAZY_LOAD:
+    model.load()
+sink = make_sink(RESULT_SINK)
+if PROFILE_REQUESTS > 0:
+    start_profile(Path(PROFILE_DIRECTORY), requests=PROFILE_REQUESTS)
 
 
 def handler(event, context):
     print("EVENT", event)
-    payload = json.loads(event["body"])
-    res = model(payload["answers"], payload["contexts"])
+    if model.pipeline is None:
+        model.load()
+    if is_sqs_event(event):
+        return handle_sqs_batch(event, model, sink)
+    try:
+        question = Question.parse_raw(event["body"])
+    except ValidationError as error:
+        return {
+            "statusCode": 400,
+            "body": error.json(),
+            "headers": {"Content-Type": "application/json"},
+        }
+    res = model(question.answers, question.contexts, **question.parameters.options())
     return {
         "statusCode": 200,
         "body": json.dumps(res),
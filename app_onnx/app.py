@@ -2,167 +2,427 @@ import json
 import os
 import platform
 import shutil
-import subprocess
 from pathlib import Path
-from typing import Any, Literal
-
-from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
-from optimum.onnxruntime.configuration import AutoQuantizationConfig, QuantizationConfig
-from transformers import (
-    AutoModelForSeq2SeqLM,
-    AutoTokenizer,
-    Text2TextGenerationPipeline,
+from typing import TYPE_CHECKING, Any, Optional
+
+from pydantic import ValidationError
+
+from question_generation import GenerationCache, StartupProfiler, T5QuestionGenerator
+from question_generation.build_cache import (
+    build_info,
+    cpu_flags,
+    fingerprint,
+    isa_target,
+    read_build_info,
+    register_variant,
+    resolve_revision,
+    write_build_info,
 )
-from transformers.modeling_utils import PreTrainedModel
-from transformers.models.auto.tokenization_auto import AutoTokenizer
-from transformers.tokenization_utils import PreTrainedTokenizer
-
-Text2TextPipelineOutput = list[list[dict[Literal["generated_text"], str]]]
-
-DEFAULT_GENERATOR_OPTIONS = {
-    "max_length": 128,
-    "min_length": 2,
-    "early_stopping": True,
-    "num_beams": 1,
-    "batch_size": 16,
-    "temperature": 1.0,
-    "num_return_sequences": 1,
-    "top_k": 0,
-    "top_p": 0.92,
-    "repetition_penalty": 2.0,
-    "length_penalty": 1.0,
-}
-
-
-class MultipleText2TextGenerationPipeline(Text2TextGenerationPipeline):
-    def __call__(self, *args: list[Any], **kwargs: Any):
-        result: Text2TextPipelineOutput = super(
-            Text2TextGenerationPipeline, self
-        ).__call__(*args, **kwargs)
-        flatten_results: list[str] = []
-        for result_list in result:
-            for result_dict in result_list:
-                flatten_results.append(
-                    result_dict["generated_text"].replace("question: ", "")
-                )
-        return flatten_results
+from question_generation.calibration import benchmark, token_f1
+from question_generation.engines import ONNX_FP32_DIRECTORY, OnnxEngine, OnnxInt8Engine
+from question_generation.generator import (
+    DEFAULT_GENERATOR_OPTIONS,
+    MODEL_CHECKPOINT,
+    prompt,
+)
+from question_generation.profiling import start_profile
+from question_generation.schema import Question
+from question_generation.sqs_batch import handle_sqs_batch, is_sqs_event, make_sink
+
+if TYPE_CHECKING:
+    from datasets import Dataset
+    from optimum.onnxruntime.configuration import QuantizationConfig
+    from transformers.tokenization_utils import PreTrainedTokenizer
+
+profiler = StartupProfiler()
+
+Payload = tuple[list[list[str]], list[str]]
+
+# Generated questions are cached per prompt and generator options, set
+# GENERATION_CACHE_PATH to also keep them in a sqlite file across restarts.
+GENERATION_CACHE_SIZE = int(os.environ.get("GENERATION_CACHE_SIZE", 4096))
+GENERATION_CACHE_TTL = float(os.environ.get("GENERATION_CACHE_TTL", 24 * 3600))
+GENERATION_CACHE_PATH = os.environ.get("GENERATION_CACHE_PATH")
+
+# Defers onnxruntime / transformers imports and the model load to the first
+# request, the init phase then only runs this module.
+LAZY_LOAD = os.environ.get("LAZY_LOAD", "0") == "1"
+
+# Engine serving the model ("onnx-int8", "onnx-fp32", ...), "auto" picks the
+# fastest one on this host. Fixed by default: the image is read only, a
+# calibration could not be recorded and would rerun on every cold start.
+ENGINE = os.environ.get("ENGINE", "onnx-int8")
+
+# Encoder budget of a prompt, long contexts are cut around the answer to fit
+MAX_INPUT_TOKENS = int(os.environ.get("MAX_INPUT_TOKENS", 512))
+
+# Where questions generated from SQS records are written: s3://bucket/prefix,
+# an SQS queue url, or nothing to log them.
+RESULT_SINK = os.environ.get("RESULT_SINK", "")
+
+# Profiles the first PROFILE_REQUESTS generator calls of each execution
+# environment, their Chrome traces and python stacks are written to
+# PROFILE_DIRECTORY.
+PROFILE_REQUESTS = int(os.environ.get("PROFILE_REQUESTS", 0))
+PROFILE_DIRECTORY = os.environ.get("PROFILE_DIRECTORY", "/tmp/profile")
 
+# Representative (answers, contexts) payloads used to pick the session options
+TUNING_PAYLOADS: list[Payload] = [
+    ([["CEO"]], ["Sylvain is the CEO of Botpress."]),
+    (
+        [["Montreal", "2016"], ["open source"]],
+        [
+            "Botpress was founded in Montreal in 2016 and builds tools to create "
+            "conversational assistants.",
+            "The platform is open source and developers can extend it with their "
+            "own modules, integrations and natural language understanding models.",
+        ],
+    ),
+]
 
-class T5QuestionGenerator:
-    def __init__(self) -> None:
-        self.tokenizer: PreTrainedTokenizer
-        self.model: PreTrainedModel
-        self.weights_cache_folder = Path(__file__).parent.joinpath("models")
+
+# Static quantization calibrates on prompts padded to this length
+CALIBRATION_MAX_LENGTH = 128
+
+
+def payloads_to_texts(payloads: list[Payload]) -> list[str]:
+    return [
+        prompt(a, ctx)
+        for answers, contexts in payloads
+        for ctx_idx, ctx in enumerate(contexts)
+        for a in answers[ctx_idx]
+    ]
+
+
+def read_payloads(path: Path) -> list[Payload]:
+    """Reads a json lines file of {"answers": ..., "contexts": ...} payloads"""
+    payloads: list[Payload] = []
+    for line in path.read_text().splitlines():
+        if line.strip():
+            payload = json.loads(line)
+            payloads.append((payload["answers"], payload["contexts"]))
+    return payloads
+
+
+class OnnxModelBuilder:
+    """
+    Exports, quantizes and tunes the onnx models of the weights folder, which
+    the onnx engines of question_generation serve.
+    """
+
+    def __init__(self, weights_cache_folder: Path) -> None:
+        self.weights_cache_folder = weights_cache_folder
         self.cache_dir = Path(__file__).parent.joinpath("cache")
-        self.model_checkpoint = "mrm8488/t5-base-finetuned-question-generation-ap"
+        self.model_checkpoint = MODEL_CHECKPOINT
+        self.model_revision = "main"
+
+    def _quantization_config(
+        self, target: str, is_static: bool
+    ) -> "QuantizationConfig":
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+        return getattr(AutoQuantizationConfig, target)(
+            is_static=is_static, per_channel=True
+        )
 
-    def _get_quantization_arch(self) -> QuantizationConfig:
+    def host_target(self) -> str:
         if platform.system().lower() != "linux":
             raise RuntimeError("Onnx quantization is only supported on Linux for now")
+        return isa_target(cpu_flags())
 
-        if shutil.which("lscpu", mode=os.X_OK) is None:
-            raise RuntimeError("lscpu command was not found")
+    def _calibration_dataset(
+        self, tokenizer: "PreTrainedTokenizer", payloads: list[Payload]
+    ) -> "Dataset":
+        from datasets import Dataset
 
-        cpu_output = subprocess.run("lscpu", capture_output=True)
-        cpu_infos = cpu_output.stdout.decode("utf-8")
-        quantization_config = AutoQuantizationConfig.arm64(
-            is_static=False, per_channel=True
+        encodings = tokenizer(
+            payloads_to_texts(payloads),
+            max_length=CALIBRATION_MAX_LENGTH,
+            truncation=True,
+            padding="max_length",
+        )
+        return Dataset.from_dict(
+            {
+                "input_ids": encodings["input_ids"],
+                "attention_mask": encodings["attention_mask"],
+            }
         )
 
-        if "avx2" in cpu_infos:
-            quantization_config = AutoQuantizationConfig.avx2(
-                is_static=False, per_channel=True
-            )
-        if "avx512" in cpu_infos:
-            quantization_config = AutoQuantizationConfig.avx512(
-                is_static=False, per_channel=True
-            )
-        if "vnni" in cpu_infos:
-            quantization_config = AutoQuantizationConfig.avx512_vnni(
-                is_static=False, per_channel=True
-            )
-        return quantization_config
+    def _export(self) -> Path:
+        """Exports the checkpoint to onnx, once per checkpoint revision"""
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        from transformers.models.auto.tokenization_auto import AutoTokenizer
 
-    def optimize(self):
-        onnx_save_directory = self.cache_dir.joinpath("onnx")
-        file_name = "model.onnx"
-        quantized_file_name = "model_quantized.onnx"
-        onnx_quantized_model_path = onnx_save_directory.joinpath(quantized_file_name)
-        onnx_model_path = onnx_save_directory.joinpath(file_name)
-        feature = "seq2seq-lm"
+        exports_directory = self.cache_dir.joinpath("onnx")
+        info = build_info(
+            checkpoint=self.model_checkpoint,
+            revision=resolve_revision(
+                self.model_checkpoint, self.model_revision, exports_directory
+            ),
+        )
+        onnx_save_directory = exports_directory.joinpath(info["key"])
+        if read_build_info(onnx_save_directory) == info:
+            return onnx_save_directory
 
         tokenizer = AutoTokenizer.from_pretrained(
-            self.model_checkpoint, cache_dir=self.cache_dir
+            self.model_checkpoint,
+            revision=info["revision"],
+            cache_dir=self.cache_dir,
         )
         model = ORTModelForSeq2SeqLM.from_pretrained(
-            self.model_checkpoint, from_transformers=True, cache_dir=self.cache_dir
+            self.model_checkpoint,
+            revision=info["revision"],
+            from_transformers=True,
+            cache_dir=self.cache_dir,
         )
-
-        model.save_pretrained(onnx_save_directory, file_name=file_name)
+        model.save_pretrained(onnx_save_directory, file_name="model.onnx")
         tokenizer.save_pretrained(onnx_save_directory)
-        del model
+        write_build_info(onnx_save_directory, info)
+        return onnx_save_directory
+
+    def _build(
+        self, target: str, calibration_payloads: Optional[list[Payload]] = None
+    ) -> Path:
+        """
+        Quantizes the onnx export for the `target` instruction set into
+        cache/builds/<key>, skipped when that build already exists. Activations
+        are quantized statically with ranges calibrated on `calibration_payloads`
+        when given, dynamically at every call otherwise.
+        """
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoCalibrationConfig
+        from transformers.models.auto.modeling_auto import AutoModelForSeq2SeqLM
+        from transformers.models.auto.tokenization_auto import AutoTokenizer
 
-        quantizer = ORTQuantizer.from_pretrained(self.model_checkpoint, feature=feature)
+        is_static = calibration_payloads is not None
+        onnx_save_directory = self._export()
+        revision = read_build_info(onnx_save_directory)["revision"]
+        info = build_info(
+            export=read_build_info(onnx_save_directory)["key"],
+            target=target,
+            is_static=is_static,
+            calibration=(
+                fingerprint(payloads_to_texts(calibration_payloads))
+                if calibration_payloads is not None
+                else None
+            ),
+        )
+        output_directory = self.cache_dir.joinpath("builds", info["key"])
+        if read_build_info(output_directory) == info:
+            print("ONNX BUILD CACHED", output_directory)
+            return output_directory
+
+        onnx_model_path = onnx_save_directory.joinpath("model.onnx")
+        onnx_quantized_model_path = onnx_save_directory.joinpath(
+            "model_static_quantized.onnx" if is_static else "model_quantized.onnx"
+        )
+        tokenizer = AutoTokenizer.from_pretrained(onnx_save_directory)
+        quantization_config = self._quantization_config(target, is_static)
+        # The revision of the export, ORTQuantizer.from_pretrained has no revision
+        quantizer = ORTQuantizer(
+            tokenizer,
+            AutoModelForSeq2SeqLM.from_pretrained(
+                self.model_checkpoint, revision=revision, cache_dir=self.cache_dir
+            ),
+            feature="seq2seq-lm",
+        )
+        calibration_tensors_range = None
+        if calibration_payloads is not None:
+            calibration_dataset = self._calibration_dataset(
+                tokenizer, calibration_payloads
+            )
+            calibration_tensors_range = quantizer.fit(
+                dataset=calibration_dataset,
+                calibration_config=AutoCalibrationConfig.minmax(calibration_dataset),
+                onnx_model_path=onnx_model_path,
+                operators_to_quantize=quantization_config.operators_to_quantize,
+            )
         quantizer.export(
             onnx_model_path=onnx_model_path,
             onnx_quantized_model_output_path=onnx_quantized_model_path,
-            quantization_config=self._get_quantization_arch(),
+            quantization_config=quantization_config,
+            calibration_tensors_range=calibration_tensors_range,
         )
         del quantizer
 
         model = ORTModelForSeq2SeqLM.from_pretrained(onnx_quantized_model_path.parent)
-        model.save_pretrained(self.weights_cache_folder)
-        tokenizer.save_pretrained(self.weights_cache_folder)
+        model.save_pretrained(output_directory)
+        tokenizer.save_pretrained(output_directory)
+        write_build_info(output_directory, info)
 
         del model
         del tokenizer
+        return output_directory
 
-    def load(self):
-        tokenizer = AutoTokenizer.from_pretrained(self.weights_cache_folder)
-        model = ORTModelForSeq2SeqLM.from_pretrained(self.weights_cache_folder)
-        self.pipeline = MultipleText2TextGenerationPipeline(
-            model=model, tokenizer=tokenizer
-        )
+    def optimize(
+        self,
+        calibration_payloads: Optional[list[Payload]] = None,
+        targets: Optional[list[str]] = None,
+        fp32: bool = False,
+    ) -> list[Path]:
+        """
+        Builds a quantized variant of the model for each instruction set in
+        `targets` (this host's by default) and installs it in the weights folder,
+        where the onnx-int8 engine picks the best one for the host it runs on.
+        With `fp32`, the export itself is installed too for the onnx-fp32 engine.
+        Builds are cached, so running it again with the same inputs does nothing.
+        """
+        variant_directories: list[Path] = []
+        if fp32:
+            export_directory = self._export()
+            fp32_directory = self.weights_cache_folder.joinpath(ONNX_FP32_DIRECTORY)
+            if read_build_info(fp32_directory) != read_build_info(export_directory):
+                shutil.rmtree(fp32_directory, ignore_errors=True)
+                shutil.copytree(export_directory, fp32_directory)
+            variant_directories.append(fp32_directory)
+        for target in targets or [self.host_target()]:
+            build_directory = self._build(target, calibration_payloads)
+            info = read_build_info(build_directory)
+            variant = target if calibration_payloads is None else f"{target}-static"
+            variant_directory = self.weights_cache_folder.joinpath(variant)
+            if read_build_info(variant_directory) != info:
+                shutil.rmtree(variant_directory, ignore_errors=True)
+                shutil.copytree(build_directory, variant_directory)
+            register_variant(self.weights_cache_folder, variant, info["key"])
+            variant_directories.append(variant_directory)
+        return variant_directories
 
-    def __call__(
-        self, answers: list[list[str]], contexts: list[str]
-    ) -> list[list[str]]:
-        input_texts: list[str] = []
-        answer_mapping: list[int] = []
-        generated_questions: list[list[str]] = []
-
-        for ctx_idx, ctx in enumerate(contexts):
-            generated_questions.append([])
-            for a in answers[ctx_idx]:
-                input_texts.append(f"answer: {a} context: {ctx}")
-                answer_mapping.append(ctx_idx)
-
-        output_texts: list[str] = self.pipeline(
-            input_texts, **DEFAULT_GENERATOR_OPTIONS
+    def quantization_report(
+        self, calibration_payloads: list[Payload], held_out_payloads: list[Payload]
+    ) -> dict[str, Any]:
+        """
+        Builds dynamically and statically quantized models and compares them to
+        the fp32 export on `held_out_payloads`. Accuracy is measured against the
+        fp32 questions (exact match rate and token F1).
+        """
+        target = self.host_target()
+        variants = {
+            "fp32": OnnxEngine(self._export()),
+            "dynamic": OnnxInt8Engine(self._build(target)),
+            "static": OnnxInt8Engine(self._build(target, calibration_payloads)),
+        }
+
+        outputs: dict[str, list[str]] = {}
+        report: dict[str, Any] = {}
+        for variant, engine in variants.items():
+            # Without a cache, every call reaches the model
+            generator = T5QuestionGenerator(engine.model_directory)
+            generator.load(engine)
+
+            outputs[variant] = []
+            latencies: list[float] = []
+            for answers, contexts in held_out_payloads:
+                latencies.append(benchmark(lambda: generator(answers, contexts), 1))
+                outputs[variant].extend(
+                    question
+                    for questions in generator(answers, contexts)
+                    for question in questions
+                )
+            report[variant] = {
+                "latency_p50": sorted(latencies)[len(latencies) // 2],
+                "latency_mean": sum(latencies) / len(latencies),
+            }
+
+        for variant, questions in outputs.items():
+            pairs = list(zip(outputs["fp32"], questions))
+            n_pairs = len(pairs)
+            report[variant]["exact_match"] = sum(a == b for a, b in pairs) / n_pairs
+            report[variant]["token_f1"] = (
+                sum(token_f1(a, b) for a, b in pairs) / n_pairs
+            )
+
+        report_path = self.cache_dir.joinpath("quantization_report.json")
+        report_path.write_text(json.dumps(report, indent=2))
+        print("QUANTIZATION REPORT", json.dumps(report, indent=2))
+        return report
+
+    def tune_session(
+        self,
+        payloads: list[Payload] = TUNING_PAYLOADS,
+        model_directory: Optional[Path] = None,
+    ):
+        """
+        Benchmarks session options on this host and saves the fastest ones next
+        to `model_directory`, the quantized variant of this host by default.
+        """
+        from onnxruntime import SessionOptions
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        from transformers.models.auto.tokenization_auto import AutoTokenizer
+
+        from question_generation.pipeline import MultipleText2TextGenerationPipeline
+        from question_generation.session_tuning import (
+            candidate_profiles,
+            save_profile,
+            tune,
         )
 
-        n_inputs_texts = len(input_texts)
-        step = DEFAULT_GENERATOR_OPTIONS["num_return_sequences"]
-        for input_text_idx in range(n_inputs_texts):
-            question_batch_start = input_text_idx * step
-            question_batch_end = question_batch_start + step
-            question_batch = output_texts[question_batch_start:question_batch_end]
+        model_directory = model_directory or OnnxInt8Engine.locate(
+            self.weights_cache_folder
+        )
+        if model_directory is None:
+            raise RuntimeError(f"No onnx model in {self.weights_cache_folder}")
+        tokenizer = AutoTokenizer.from_pretrained(model_directory)
+        input_texts = payloads_to_texts(payloads)
 
-            fact_idx = answer_mapping[input_text_idx]
-            generated_questions[fact_idx].extend(question_batch)
+        def build(session_options: SessionOptions):
+            model = ORTModelForSeq2SeqLM.from_pretrained(
+                model_directory, session_options=session_options
+            )
+            pipeline = MultipleText2TextGenerationPipeline(
+                model=model, tokenizer=tokenizer
+            )
+            return lambda: pipeline(
+                input_texts, **{**DEFAULT_GENERATOR_OPTIONS, "batch_size": 1}
+            )
 
-        return generated_questions
+        n_cpus = os.cpu_count() or 1
+        profile, _ = tune(build, candidate_profiles(n_cpus))
+        save_profile(model_directory, profile, n_cpus)
 
 
-model = T5QuestionGenerator()
-# model.optimize()
-model.load()
+weights_cache_folder = Path(__file__).parent.joinpath("models")
+builder = OnnxModelBuilder(weights_cache_folder)
+# builder.optimize()
+# Variants for every instruction set the image may land on
+# builder.optimize(targets=["avx2", "avx512", "avx512_vnni"])
+# Static quantization, calibrated on a json lines file of payloads
+# builder.optimize(read_payloads(Path("calibration.jsonl")))
+# The fp32 export too, the calibration at startup then compares both
+# builder.optimize(fp32=True)
+# builder.tune_session()
+model = T5QuestionGenerator(
+    weights_cache_folder,
+    engine=ENGINE,
+    max_input_tokens=MAX_INPUT_TOKENS,
+    cache=GenerationCache(
+        max_entries=GENERATION_CACHE_SIZE,
+        ttl_seconds=GENERATION_CACHE_TTL,
+        disk_path=GENERATION_CACHE_PATH,
+    ),
+    profiler=profiler,
+)
+if not LAZY_LOAD:
+    model.load()
+sink = make_sink(RESULT_SINK)
+if PROFILE_REQUESTS > 0:
+    start_profile(Path(PROFILE_DIRECTORY), requests=PROFILE_REQUESTS)
 
 
 def handler(event, context):
     print("EVENT", event)
-    payload = json.loads(event["body"])
-    res = model(payload["answers"], payload["contexts"])
+    if model.pipeline is None:
+        model.load()
+    if is_sqs_event(event):
+        return handle_sqs_batch(event, model, sink)
+    try:
+        question = Question.parse_raw(event["body"])
+    except ValidationError as error:
+        return {
+            "statusCode": 400,
+            "body": error.json(),
+            "headers": {"Content-Type": "application/json"},
+        }
+    res = model(question.answers, question.contexts, **question.parameters.options())
     return {
         "statusCode": 200,
         "body": json.dumps(res),
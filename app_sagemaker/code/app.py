@@ -1,7 +1,9 @@
+import io
 import json
 import os
+from itertools import islice
 # from time import perf_counter
-from typing import Any, Optional, cast
+from typing import Any, Iterable, Iterator, Optional, Union, cast
 
 # import numpy as np
 import tensorflow  # type: ignore
@@ -13,9 +15,13 @@ from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
 from transformers.modeling_utils import PreTrainedModel
 from transformers.models.t5.configuration_t5 import T5Config
 from transformers.models.t5.modeling_t5 import T5ForConditionalGeneration
-from transformers.models.t5.tokenization_t5 import T5Tokenizer
+from transformers.models.t5.tokenization_t5_fast import T5TokenizerFast
+
+from context_window import windowed_prompts
 
 JSON_CONTENT_TYPE = "application/json"
+# Batch transform jobs split their input files on lines and send many per request
+JSONLINES_CONTENT_TYPES = ("application/jsonlines", "application/x-jsonlines")
 print("PATH", os.getcwd())
 model_id = "mrm8488/t5-base-finetuned-question-generation-ap"
 num_texts = 1  # Number of input texts to decode
@@ -209,26 +215,88 @@ class NeuronGeneration(PreTrainedModel, GenerationMixin):
 
 def model_fn(model_dir: str):
     model_neuron = NeuronGeneration.from_pretrained("./models")
-    tokenizer = cast(T5Tokenizer, T5Tokenizer.from_pretrained(model_id))
+    # The Rust tokenizer encodes and decodes whole batches, from the
+    # tokenizer.json saved with the model or converted from model_id
+    tokenizer_path = (
+        model_dir
+        if os.path.exists(os.path.join(model_dir, "tokenizer.json"))
+        else model_id
+    )
+    tokenizer = cast(T5TokenizerFast, T5TokenizerFast.from_pretrained(tokenizer_path))
     return model_neuron, tokenizer
 
 
-def input_fn(serialized_input_data: str, content_type: str = JSON_CONTENT_TYPE):
+# A json line: its index, the record when it is valid, the error otherwise
+Line = tuple[int, Optional[dict[str, Any]], Optional[str]]
+
+
+def record_error(record: Any) -> Optional[str]:
+    """Why `record` can not be generated for, None when it can"""
+    if not isinstance(record, dict):
+        return "A record must be a json object"
+    for field in ("answer", "context"):
+        if field not in record:
+            return "A record needs an answer and a context"
+        if not isinstance(record[field], str):
+            return f"The {field} of a record must be a string"
+    return None
+
+
+def read_records(lines: Iterable[str]) -> Iterator[Line]:
+    """Parses json lines one at a time, every line yields a record or an error"""
+    for index, line in enumerate(lines):
+        if not line.strip():
+            yield index, None, "Blank line"
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            yield index, None, f"Invalid json line: {error}"
+            continue
+        error = record_error(record)
+        yield (index, None, error) if error else (index, record, None)
+
+
+def batched(lines: Iterator[Line], size: int) -> Iterator[list[Line]]:
+    while True:
+        batch = list(islice(lines, size))
+        if not batch:
+            return
+        yield batch
+
+
+def input_fn(
+    serialized_input_data: Union[str, bytes], content_type: str = JSON_CONTENT_TYPE
+):
     if content_type == JSON_CONTENT_TYPE:
         input_data = json.loads(serialized_input_data)
         return input_data
 
-    else:
-        raise Exception("Requested unsupported ContentType in Accept: " + content_type)
+    if content_type in JSONLINES_CONTENT_TYPES:
+        if isinstance(serialized_input_data, bytes):
+            serialized_input_data = serialized_input_data.decode("utf-8")
+        return read_records(io.StringIO(serialized_input_data))
 
+    raise Exception("Requested unsupported ContentType in Accept: " + content_type)
 
-def predict_fn(input_data: dict[str, Any], model: Any):
+
+def generate(model: Any, records: list[dict[str, Any]]) -> list[list[str]]:
+    """Questions of up to `num_texts` records, from a single generate call"""
     model_neuron, tokenizer = model
-    text = f"answer: {input_data['answer']} context: {input_data['context']}"
+    # The context around the answer, rather than its start, fits the traced
+    # encoder length
+    texts = [
+        windowed_prompts(
+            tokenizer, [record["answer"]], record["context"], max_encoder_length
+        )[0]
+        for record in records
+    ]
+    # The traced networks take exactly num_texts texts
+    texts_padded = texts + [texts[-1]] * (num_texts - len(texts))
 
     batch = tokenizer(
-        text,
-        max_length=max_decoder_length,
+        texts_padded,
+        max_length=max_encoder_length,
         truncation=True,
         padding="max_length",
         return_tensors="pt",
@@ -236,17 +304,47 @@ def predict_fn(input_data: dict[str, Any], model: Any):
     # with torch.inference_mode():
     output = model_neuron.generate(
         inputs=cast(torch.Tensor, batch["input_ids"]),
+        attention_mask=cast(torch.Tensor, batch["attention_mask"]),
         max_length=max_decoder_length,
         num_beams=num_beams,
         num_return_sequences=num_beams,
     )
-    results = [tokenizer.decode(t, skip_special_tokens=True) for t in output]
-
-    return results
+    results = tokenizer.batch_decode(output, skip_special_tokens=True)
+    return [
+        results[text_idx * num_beams : (text_idx + 1) * num_beams]
+        for text_idx in range(len(texts))
+    ]
+
+
+def predict_fn(input_data: Union[dict[str, Any], Iterator[Line]], model: Any):
+    if isinstance(input_data, dict):
+        error = record_error(input_data)
+        if error:
+            raise ValueError(error)
+        return generate(model, [input_data])[0]
+
+    # Json lines: one output per input line, in order
+    outputs: list[dict[str, Any]] = []
+    for lines in batched(input_data, num_texts):
+        valid = [record for _, record, _ in lines if record is not None]
+        questions = iter(generate(model, valid) if valid else [])
+        for index, record, error in lines:
+            if record is None:
+                outputs.append({"error": error, "line": index})
+                continue
+            output: dict[str, Any] = {"questions": next(questions)}
+            if "id" in record:
+                output["id"] = record["id"]
+            outputs.append(output)
+    return outputs
 
 
 def output_fn(prediction_output: Any, accept: str = JSON_CONTENT_TYPE):
     if accept == JSON_CONTENT_TYPE:
         return json.dumps(prediction_output), accept
 
+    if accept in JSONLINES_CONTENT_TYPES:
+        lines = [json.dumps(output) for output in prediction_output]
+        return "\n".join(lines) + "\n", accept
+
     raise Exception("Requested unsupported ContentType in Accept: " + accept)
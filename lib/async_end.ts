@@ -61,6 +61,19 @@ export class AsyncStack extends cdk.Stack
       ]
     })
 
+    // The endpoint publishes the outcome of each invocation. Every lambda
+    // execution environment long polls a queue of its own, subscribed to both
+    // topics with a filter on the inference ids of its jobs, instead of polling
+    // the output bucket
+    const success_topic = new cdk.aws_sns.Topic(this, 'AsyncSuccessTopic')
+    const error_topic = new cdk.aws_sns.Topic(this, 'AsyncErrorTopic')
+    const notification_queue_prefix = `${this.stackName}-notifications`
+    const notification_queues_arn = cdk.Stack.of(this).formatArn({
+      service: "sqs",
+      resource: `${notification_queue_prefix}-*`,
+      arnFormat: cdk.ArnFormat.NO_RESOURCE_NAME,
+    })
+
     const sagemakerRole = new cdk.aws_iam.Role(
       this, "SageMakerRole", {
       assumedBy: new cdk.aws_iam.ServicePrincipal("sagemaker.amazonaws.com"),
@@ -147,6 +160,14 @@ export class AsyncStack extends cdk.Stack
               })
           ]
         }),
+        "Notifications": new cdk.aws_iam.PolicyDocument({
+          statements: [
+            new cdk.aws_iam.PolicyStatement({
+              resources: [success_topic.topicArn, error_topic.topicArn],
+              actions: ["sns:Publish"]
+            }),
+          ]
+        }),
         "KMS": new cdk.aws_iam.PolicyDocument({
           statements: [
             new cdk.aws_iam.PolicyStatement({
@@ -193,6 +214,10 @@ export class AsyncStack extends cdk.Stack
           outputConfig: {
             s3OutputPath: s3_async_output_bucket.s3UrlForObject(),
             kmsKeyId: output_key.keyId,
+            notificationConfig: {
+              successTopic: success_topic.topicArn,
+              errorTopic: error_topic.topicArn,
+            },
           },
           clientConfig: { maxConcurrentInvocationsPerInstance: 123 },
         }
@@ -263,6 +288,7 @@ export class AsyncStack extends cdk.Stack
               actions: [
                 "s3:PutObject", "s3:PutObjectAcl",
                 "s3:Abort", "s3:AbortMultipartUpload",
+                "s3:DeleteObject",
                 "s3:GetObject", "s3:GetObjectAcl",
                 "s3:ListBucket",
               ]
@@ -279,6 +305,30 @@ export class AsyncStack extends cdk.Stack
               resources: [output_key.keyArn],
               effect: cdk.aws_iam.Effect.ALLOW,
               actions: ["kms:Decrypt"]
+            }),
+            new cdk.aws_iam.PolicyStatement({
+              resources: [notification_queues_arn],
+              effect: cdk.aws_iam.Effect.ALLOW,
+              actions: [
+                "sqs:CreateQueue",
+                "sqs:DeleteQueue",
+                "sqs:GetQueueAttributes",
+                "sqs:SetQueueAttributes",
+                "sqs:TagQueue",
+                "sqs:ListQueueTags",
+                "sqs:ReceiveMessage",
+                "sqs:DeleteMessage",
+              ]
+            }),
+            new cdk.aws_iam.PolicyStatement({
+              resources: ["*"],
+              effect: cdk.aws_iam.Effect.ALLOW,
+              actions: ["sqs:ListQueues", "sns:Unsubscribe"]
+            }),
+            new cdk.aws_iam.PolicyStatement({
+              resources: [success_topic.topicArn, error_topic.topicArn],
+              effect: cdk.aws_iam.Effect.ALLOW,
+              actions: ["sns:Subscribe", "sns:ListSubscriptionsByTopic"]
             })
           ]
         })
@@ -293,9 +343,15 @@ export class AsyncStack extends cdk.Stack
       environment: {
         "ENDPOINT_NAME": async_endpoint.endpointName!,
         "INPUT_BUCKET": s3_async_input_bucket.bucketName!,
+        "NOTIFICATION_TOPICS": cdk.Fn.join(",", [success_topic.topicArn, error_topic.topicArn]),
+        "NOTIFICATION_QUEUE_PREFIX": notification_queue_prefix,
+        "NOTIFICATION_TIMEOUT": "30",
+        "RESULT_TIMEOUT": "280",
+        "MAX_INPUTS_PER_JOB": "32",
+        "MAX_IN_FLIGHT": "8",
       },
       handler: "app.lambda_handler",
-      timeout: cdk.Duration.seconds(30),
+      timeout: cdk.Duration.minutes(5),
     })
 
     const lambda_url = new cdk.aws_lambda.FunctionUrl(this, "LambdaUrl", {
@@ -8,7 +8,8 @@ export class GPUStack extends cdk.Stack
     super(scope, id, props)
     const dockerImg = new cdk.aws_ecr_assets.DockerImageAsset(
       this, 'bp-test-docker-image',
-      { directory: 'app_gpu' }
+      // Built from the root to include the shared question_generation package
+      { directory: '.', file: 'app_gpu/Dockerfile' }
     )
 
     const vpc = new cdk.aws_ec2.Vpc(this, 'my-cdk-vpc', {
@@ -13,7 +13,7 @@ export class InferentiaStack extends Stack
     super(scope, id, props)
     const dockerImg = new ecr_assets.DockerImageAsset(
       this, 'bp-test-inferentia-docker',
-      { directory: 'app_inferentia' }
+      { directory: '.', file: 'app_inferentia/Dockerfile' }
     )
 
     const vpc = new ec2.Vpc(this, 'my-cdk-vpc', {
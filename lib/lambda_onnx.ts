@@ -8,13 +8,36 @@ export class LambdaOnnxStack extends cdk.Stack
     super(scope, id, props)
     const lambda = new cdk.aws_lambda.Function(this, 'bp-test-lambda-onnx', {
       runtime: cdk.aws_lambda.Runtime.FROM_IMAGE,
-      code: cdk.aws_lambda.Code.fromAssetImage('app_onnx'),
+      // Built from the root to include the shared question_generation package
+      code: cdk.aws_lambda.Code.fromAssetImage('.', { file: 'app_onnx/Dockerfile' }),
       handler: cdk.aws_lambda.Handler.FROM_IMAGE,
       timeout: cdk.Duration.minutes(5),
       memorySize: 3096,
       architecture: cdk.aws_lambda.Architecture.X86_64,
     })
 
+    // A fixed engine, the read only image cannot record a calibration
+    lambda.addEnvironment("ENGINE", "onnx-int8")
+
+    // Offline jobs: records are batched into a single model call, results land in S3
+    const results_bucket = new cdk.aws_s3.Bucket(this, 'bp-test-lambda-onnx-results', {
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+      autoDeleteObjects: true,
+    })
+    results_bucket.grantWrite(lambda)
+    lambda.addEnvironment("RESULT_SINK", results_bucket.s3UrlForObject("questions"))
+
+    const jobs_dead_letter_queue = new cdk.aws_sqs.Queue(this, 'bp-test-lambda-onnx-jobs-dlq')
+    const jobs_queue = new cdk.aws_sqs.Queue(this, 'bp-test-lambda-onnx-jobs', {
+      visibilityTimeout: cdk.Duration.minutes(30),
+      deadLetterQueue: { queue: jobs_dead_letter_queue, maxReceiveCount: 3 },
+    })
+    lambda.addEventSource(new cdk.aws_lambda_event_sources.SqsEventSource(jobs_queue, {
+      batchSize: 50,
+      maxBatchingWindow: cdk.Duration.seconds(5),
+      reportBatchItemFailures: true,
+    }))
+
     const api = new cdk.aws_apigateway.RestApi(this, "bp-test-lambda-onnx-api", {
       restApiName: "bp test lambda api",
       description: "This service serves the ml lambda-onnx."
@@ -30,6 +53,7 @@ export class LambdaOnnxStack extends cdk.Stack
       apiKeyRequired: false
     });
 
+    new cdk.CfnOutput(this, "JobsQueueUrl", { value: jobs_queue.queueUrl });
     new cdk.CfnOutput(this, "LambdaOnnxAPI", { value: api.url });
   }
 }
\ No newline at end of file
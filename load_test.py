@@ -0,0 +1,502 @@
+"""
+Load testing harness for the question generation backends.
+
+Runs a backend locally (Lambda handlers through a local invoker, FastAPI apps
+in process or behind uvicorn) or targets a deployed url, drives it with closed
+loop or open loop load, and prints a JSON report with throughput, latency
+percentiles and cold start timings.
+
+    python load_test.py lambda onnx gpu inferentia --concurrency 4 --requests 200
+    python load_test.py gpu --launch uvicorn --mode open --rate 20 --duration 60
+    python load_test.py onnx --remote --mix 1x1:3,8x4:1
+
+Several local backends are each measured in a fresh process, so the cold start
+of one does not benefit from the imports of another.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from importlib import import_module
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ROOT = Path(__file__).parent
+
+# Local backends: how they are served and the directory of their app.py
+LOCAL_BACKENDS = {
+    "lambda": ("lambda", "app_lambda"),
+    "onnx": ("lambda", "app_onnx"),
+    "gpu": ("fastapi", "app_gpu"),
+    "inferentia": ("fastapi", "app_inferentia"),
+}
+
+# Apps whose image copies modules of question_generation next to their own,
+# imported as top level modules
+SHARED_MODULE_APPS = {"app_inferentia"}
+
+REMOTE_URLS = {
+    "lambda": "https://f9sxufa4oc.execute-api.us-east-1.amazonaws.com/prod/",
+    "onnx": "https://uc4g3xxu29.execute-api.us-east-1.amazonaws.com/prod/",
+    "gpu": "http://bp-gp-Appli-1S4QDXVMDZPXL-740407946.us-east-1.elb.amazonaws.com",
+    "inferentia": (
+        "http://bp-in-Appli-1A84QB3IVIECM-458273597.us-east-1.elb.amazonaws.com"
+    ),
+    "async": "https://d3szrvx6jw7blfke642msol5a40cnldb.lambda-url.us-east-1.on.aws/",
+}
+
+CONTEXTS = [
+    ("Sylvain is the CEO of Botpress.", "CEO"),
+    ("Botpress is a company based in Quebec City.", "Quebec City"),
+    ("The Eiffel Tower was completed in 1889 in Paris.", "1889"),
+    ("Marie Curie won the Nobel Prize in Physics in 1903.", "Marie Curie"),
+]
+
+SendFn = Callable[[dict[str, Any]], None]
+
+
+@dataclass
+class Shape:
+    """Payload size: number of contexts and of answers per context"""
+
+    contexts: int
+    answers: int
+    weight: float = 1.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.contexts}x{self.answers}"
+
+
+@dataclass
+class Sample:
+    shape: str
+    latency: float
+    ok: bool
+
+
+def parse_mix(mix: str) -> list[Shape]:
+    """"1x1:3,8x4:1" is three 1 context, 1 answer payloads for each 8x4 one"""
+    shapes: list[Shape] = []
+    for item in mix.split(","):
+        size, _, weight = item.partition(":")
+        contexts, _, answers = size.partition("x")
+        shapes.append(Shape(int(contexts), int(answers or 1), float(weight or 1)))
+    return shapes
+
+
+def make_payload(shape: Shape, number: int, unique: bool) -> dict[str, Any]:
+    """
+    Payload of `shape`, every context and answer in it numbered by its slot so
+    that the backends generate each of them rather than deduplicating repeats.
+    Unique payloads also get a per request prefix, so response caches of the
+    backends do not turn the benchmark into a cache benchmark.
+    """
+    answers: list[list[str]] = []
+    contexts: list[str] = []
+    for index in range(shape.contexts):
+        context, answer = CONTEXTS[index % len(CONTEXTS)]
+        context = f"Passage {index}. {context}"
+        contexts.append(f"Request {number}. {context}" if unique else context)
+        slots = range(shape.answers)
+        answers.append([f"{answer} {slot}" if slot else answer for slot in slots])
+    return {"answers": answers, "contexts": contexts}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted `values`"""
+    if not values:
+        return float("nan")
+    rank = min(max(math.ceil(fraction * len(values)) - 1, 0), len(values) - 1)
+    return values[rank]
+
+
+def latency_summary(samples: list[Sample]) -> dict[str, Any]:
+    latencies = sorted(sample.latency * 1000 for sample in samples if sample.ok)
+    if not latencies:
+        return {}
+    return {
+        "p50": round(percentile(latencies, 0.50), 2),
+        "p95": round(percentile(latencies, 0.95), 2),
+        "p99": round(percentile(latencies, 0.99), 2),
+        "mean": round(sum(latencies) / len(latencies), 2),
+        "max": round(latencies[-1], 2),
+    }
+
+
+class Backend(ABC):
+    """Something to send payloads to, started before and stopped after a run"""
+
+    init_seconds: Optional[float] = None
+
+    def start(self) -> None:
+        pass
+
+    @abstractmethod
+    def send(self, payload: dict[str, Any]) -> None:
+        ...
+
+    def stop(self) -> None:
+        pass
+
+
+class HttpBackend(Backend):
+    def __init__(self, url: str, pool_size: int = 64) -> None:
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def send(self, payload: dict[str, Any]) -> None:
+        response = self.session.post(self.url, json=payload, timeout=300)
+        response.raise_for_status()
+
+
+def _shared_paths(directory: str) -> list[str]:
+    if directory in SHARED_MODULE_APPS:
+        return [str(ROOT.joinpath("question_generation"))]
+    return []
+
+
+def _import_app(directory: str) -> Any:
+    """app.py of an app directory, imported as it is in its container"""
+    app_directory = ROOT.joinpath(directory)
+    sys.path[:0] = [str(app_directory), *_shared_paths(directory)]
+    os.chdir(app_directory)
+    return import_module("app")
+
+
+class LambdaBackend(Backend):
+    """
+    Calls the handler of a Lambda app.py with API Gateway proxy events. Like a
+    Lambda cold start, init is the import of the module (which loads the model).
+    Concurrent requests share one instance, use --concurrency 1 for the numbers
+    of a single Lambda execution environment.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.handler: Any = None
+
+    def start(self) -> None:
+        start = time.perf_counter()
+        self.handler = _import_app(self.directory).handler
+        self.init_seconds = time.perf_counter() - start
+
+    def send(self, payload: dict[str, Any]) -> None:
+        event = {
+            "httpMethod": "POST",
+            "path": "/",
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(payload),
+            "isBase64Encoded": False,
+        }
+        context = SimpleNamespace(
+            function_name=f"local-{self.directory}",
+            aws_request_id=f"local-{time.monotonic_ns()}",
+            get_remaining_time_in_millis=lambda: 300_000,
+        )
+        response = self.handler(event, context)
+        if response.get("statusCode") != 200:
+            raise RuntimeError(f"Handler returned {response.get('statusCode')}")
+
+
+class InProcessBackend(Backend):
+    """FastAPI app.py served in this process by the starlette test client"""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.client: Any = None
+
+    def start(self) -> None:
+        from fastapi.testclient import TestClient
+
+        start = time.perf_counter()
+        self.client = TestClient(_import_app(self.directory).app)
+        # Runs the startup handlers
+        self.client.__enter__()
+        self.init_seconds = time.perf_counter() - start
+
+    def send(self, payload: dict[str, Any]) -> None:
+        self.client.post("/", json=payload).raise_for_status()
+
+    def stop(self) -> None:
+        if self.client is not None:
+            self.client.__exit__(None, None, None)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class UvicornBackend(HttpBackend):
+    """FastAPI app.py behind its own uvicorn process, init lasts until /status"""
+
+    def __init__(self, directory: str, startup_timeout: float = 600) -> None:
+        self.directory = directory
+        self.port = _free_port()
+        self.startup_timeout = startup_timeout
+        self.process: Optional[subprocess.Popen[bytes]] = None
+        super().__init__(f"http://127.0.0.1:{self.port}/")
+
+    def start(self) -> None:
+        start = time.perf_counter()
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(self.port)],
+            cwd=ROOT.joinpath(self.directory),
+            # The apps import the shared question_generation package
+            env={
+                **os.environ,
+                "PYTHONPATH": os.pathsep.join(
+                    [str(ROOT), *_shared_paths(self.directory)]
+                ),
+            },
+        )
+        while time.perf_counter() - start < self.startup_timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with {self.process.returncode}")
+            try:
+                if self.session.get(f"{self.url}status", timeout=1).ok:
+                    self.init_seconds = time.perf_counter() - start
+                    return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.2)
+        raise TimeoutError(f"{self.directory} did not start")
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def make_backend(name: str, launch: str, url: Optional[str]) -> Backend:
+    if url:
+        return HttpBackend(url)
+    kind, directory = LOCAL_BACKENDS[name]
+    if kind == "lambda":
+        return LambdaBackend(directory)
+    if launch == "uvicorn":
+        return UvicornBackend(directory)
+    return InProcessBackend(directory)
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        send: SendFn,
+        shapes: list[Shape],
+        unique: bool = True,
+        max_in_flight: int = 256,
+        seed: int = 0,
+    ) -> None:
+        self.send = send
+        self.shapes = shapes
+        self.unique = unique
+        self.random = random.Random(seed)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.count = 0
+
+    def next_payload(self) -> tuple[Shape, dict[str, Any]]:
+        shape = self.random.choices(
+            self.shapes, weights=[shape.weight for shape in self.shapes]
+        )[0]
+        self.count += 1
+        return shape, make_payload(shape, self.count, self.unique)
+
+    async def request(self, scheduled: Optional[float] = None) -> Sample:
+        """
+        One request. Open loop latency counts from the `scheduled` arrival, so
+        time spent waiting for a free worker is not hidden (coordinated omission).
+        """
+        shape, payload = self.next_payload()
+        start = time.perf_counter() if scheduled is None else scheduled
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(self.send, payload)
+            )
+            ok = True
+        except Exception as error:
+            print("REQUEST FAILED", shape.name, repr(error), file=sys.stderr)
+            ok = False
+        return Sample(shape.name, time.perf_counter() - start, ok)
+
+    async def closed_loop(
+        self, concurrency: int, requests_count: int, duration: Optional[float]
+    ) -> list[Sample]:
+        """`concurrency` clients, each sending its next request on a response"""
+        samples: list[Sample] = []
+        deadline = time.perf_counter() + duration if duration else None
+        remaining = [requests_count]
+
+        async def client() -> None:
+            while True:
+                if deadline is not None:
+                    if time.perf_counter() >= deadline:
+                        return
+                elif remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                samples.append(await self.request())
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return samples
+
+    async def open_loop(self, rate: float, duration: float) -> list[Sample]:
+        """Poisson arrivals at `rate` per second, whatever the response times"""
+        start = time.perf_counter()
+        arrival = start
+        tasks: list["asyncio.Task[Sample]"] = []
+        while True:
+            arrival += self.random.expovariate(rate)
+            if arrival - start >= duration:
+                break
+            await asyncio.sleep(max(arrival - time.perf_counter(), 0))
+            tasks.append(asyncio.create_task(self.request(scheduled=arrival)))
+        return list(await asyncio.gather(*tasks))
+
+
+def report(
+    samples: list[Sample], wall_seconds: float, settings: dict[str, Any]
+) -> dict[str, Any]:
+    succeeded = [sample for sample in samples if sample.ok]
+    by_shape = {
+        shape: latency_summary([sample for sample in samples if sample.shape == shape])
+        for shape in sorted({sample.shape for sample in samples})
+    }
+    return {
+        **settings,
+        "requests": len(samples),
+        "errors": len(samples) - len(succeeded),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(succeeded) / wall_seconds, 3),
+        "latency_ms": latency_summary(samples),
+        "latency_ms_by_payload": by_shape,
+    }
+
+
+def run(name: str, args: argparse.Namespace) -> dict[str, Any]:
+    url = args.url or (REMOTE_URLS[name] if args.remote else None)
+    backend = make_backend(name, args.launch, url)
+    shapes = parse_mix(args.mix)
+    generator = LoadGenerator(
+        backend.send, shapes, unique=not args.repeat_payloads, seed=args.seed
+    )
+    backend.start()
+    try:
+        # The first request after init is the cold one, the next ones warm up
+        cold = asyncio.run(generator.request())
+        for _ in range(args.warmup):
+            asyncio.run(generator.request())
+
+        start = time.perf_counter()
+        if args.mode == "open":
+            samples = asyncio.run(generator.open_loop(args.rate, args.duration))
+        else:
+            samples = asyncio.run(
+                generator.closed_loop(args.concurrency, args.requests, args.duration)
+            )
+        wall_seconds = time.perf_counter() - start
+    finally:
+        backend.stop()
+
+    settings: dict[str, Any] = {
+        "backend": name,
+        "target": url or f"local {args.launch}",
+        "mode": args.mode,
+        "mix": args.mix,
+    }
+    if args.mode == "open":
+        settings["rate"] = args.rate
+    else:
+        settings["concurrency"] = args.concurrency
+    result = report(samples, wall_seconds, settings)
+    result["cold"] = {
+        "init_seconds": (
+            round(backend.init_seconds, 3) if backend.init_seconds is not None else None
+        ),
+        "first_request_ms": round(cold.latency * 1000, 2) if cold.ok else None,
+        "first_payload": cold.shape,
+    }
+    result["warm_p50_ms"] = result["latency_ms"].get("p50")
+    return result
+
+
+def run_isolated(name: str, argv: list[str]) -> dict[str, Any]:
+    """Runs the benchmark of one backend in a fresh interpreter"""
+    with tempfile.TemporaryDirectory() as directory:
+        output = Path(directory).joinpath("report.json")
+        # Logs of the backend go to stderr, away from the report
+        subprocess.run(
+            [sys.executable, __file__, name, *argv, "--output", str(output)],
+            stdout=sys.stderr,
+            check=True,
+        )
+        return json.loads(output.read_text())[0]
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("backends", nargs="+", choices=sorted(REMOTE_URLS))
+    parser.add_argument(
+        "--launch", choices=["inprocess", "uvicorn"], default="inprocess"
+    )
+    parser.add_argument("--remote", action="store_true", help="use the deployed urls")
+    parser.add_argument("--url", help="target this url instead of a local backend")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=5.0, help="open loop req/s")
+    parser.add_argument("--duration", type=float, help="seconds, default --requests")
+    parser.add_argument("--mix", default="1x1", help="e.g. 1x1:3,8x4:1")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--repeat-payloads", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args(argv)
+    if args.mode == "open" and args.duration is None:
+        parser.error("open loop load needs a --duration")
+    if not (args.remote or args.url):
+        remote_only = [name for name in args.backends if name not in LOCAL_BACKENDS]
+        if remote_only:
+            parser.error(f"no local backend for {remote_only}, use --remote")
+    return args
+
+
+def main(argv: list[str]) -> None:
+    args = parse_args(argv)
+    # A later --output of run_isolated overrides the one of the command line
+    options = [arg for arg in argv if arg not in args.backends]
+    local = not (args.remote or args.url)
+    if local and len(args.backends) > 1:
+        results = [run_isolated(name, options) for name in args.backends]
+    else:
+        results = [run(name, args) for name in args.backends]
+
+    output = json.dumps(results, indent=2)
+    # Backends log to stdout, the report is the last thing printed
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
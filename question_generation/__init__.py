@@ -0,0 +1,24 @@
+"""
+Question generation shared by the lambda, onnx and gpu apps: one generator
+over interchangeable engines (PyTorch eager, TorchScript, ONNX Runtime fp32
+and int8), picked at startup by a short calibration on the host.
+
+The python 3.7 inferentia image copies context_window, metrics, profiling and
+replica_pool as top level modules: they import nothing from this package and
+keep to the syntax of python 3.7.
+"""
+from .engines import ENGINES, Engine, available_engines, register_engine
+from .generation_cache import GenerationCache
+from .generator import DEFAULT_GENERATOR_OPTIONS, T5QuestionGenerator
+from .startup_profiler import StartupProfiler
+
+__all__ = [
+    "DEFAULT_GENERATOR_OPTIONS",
+    "ENGINES",
+    "Engine",
+    "GenerationCache",
+    "StartupProfiler",
+    "T5QuestionGenerator",
+    "available_engines",
+    "register_engine",
+]
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import platform
+from pathlib import Path
+from typing import Any, Optional
+
+# Quantization targets, from the most to the least specific instruction set
+ISA_TARGETS = ["avx512_vnni", "avx512", "avx2", "arm64"]
+
+BUILD_INFO_FILE = "build.json"
+VARIANTS_FILE = "variants.json"
+
+
+def cpu_flags(cpuinfo_path: Path = Path("/proc/cpuinfo")) -> set[str]:
+    """Instruction set flags of the host ("flags" on x86, "Features" on arm)"""
+    if not cpuinfo_path.exists():
+        return set()
+    flags: set[str] = set()
+    for line in cpuinfo_path.read_text().splitlines():
+        key, _, value = line.partition(":")
+        if key.strip() in ("flags", "Features"):
+            flags.update(value.split())
+    return flags
+
+
+def isa_target(flags: set[str]) -> str:
+    if "avx512_vnni" in flags or "avx512vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    if "avx2" in flags:
+        return "avx2"
+    if platform.machine().lower() in ("aarch64", "arm64") or "asimd" in flags:
+        return "arm64"
+    raise RuntimeError("No supported quantization target for this cpu")
+
+
+def fallback_targets(target: str) -> list[str]:
+    """Targets a host supporting `target` can run, best first"""
+    if target == "arm64":
+        return ["arm64"]
+    return ISA_TARGETS[ISA_TARGETS.index(target) : ISA_TARGETS.index("arm64")]
+
+
+def resolve_revision(
+    checkpoint: str, revision: str, builds_directory: Optional[Path] = None
+) -> str:
+    """
+    Commit sha of a checkpoint branch or tag. Offline, the revision recorded by
+    the latest build of the checkpoint in `builds_directory`, so that its build
+    key still matches, and `revision` itself only when there is none.
+    """
+    from huggingface_hub import model_info
+
+    try:
+        sha = model_info(checkpoint, revision=revision).sha
+    except Exception:
+        recorded = (
+            recorded_revision(builds_directory, checkpoint)
+            if builds_directory is not None
+            else None
+        )
+        return recorded or revision
+    return sha or revision
+
+
+def recorded_revision(builds_directory: Path, checkpoint: str) -> Optional[str]:
+    """Revision of the most recent build of `checkpoint` in `builds_directory`"""
+    if not builds_directory.is_dir():
+        return None
+    info_paths = sorted(
+        builds_directory.glob(f"*/{BUILD_INFO_FILE}"),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
+    )
+    for info_path in info_paths:
+        info = json.loads(info_path.read_text())
+        if info.get("checkpoint") == checkpoint and info.get("revision"):
+            return info["revision"]
+    return None
+
+
+def fingerprint(value: Any) -> str:
+    serialized = json.dumps(value, sort_keys=True)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:16]
+
+
+def build_info(**fields: Any) -> dict[str, Any]:
+    """Describes a build from its inputs, `key` changes whenever one of them does"""
+    # Only needed when building, keeps them out of the serving imports
+    import onnxruntime
+    import optimum.version
+    import transformers
+
+    info = {
+        **fields,
+        "onnxruntime": onnxruntime.__version__,
+        "optimum": optimum.version.__version__,
+        "transformers": transformers.__version__,
+    }
+    info["key"] = fingerprint(info)
+    return info
+
+
+def read_build_info(directory: Path) -> Optional[dict[str, Any]]:
+    info_path = directory.joinpath(BUILD_INFO_FILE)
+    if not info_path.exists():
+        return None
+    return json.loads(info_path.read_text())
+
+
+def write_build_info(directory: Path, info: dict[str, Any]) -> None:
+    directory.joinpath(BUILD_INFO_FILE).write_text(json.dumps(info, indent=2))
+
+
+def read_variants(directory: Path) -> dict[str, str]:
+    """Variant name (target, "-static" suffixed when static) to its build key"""
+    variants_path = directory.joinpath(VARIANTS_FILE)
+    if not variants_path.exists():
+        return {}
+    return json.loads(variants_path.read_text())
+
+
+def register_variant(directory: Path, variant: str, key: str) -> None:
+    variants = read_variants(directory)
+    variants[variant] = key
+    directory.joinpath(VARIANTS_FILE).write_text(json.dumps(variants, indent=2))
+
+
+def select_variant(variants: dict[str, str], target: str) -> Optional[str]:
+    """Best built variant for a host, statically quantized ones first"""
+    for candidate in fallback_targets(target):
+        for variant in (f"{candidate}-static", candidate):
+            if variant in variants:
+                return variant
+    return None
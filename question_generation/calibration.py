@@ -0,0 +1,187 @@
+import json
+import os
+import platform
+import sys
+from collections import Counter
+from importlib.util import find_spec
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from .build_cache import cpu_flags, isa_target
+from .engines import ENGINES, available_engines
+from .startup_profiler import StartupProfiler
+
+if TYPE_CHECKING:
+    from .pipeline import MultipleText2TextGenerationPipeline
+
+ENGINE_SELECTION_FILE = "engine_selection.json"
+
+# Where the engine picked for each host is recorded, the weights folder by
+# default. Read only file systems (Lambda) can point it to /tmp or skip it.
+ENGINE_SELECTION_PATH = os.environ.get("ENGINE_SELECTION_PATH")
+
+# Mean token F1 to the reference outputs an engine needs to be selected
+ENGINE_MIN_AGREEMENT = float(os.environ.get("ENGINE_MIN_AGREEMENT", 0.9))
+
+CALIBRATION_TEXTS = [
+    "answer: CEO context: Sylvain is the CEO of Botpress.",
+    "answer: Montreal context: Botpress was founded in Montreal in 2016 and builds "
+    "tools to create conversational assistants.",
+    "answer: open source context: The platform is open source and developers can "
+    "extend it with their own modules, integrations and natural language "
+    "understanding models.",
+]
+
+
+def benchmark(run: Callable[[], Any], n_runs: int = 3) -> float:
+    """Median latency of `run` in seconds, after a warmup call"""
+    run()
+    latencies: list[float] = []
+    for _ in range(n_runs):
+        start = perf_counter()
+        run()
+        latencies.append(perf_counter() - start)
+    return sorted(latencies)[len(latencies) // 2]
+
+
+def token_f1(reference: str, prediction: str) -> float:
+    reference_tokens = reference.lower().split()
+    prediction_tokens = prediction.lower().split()
+    common = sum((Counter(reference_tokens) & Counter(prediction_tokens)).values())
+    if common == 0:
+        return float(reference_tokens == prediction_tokens)
+    precision = common / len(prediction_tokens)
+    recall = common / len(reference_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def host_key() -> str:
+    """Instruction set, core count and gpu, what the engine ranking depends on"""
+    try:
+        isa = isa_target(cpu_flags())
+    except RuntimeError:
+        isa = platform.machine()
+    accelerator = "cpu"
+    if find_spec("torch") is not None:
+        import torch
+
+        if torch.cuda.is_available():
+            accelerator = torch.cuda.get_device_name(0).replace(" ", "_")
+    return f"{isa}-{os.cpu_count()}cpus-{accelerator}"
+
+
+def selection_path(weights_folder: Path) -> Path:
+    if ENGINE_SELECTION_PATH:
+        return Path(ENGINE_SELECTION_PATH)
+    return weights_folder.joinpath(ENGINE_SELECTION_FILE)
+
+
+def read_selection(path: Path, key: str) -> Optional[str]:
+    if not path.exists():
+        return None
+    return json.loads(path.read_text()).get(key, {}).get("engine")
+
+
+def writable(path: Path) -> bool:
+    """Whether a selection can be recorded at `path`"""
+    if path.exists():
+        return os.access(path, os.W_OK)
+    return os.access(path.parent, os.W_OK)
+
+
+def record_selection(path: Path, key: str, selection: dict[str, Any]) -> None:
+    try:
+        selections = json.loads(path.read_text()) if path.exists() else {}
+        selections[key] = selection
+        path.write_text(json.dumps(selections, indent=2))
+    except OSError as error:
+        print("ENGINE SELECTION NOT RECORDED", repr(error))
+
+
+def calibrate(
+    weights_folder: Path,
+    profiler: StartupProfiler,
+    texts: list[str] = CALIBRATION_TEXTS,
+    min_agreement: float = ENGINE_MIN_AGREEMENT,
+    n_runs: int = 3,
+) -> tuple[str, "MultipleText2TextGenerationPipeline", list[dict[str, Any]]]:
+    """
+    Loads every available engine in turn and times it on `texts`. The first
+    one gives the reference questions, an engine whose questions agree less
+    than `min_agreement` with them is rejected. Only the fastest accepted
+    pipeline is kept in memory.
+    """
+    from .generator import DEFAULT_GENERATOR_OPTIONS
+
+    options = {**DEFAULT_GENERATOR_OPTIONS, "batch_size": len(texts)}
+    reference: Optional[list[str]] = None
+    best: Optional[tuple[float, str, "MultipleText2TextGenerationPipeline"]] = None
+    results: list[dict[str, Any]] = []
+    for name, directory in available_engines(weights_folder).items():
+        try:
+            pipeline = ENGINES[name](directory).load(profiler)
+            outputs: list[str] = pipeline(texts, **options)
+        except Exception as error:
+            print("ENGINE FAILED", name, repr(error))
+            continue
+        if reference is None:
+            reference = outputs
+        agreement = sum(map(token_f1, reference, outputs)) / len(texts)
+        latency = benchmark(lambda: pipeline(texts, **options), n_runs)
+        accepted = agreement >= min_agreement
+        results.append(
+            {
+                "engine": name,
+                "latency": round(latency, 4),
+                "agreement": round(agreement, 4),
+                "accepted": accepted,
+            }
+        )
+        print("ENGINE CALIBRATION", json.dumps(results[-1]))
+        if accepted and (best is None or latency < best[0]):
+            best = (latency, name, pipeline)
+        del pipeline
+
+    if best is None:
+        raise RuntimeError(f"No engine could be loaded from {weights_folder}")
+    _, name, pipeline = best
+    return name, pipeline, results
+
+
+def select_engine(
+    weights_folder: Path, profiler: StartupProfiler
+) -> tuple[str, "MultipleText2TextGenerationPipeline"]:
+    """
+    Engine to serve with on this host: the one recorded by a previous
+    calibration on the same kind of host with the same engines available,
+    or the winner of a new calibration, which is then recorded. Without a
+    writable selection path the calibration would rerun on every start, the
+    first available engine is served instead.
+    """
+    engines = available_engines(weights_folder)
+    if not engines:
+        raise RuntimeError(f"No engine can load a model from {weights_folder}")
+    key = f"{host_key()}/{','.join(engines)}"
+    path = selection_path(weights_folder)
+
+    name = read_selection(path, key)
+    if name in engines:
+        return name, ENGINES[name](engines[name]).load(profiler)
+    if len(engines) == 1 or not writable(path):
+        name = next(iter(engines))
+        if len(engines) > 1:
+            print("ENGINE CALIBRATION SKIPPED", path, "is not writable")
+        return name, ENGINES[name](engines[name]).load(profiler)
+
+    with profiler.phase("calibration"):
+        name, pipeline, results = calibrate(weights_folder, profiler)
+    record_selection(path, key, {"engine": name, "candidates": results})
+    return name, pipeline
+
+
+if __name__ == "__main__":
+    # Calibrates ahead of serving, recording the engine for this kind of host
+    # python -m question_generation.calibration models
+    name, _ = select_engine(Path(sys.argv[1]), StartupProfiler())
+    print("ENGINE", name)
@@ -0,0 +1,137 @@
+"""
+Fits contexts in the encoder budget around their answers. The inferentia,
+sagemaker and async apps copy this file next to their own modules, it keeps
+to the standard library and the python 3.7 syntax of their images.
+"""
+import re
+from typing import Any, List, Optional, Tuple
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+WORD = re.compile(r"\S+")
+
+Span = Tuple[int, int]
+
+
+def prompt(answer: str, context: str) -> str:
+    return f"answer: {answer} context: {context}"
+
+
+def sentence_spans(text: str) -> List[Span]:
+    spans: List[Span] = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        spans.append((start, match.start()))
+        start = match.end()
+    spans.append((start, len(text)))
+    return spans
+
+
+def word_spans(text: str, start: int, end: int) -> List[Span]:
+    return [
+        (start + match.start(), start + match.end())
+        for match in WORD.finditer(text[start:end])
+    ]
+
+
+def count_tokens(tokenizer: Any, text: str, spans: List[Span]) -> List[int]:
+    """Tokens of each span, the tokenizer marks the start of every word"""
+    pieces = [text[start:end] for start, end in spans]
+    encodings = tokenizer(pieces, add_special_tokens=False)["input_ids"]
+    return [len(ids) for ids in encodings]
+
+
+def covering(spans: List[Span], start: int, end: int) -> Tuple[int, int]:
+    """Range of the spans overlapping [start, end)"""
+    first = next(idx for idx, span in enumerate(spans) if span[1] > start)
+    last = max((idx for idx, span in enumerate(spans) if span[0] < end), default=first)
+    return first, max(first, last) + 1
+
+
+def expand(counts: List[int], first: int, last: int, budget: int) -> Tuple[int, int]:
+    """
+    Widest range of units around [first, last) within `budget` tokens, taking
+    the next unit after then before it in turn. Starts from the answer alone,
+    cut from its end, when even the answer exceeds the budget.
+    """
+    used = sum(counts[first:last])
+    while last - first > 1 and used > budget:
+        last -= 1
+        used -= counts[last]
+    grown = True
+    while grown:
+        grown = False
+        if last < len(counts) and used + counts[last] <= budget:
+            used += counts[last]
+            last += 1
+            grown = True
+        if first > 0 and used + counts[first - 1] <= budget:
+            first -= 1
+            used += counts[first]
+            grown = True
+    return first, last
+
+
+class ContextWindow:
+    """
+    Fits a context in an encoder budget of `max_tokens` tokens for each of
+    its answers. Around the answer it keeps whole sentences while they fit,
+    then the words of the answer's sentence(s). A context that fits is kept
+    whole, the window of one without the answer starts at its beginning.
+    The context is only tokenized once a prompt may not fit.
+    """
+
+    def __init__(self, tokenizer: Any, context: str, max_tokens: int) -> None:
+        self.tokenizer = tokenizer
+        self.context = context
+        self.max_tokens = max_tokens
+        self.sentences = sentence_spans(context)
+        self._sentence_tokens: Optional[List[int]] = None
+
+    @property
+    def sentence_tokens(self) -> List[int]:
+        if self._sentence_tokens is None:
+            self._sentence_tokens = count_tokens(
+                self.tokenizer, self.context, self.sentences
+            )
+        return self._sentence_tokens
+
+    def budget(self, answer: str) -> int:
+        """Tokens left to the context, after the prompt template and eos"""
+        template = self.tokenizer(prompt(answer, ""))["input_ids"]
+        return self.max_tokens - len(template)
+
+    def prompt(self, answer: str) -> str:
+        whole = prompt(answer, self.context)
+        # Every piece of the tokenizer holds at least a character, a prompt
+        # shorter than the budget fits along with its eos
+        if len(whole) < self.max_tokens:
+            return whole
+        budget = self.budget(answer)
+        if sum(self.sentence_tokens) <= budget:
+            return whole
+        start = self.context.lower().find(answer.lower()) if answer.strip() else -1
+        end = start + len(answer)
+        if start < 0:
+            start, end = 0, 1
+
+        first, last = covering(self.sentences, start, end)
+        if sum(self.sentence_tokens[first:last]) <= budget:
+            first, last = expand(self.sentence_tokens, first, last, budget)
+            spans = self.sentences
+        else:
+            # A single window of words inside the answer's sentences
+            spans = word_spans(
+                self.context, self.sentences[first][0], self.sentences[last - 1][1]
+            )
+            counts = count_tokens(self.tokenizer, self.context, spans)
+            first, last = covering(spans, start, end)
+            first, last = expand(counts, first, last, budget)
+        return prompt(answer, self.context[spans[first][0] : spans[last - 1][1]])
+
+
+def windowed_prompts(
+    tokenizer: Any, answers: List[str], context: str, max_tokens: int
+) -> List[str]:
+    """Prompts of the answers of a context, the context fit in `max_tokens`"""
+    window = ContextWindow(tokenizer, context, max_tokens)
+    return [window.prompt(answer) for answer in answers]
@@ -0,0 +1,246 @@
+from abc import ABC, abstractmethod
+from importlib.util import find_spec
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, ClassVar, Optional
+
+from .build_cache import cpu_flags, isa_target, read_variants, select_variant
+from .startup_profiler import StartupProfiler
+
+if TYPE_CHECKING:
+    from transformers.modeling_utils import PreTrainedModel
+
+    from .pipeline import MultipleText2TextGenerationPipeline
+
+PYTORCH_WEIGHTS_FILE = "pytorch_model.bin"
+# Same as weights.SAFETENSORS_FILE, which would import torch with this module
+SAFETENSORS_FILE = "model.safetensors"
+
+# fp32 onnx export, next to the quantized variants of the weights folder
+ONNX_FP32_DIRECTORY = "fp32"
+
+
+class Engine(ABC):
+    """
+    Runtime a checkpoint is served with. `locate` finds the files the engine
+    needs in a weights folder, `load` turns them into a generation pipeline.
+    """
+
+    name: ClassVar[str]
+    # Modules the engine needs, it is not available when one is missing
+    requires: ClassVar[tuple[str, ...]] = ()
+
+    def __init__(self, model_directory: Path) -> None:
+        self.model_directory = model_directory
+
+    @classmethod
+    @abstractmethod
+    def locate(cls, weights_folder: Path) -> Optional[Path]:
+        ...
+
+    @classmethod
+    def available(cls, weights_folder: Path) -> Optional[Path]:
+        if any(find_spec(module) is None for module in cls.requires):
+            return None
+        return cls.locate(weights_folder)
+
+    @abstractmethod
+    def load(self, profiler: StartupProfiler) -> "MultipleText2TextGenerationPipeline":
+        ...
+
+
+# In order of preference for the reference outputs of the calibration: the
+# first available engine is the one the others must agree with.
+ENGINES: dict[str, type[Engine]] = {}
+
+
+def register_engine(engine: type[Engine]) -> type[Engine]:
+    ENGINES[engine.name] = engine
+    return engine
+
+
+def available_engines(weights_folder: Path) -> dict[str, Path]:
+    """Name of every engine the weights folder has files for, to its directory"""
+    engines: dict[str, Path] = {}
+    for name, engine in ENGINES.items():
+        directory = engine.available(weights_folder)
+        if directory is not None:
+            engines[name] = directory
+    return engines
+
+
+@register_engine
+class TorchEngine(Engine):
+    name = "torch"
+    requires = ("torch", "transformers")
+
+    @classmethod
+    def locate(cls, weights_folder: Path) -> Optional[Path]:
+        if not weights_folder.joinpath("config.json").exists():
+            return None
+        for weights_file in (SAFETENSORS_FILE, PYTORCH_WEIGHTS_FILE):
+            if weights_folder.joinpath(weights_file).exists():
+                return weights_folder
+        return None
+
+    def prepare(self, model: "PreTrainedModel") -> "PreTrainedModel":
+        return model
+
+    def load(self, profiler: StartupProfiler) -> "MultipleText2TextGenerationPipeline":
+        # Only the submodules needed to serve, `import transformers` resolves
+        # every model and pipeline lazily through its top level module.
+        with profiler.phase(f"{self.name} imports"):
+            from torch.cuda import is_available as gpu_available
+            from transformers.models.auto.modeling_auto import AutoModelForSeq2SeqLM
+            from transformers.models.auto.tokenization_auto import AutoTokenizer
+
+            from .pipeline import MultipleText2TextGenerationPipeline
+            from .weights import load_mapped_model
+
+        with profiler.phase(f"{self.name} tokenizer"):
+            tokenizer = AutoTokenizer.from_pretrained(self.model_directory)
+        with profiler.phase(f"{self.name} weights"):
+            # Converted at build time (python -m question_generation.weights
+            # convert models), memory mapped and shared between processes
+            if self.model_directory.joinpath(SAFETENSORS_FILE).exists():
+                model = load_mapped_model(self.model_directory)
+            else:
+                model = AutoModelForSeq2SeqLM.from_pretrained(self.model_directory)
+        with profiler.phase(f"{self.name} pipeline"):
+            device = 0 if gpu_available() else -1
+            if device >= 0:
+                model = model.to(f"cuda:{device}")
+            return MultipleText2TextGenerationPipeline(
+                model=self.prepare(model), tokenizer=tokenizer, device=device
+            )
+
+
+class TracedEncoder:
+    """
+    Stands in for the encoder of a seq2seq model during `generate`, running a
+    TorchScript trace of it. Traced with symbolic sizes, it takes any batch
+    size and sequence length.
+    """
+
+    main_input_name = "input_ids"
+
+    def __init__(self, traced: Any) -> None:
+        self.traced = traced
+
+    def __call__(
+        self, input_ids: Any, attention_mask: Any = None, **kwargs: Any
+    ) -> Any:
+        import torch
+        from transformers.modeling_outputs import BaseModelOutput
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        return BaseModelOutput(last_hidden_state=self.traced(input_ids, attention_mask))
+
+    forward = __call__
+
+
+@register_engine
+class TorchScriptEngine(TorchEngine):
+    """
+    Eager model whose encoder runs as a TorchScript trace. The decoder stays
+    eager: its cache of past keys and values changes shape at every step.
+    """
+
+    name = "torchscript"
+
+    def prepare(self, model: "PreTrainedModel") -> "PreTrainedModel":
+        import torch
+
+        encoder = model.get_encoder()
+
+        class EncoderHiddenStates(torch.nn.Module):
+            def __init__(self) -> None:
+                super().__init__()
+                self.encoder = encoder
+
+            def forward(self, input_ids: Any, attention_mask: Any) -> Any:
+                return self.encoder(
+                    input_ids, attention_mask=attention_mask, return_dict=False
+                )[0]
+
+        def example(ids: list[list[int]]) -> tuple[Any, Any]:
+            # Rows of different lengths, so padding is part of the trace
+            example_ids = torch.tensor(ids, device=model.device)
+            example_mask = (example_ids != 0).long()
+            example_mask[:, 0] = 1
+            return example_ids, example_mask
+
+        eager = EncoderHiddenStates().eval()
+        # The trace must generalize to other batch sizes and lengths
+        check = example(
+            [[0, 4, 2, 5, 1, 3, 1], [0, 3, 1, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0]]
+        )
+        with torch.no_grad():
+            traced = torch.jit.trace(
+                eager,
+                example([[0, 1, 2, 1], [0, 1, 0, 0]]),
+                check_inputs=[check],
+            )
+            if not torch.allclose(traced(*check), eager(*check), atol=1e-4):
+                raise RuntimeError("The traced encoder does not match the eager one")
+        traced_encoder = TracedEncoder(traced)
+        model.get_encoder = lambda: traced_encoder  # type: ignore
+        return model
+
+
+@register_engine
+class OnnxEngine(Engine):
+    name = "onnx-fp32"
+    requires = ("onnxruntime", "optimum")
+
+    @classmethod
+    def locate(cls, weights_folder: Path) -> Optional[Path]:
+        directory = weights_folder.joinpath(ONNX_FP32_DIRECTORY)
+        return directory if any(directory.glob("*.onnx")) else None
+
+    def load(self, profiler: StartupProfiler) -> "MultipleText2TextGenerationPipeline":
+        # Only the submodules needed to serve, quantization and calibration
+        # (datasets) are imported by the methods building the model.
+        with profiler.phase(f"{self.name} imports"):
+            from optimum.onnxruntime import ORTModelForSeq2SeqLM
+            from transformers.models.auto.tokenization_auto import AutoTokenizer
+
+            from .pipeline import MultipleText2TextGenerationPipeline
+            from .session_tuning import load_profile
+
+        with profiler.phase(f"{self.name} tokenizer"):
+            tokenizer = AutoTokenizer.from_pretrained(self.model_directory)
+        with profiler.phase(f"{self.name} weights"):
+            profile = load_profile(self.model_directory)
+            model = ORTModelForSeq2SeqLM.from_pretrained(
+                self.model_directory,
+                session_options=profile.session_options() if profile else None,
+            )
+        with profiler.phase(f"{self.name} pipeline"):
+            return MultipleText2TextGenerationPipeline(
+                model=model, tokenizer=tokenizer
+            )
+
+
+@register_engine
+class OnnxInt8Engine(OnnxEngine):
+    """Quantized variant built for the instruction set of this host"""
+
+    name = "onnx-int8"
+
+    @classmethod
+    def locate(cls, weights_folder: Path) -> Optional[Path]:
+        variants = read_variants(weights_folder)
+        if not variants:
+            # A single model saved directly in the weights folder
+            return weights_folder if any(weights_folder.glob("*.onnx")) else None
+        try:
+            target = isa_target(cpu_flags())
+        except RuntimeError:
+            return None
+        variant = select_variant(variants, target)
+        if variant is None:
+            print(f"NO ONNX VARIANT FOR {target}, built: {', '.join(variants)}")
+            return None
+        print("ONNX VARIANT", variant)
+        return weights_folder.joinpath(variant)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from time import time
+from typing import Any, Optional, Union
+
+
+def cache_key(prompt: str, generator_options: dict[str, Any]) -> str:
+    serialized = json.dumps([prompt, generator_options], sort_keys=True)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(generator_options: dict[str, Any]) -> bool:
+    # Sampled generations (top_k / top_p with do_sample) are not reproducible
+    return not generator_options.get("do_sample", False)
+
+
+class GenerationCache:
+    """
+    Content addressed cache of generated questions. Entries live in a bounded
+    in memory LRU and, when `disk_path` is given, in a sqlite table that survives
+    process restarts. Entries older than `ttl_seconds` are treated as misses.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        ttl_seconds: Optional[float] = None,
+        disk_path: Optional[Union[str, Path]] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[str, tuple[float, list[str]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.disk: Optional[sqlite3.Connection] = None
+
+        if disk_path is not None:
+            Path(disk_path).parent.mkdir(parents=True, exist_ok=True)
+            self.disk = sqlite3.connect(str(disk_path), check_same_thread=False)
+            self.disk.execute(
+                "CREATE TABLE IF NOT EXISTS generations "
+                "(key TEXT PRIMARY KEY, created REAL, questions TEXT)"
+            )
+            self.disk.commit()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl_seconds is not None and time() - created > self.ttl_seconds
+
+    def _remember(self, key: str, created: float, questions: list[str]) -> None:
+        self.entries[key] = (created, questions)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _get_from_disk(self, key: str) -> Optional[tuple[float, list[str]]]:
+        if self.disk is None:
+            return None
+        row = self.disk.execute(
+            "SELECT created, questions FROM generations WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        created, questions = row
+        if self._expired(created):
+            self.disk.execute("DELETE FROM generations WHERE key = ?", (key,))
+            self.disk.commit()
+            return None
+        return created, json.loads(questions)
+
+    def get(self, key: str) -> Optional[list[str]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                entry = self._get_from_disk(key)
+                if entry is not None:
+                    self._remember(key, *entry)
+            else:
+                self.entries.move_to_end(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, questions: list[str]) -> None:
+        created = time()
+        with self.lock:
+            self._remember(key, created, questions)
+            if self.disk is not None:
+                self.disk.execute(
+                    "INSERT OR REPLACE INTO generations VALUES (?, ?, ?)",
+                    (key, created, json.dumps(questions)),
+                )
+                self.disk.commit()
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
@@ -0,0 +1,187 @@
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Optional
+
+from .context_window import prompt, windowed_prompts
+from .engines import ENGINES, Engine
+from .generation_cache import GenerationCache, cache_key, is_cacheable
+from .metrics import observe_input_tokens, observe_model_load, timed
+from .profiling import profiled
+from .startup_profiler import StartupProfiler
+
+if TYPE_CHECKING:
+    from .pipeline import MultipleText2TextGenerationPipeline
+
+MODEL_CHECKPOINT = "mrm8488/t5-base-finetuned-question-generation-ap"
+
+DEFAULT_GENERATOR_OPTIONS = {
+    "max_length": 128,
+    "min_length": 2,
+    "early_stopping": True,
+    "num_beams": 1,
+    "temperature": 1.0,
+    "num_return_sequences": 1,
+    "top_k": 0,
+    "top_p": 0.92,
+    "repetition_penalty": 2.0,
+    "length_penalty": 1.0,
+}
+
+# Padded tokens (rows x longest row) allowed in a single pipeline batch.
+MAX_BATCH_TOKENS = 2048
+
+# Encoder budget of a prompt, the length the checkpoint was fine tuned with
+MAX_INPUT_TOKENS = 512
+
+
+def token_budget_batches(lengths: list[int], max_batch_tokens: int) -> list[list[int]]:
+    """
+    Groups input indices by increasing length so that each batch pads to at most
+    `max_batch_tokens` tokens. An input longer than the budget gets its own batch.
+    """
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    for idx in sorted(range(len(lengths)), key=lambda idx: lengths[idx]):
+        # Inputs are sorted, so the current one is the longest of its batch
+        if batch and lengths[idx] * (len(batch) + 1) > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class T5QuestionGenerator:
+    """
+    Generates questions for (answer, context) pairs with the engine named
+    `engine`, or with the fastest engine of this host when it is "auto".
+    Long contexts are cut to a window around the answer so that prompts fit
+    in `max_input_tokens`, None keeps them whole.
+    """
+
+    def __init__(
+        self,
+        weights_cache_folder: Path,
+        engine: str = "auto",
+        cache: Optional[GenerationCache] = None,
+        profiler: Optional[StartupProfiler] = None,
+        max_input_tokens: Optional[int] = MAX_INPUT_TOKENS,
+    ) -> None:
+        self.pipeline: Optional["MultipleText2TextGenerationPipeline"] = None
+        self.weights_cache_folder = weights_cache_folder
+        self.model_checkpoint = MODEL_CHECKPOINT
+        self.engine = engine
+        self.cache = cache if cache is not None else GenerationCache(max_entries=0)
+        self.profiler = profiler or StartupProfiler()
+        self.max_input_tokens = max_input_tokens
+
+    def load(self, engine: Optional[Engine] = None) -> None:
+        """Loads `engine`, or the one named at construction"""
+        start = perf_counter()
+        if engine is None and self.engine == "auto":
+            from .calibration import select_engine
+
+            self.engine, self.pipeline = select_engine(
+                self.weights_cache_folder, self.profiler
+            )
+        else:
+            if engine is None:
+                directory = ENGINES[self.engine].available(self.weights_cache_folder)
+                if directory is None:
+                    raise RuntimeError(
+                        f"No {self.engine} model in {self.weights_cache_folder}"
+                    )
+                engine = ENGINES[self.engine](directory)
+            self.engine = engine.name
+            self.pipeline = engine.load(self.profiler)
+        observe_model_load(self.engine, perf_counter() - start)
+        print("ENGINE", self.engine)
+        self.profiler.report()
+
+    def __call__(
+        self, answers: list[list[str]], contexts: list[str], **generator_options: Any
+    ) -> list[list[str]]:
+        with profiled(), timed("generate"):
+            return self.generate(answers, contexts, **generator_options)
+
+    def prompts(self, answers: list[str], context: str) -> list[str]:
+        if self.max_input_tokens is None:
+            return [prompt(answer, context) for answer in answers]
+        with timed("window"):
+            return windowed_prompts(
+                self.pipeline.tokenizer, answers, context, self.max_input_tokens
+            )
+
+    def generate(
+        self, answers: list[list[str]], contexts: list[str], **generator_options: Any
+    ) -> list[list[str]]:
+        input_texts: list[str] = []
+        answer_mapping: list[int] = []
+        generated_questions: list[list[str]] = []
+
+        for ctx_idx, ctx in enumerate(contexts):
+            generated_questions.append([])
+            input_texts.extend(self.prompts(answers[ctx_idx], ctx))
+            answer_mapping.extend([ctx_idx] * len(answers[ctx_idx]))
+
+        options = {**DEFAULT_GENERATOR_OPTIONS, **generator_options}
+        use_cache = is_cacheable(options)
+        n_inputs_texts = len(input_texts)
+        step = options["num_return_sequences"]
+
+        output_texts: list[str] = [""] * (n_inputs_texts * step)
+        keys = [cache_key(input_text, options) for input_text in input_texts]
+        missing: list[int] = []
+        # Repeated prompts are generated once, (input text, first occurrence)
+        first_occurrences: dict[str, int] = {}
+        duplicates: list[tuple[int, int]] = []
+        for input_text_idx, key in enumerate(keys):
+            if use_cache and key in first_occurrences:
+                duplicates.append((input_text_idx, first_occurrences[key]))
+                continue
+            first_occurrences[key] = input_text_idx
+            cached = self.cache.get(key) if use_cache else None
+            if cached is None:
+                missing.append(input_text_idx)
+            else:
+                output_texts[input_text_idx * step : (input_text_idx + 1) * step] = (
+                    cached
+                )
+
+        # Tokenized once, for the batch lengths and as the pipeline's inputs
+        model_inputs: list[dict[str, Any]] = []
+        lengths: list[int] = []
+        if missing:
+            model_inputs = self.pipeline.tokenize([input_texts[idx] for idx in missing])
+            lengths = [len(inputs["input_ids"][0]) for inputs in model_inputs]
+            observe_input_tokens(sum(lengths))
+        for batch in token_budget_batches(lengths, MAX_BATCH_TOKENS):
+            batch_outputs: list[str] = self.pipeline(
+                [model_inputs[idx] for idx in batch],
+                **{**options, "batch_size": len(batch)},
+            )
+            # Put the questions back at the position of their input text
+            for batch_idx, missing_idx in enumerate(batch):
+                input_text_idx = missing[missing_idx]
+                questions = batch_outputs[batch_idx * step : (batch_idx + 1) * step]
+                output_texts[input_text_idx * step : (input_text_idx + 1) * step] = (
+                    questions
+                )
+                if use_cache:
+                    self.cache.put(keys[input_text_idx], questions)
+
+        for input_text_idx, first_idx in duplicates:
+            output_texts[input_text_idx * step : (input_text_idx + 1) * step] = (
+                output_texts[first_idx * step : (first_idx + 1) * step]
+            )
+
+        for input_text_idx in range(n_inputs_texts):
+            question_batch_start = input_text_idx * step
+            question_batch_end = question_batch_start + step
+            question_batch = output_texts[question_batch_start:question_batch_end]
+
+            fact_idx = answer_mapping[input_text_idx]
+            generated_questions[fact_idx].extend(question_batch)
+
+        return generated_questions
@@ -0,0 +1,191 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from importlib.util import find_spec
+from time import perf_counter
+from typing import Any, Iterator, Optional, Tuple
+
+# Seconds, from a single decode step to a long request
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+class Metrics:
+    """
+    Prometheus metrics of the generator. Stages are window (fitting contexts
+    in the encoder budget), tokenize, encode, decode_step, detokenize, generate
+    (a generator call) and request (an http request, end to end).
+    """
+
+    def __init__(self) -> None:
+        from prometheus_client import Gauge, Histogram
+
+        self.stage_seconds = Histogram(
+            "question_generation_stage_seconds",
+            "Duration of each stage of the question generation",
+            ["stage"],
+            buckets=LATENCY_BUCKETS,
+        )
+        self.batch_size = Histogram(
+            "question_generation_batch_size",
+            "Texts per model batch",
+            buckets=BATCH_SIZE_BUCKETS,
+        )
+        self.input_tokens = Histogram(
+            "question_generation_input_tokens",
+            "Prompt tokens per generator call",
+            buckets=TOKEN_BUCKETS,
+        )
+        self.requests_in_flight = Gauge(
+            "question_generation_requests_in_flight",
+            "Requests being served",
+            multiprocess_mode="livesum",
+        )
+        self.model_load_seconds = Gauge(
+            "question_generation_model_load_seconds",
+            "Duration of the last model load",
+            ["engine"],
+            multiprocess_mode="max",
+        )
+
+
+@lru_cache(maxsize=None)
+def metrics() -> Optional[Metrics]:
+    """
+    Metrics of this process, created on first use so `enable_multiprocess`
+    can run before. None when prometheus_client is not installed (lambdas).
+    """
+    if find_spec("prometheus_client") is None:
+        return None
+    return Metrics()
+
+
+def enable_multiprocess() -> None:
+    """
+    Aggregates the metrics of the model replicas: call it in the server process
+    before any metric is used, the replicas inherit the directory.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="metrics")
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    registry = metrics()
+    if registry is not None:
+        registry.stage_seconds.labels(stage).observe(seconds)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, perf_counter() - start)
+
+
+def observe_batch_size(size: int) -> None:
+    registry = metrics()
+    if registry is not None:
+        registry.batch_size.observe(size)
+
+
+def observe_input_tokens(n_tokens: int) -> None:
+    registry = metrics()
+    if registry is not None:
+        registry.input_tokens.observe(n_tokens)
+
+
+def observe_model_load(engine: str, seconds: float) -> None:
+    registry = metrics()
+    if registry is not None:
+        registry.model_load_seconds.labels(engine).set(seconds)
+
+
+@contextmanager
+def track_request() -> Iterator[None]:
+    """Counts the request in flight and times it end to end"""
+    registry = metrics()
+    if registry is not None:
+        registry.requests_in_flight.inc()
+    try:
+        with timed("request"):
+            yield
+    finally:
+        if registry is not None:
+            registry.requests_in_flight.dec()
+
+
+def exposition() -> Tuple[bytes, str]:
+    """Body and content type of a /metrics response"""
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        REGISTRY,
+        CollectorRegistry,
+        generate_latest,
+    )
+
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class TimedEncoder:
+    """Times the encoder pass of `generate`, otherwise behaves as `encoder`"""
+
+    def __init__(self, encoder: Any) -> None:
+        self.encoder = encoder
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.encoder, name)
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        with timed("encode"):
+            return self.encoder(*args, **kwargs)
+
+    @property
+    def forward(self) -> Any:
+        # generate inspects the signature of the encoder's forward
+        @wraps(self.encoder.forward)
+        def forward(*args: Any, **kwargs: Any) -> Any:
+            return self(*args, **kwargs)
+
+        return forward
+
+
+def instrument_model(model: Any) -> None:
+    """
+    Times the encoder pass and every decode step of `model.generate`: it calls
+    the encoder once, then the model's forward once per generated token.
+    """
+    get_encoder = model.get_encoder
+    forward = model.forward
+
+    @wraps(forward)
+    def timed_forward(*args: Any, **kwargs: Any) -> Any:
+        with timed("decode_step"):
+            return forward(*args, **kwargs)
+
+    model.get_encoder = lambda: TimedEncoder(get_encoder())
+    model.forward = timed_forward
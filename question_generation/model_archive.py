@@ -0,0 +1,32 @@
+"""
+Packs the model.tar.gz of the sagemaker and async endpoints: the files of the
+app folder (model files and the inference code in code/) along with the
+shared modules its code imports as top level ones.
+"""
+import sys
+import tarfile
+from pathlib import Path
+from typing import Optional
+
+PACKAGE = Path(__file__).parent
+# Modules of this package copied into code/ of the archive
+SHARED_MODULES = ("context_window.py",)
+
+
+def skip_caches(member: tarfile.TarInfo) -> Optional[tarfile.TarInfo]:
+    return None if "__pycache__" in Path(member.name).parts else member
+
+
+def pack(app_directory: Path, archive: Path) -> Path:
+    archive.parent.mkdir(parents=True, exist_ok=True)
+    with tarfile.open(archive, "w:gz") as tar:
+        for path in sorted(app_directory.iterdir()):
+            tar.add(path, arcname=path.name, filter=skip_caches)
+        for module in SHARED_MODULES:
+            tar.add(PACKAGE / module, arcname=f"code/{module}")
+    return archive
+
+
+if __name__ == "__main__":
+    # python -m question_generation.model_archive app_async/app model.tar.gz
+    print("PACKED", pack(Path(sys.argv[1]), Path(sys.argv[2])))
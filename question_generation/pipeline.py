@@ -0,0 +1,57 @@
+from typing import Any, Literal
+
+import torch
+from transformers.pipelines.text2text_generation import Text2TextGenerationPipeline
+
+from .metrics import instrument_model, observe_batch_size, timed
+
+Text2TextPipelineOutput = list[list[dict[Literal["generated_text"], str]]]
+
+
+class MultipleText2TextGenerationPipeline(Text2TextGenerationPipeline):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        instrument_model(self.model)
+
+    def __call__(self, *args: list[Any], **kwargs: Any):
+        result: Text2TextPipelineOutput = super(
+            Text2TextGenerationPipeline, self
+        ).__call__(*args, **kwargs)
+        flatten_results: list[str] = []
+        for result_list in result:
+            for result_dict in result_list:
+                flatten_results.append(
+                    result_dict["generated_text"].replace("question: ", "")
+                )
+        return flatten_results
+
+    def tokenize(self, texts: list[str]) -> list[dict[str, torch.Tensor]]:
+        """
+        Model inputs of each text as `preprocess` builds them, from a single
+        tokenizer call. The pipeline takes them in place of the texts.
+        """
+        prefix = self.model.config.prefix or ""
+        with timed("tokenize"):
+            encodings = self.tokenizer([prefix + text for text in texts])
+        return [
+            {
+                name: torch.tensor([encodings[name][idx]])
+                for name in ("input_ids", "attention_mask")
+            }
+            for idx in range(len(texts))
+        ]
+
+    def preprocess(self, inputs: Any, *args: Any, **kwargs: Any):
+        if isinstance(inputs, dict):
+            # Already tokenized by `tokenize`
+            return inputs
+        with timed("tokenize"):
+            return super().preprocess(inputs, *args, **kwargs)
+
+    def _forward(self, model_inputs: Any, **generate_kwargs: Any):
+        observe_batch_size(len(model_inputs["input_ids"]))
+        return super()._forward(model_inputs, **generate_kwargs)
+
+    def postprocess(self, *args: Any, **kwargs: Any):
+        with timed("detokenize"):
+            return super().postprocess(*args, **kwargs)
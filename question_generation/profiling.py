@@ -0,0 +1,237 @@
+import asyncio
+import hmac
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+from contextlib import contextmanager, nullcontext
+from importlib.util import find_spec
+from pathlib import Path
+from time import monotonic
+from typing import Any, Callable, Counter, Iterator, List, Optional, Set
+
+# Interval of the python stack samples, in seconds
+SAMPLING_INTERVAL = float(os.environ.get("PROFILE_SAMPLING_INTERVAL", 0.005))
+
+# Written last by a profiling session, once its traces are complete
+STACKS_SUFFIX = ".folded"
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the python stacks of the threads in a profiled call every
+    `interval` seconds, counted in the folded format of flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, threads: Set[int], interval: float) -> None:
+        super().__init__(daemon=True)
+        self.threads = threads
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.stopping = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in list(self.threads):
+                frame = frames.get(thread_id)
+                stack: List[str] = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = Path(code.co_filename).name
+                    stack.append(f"{code.co_name} ({name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        self.stopping.set()
+        self.join()
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.items())
+
+
+class Profiler:
+    """
+    Profiles the generator calls of this process while a session runs, the
+    next `requests` calls or the calls of the next `seconds`. Each call gets a
+    torch.profiler trace, `<pid>-<call>.trace.json` in Chrome trace format,
+    and the python stacks of the session are sampled to `<pid>.folded`. Calls
+    only check an attribute when no session runs.
+    """
+
+    def __init__(self) -> None:
+        # Calls are profiled while active, the session is written once no
+        # profiled call is left in progress.
+        self.active = False
+        self.running = False
+        self.lock = threading.Condition()
+        self.directory = Path()
+        self.remaining: Optional[int] = None
+        self.n_calls = 0
+        self.in_progress = 0
+        self.threads: Set[int] = set()
+        self.sampler: Optional[StackSampler] = None
+        self.timer: Optional[threading.Timer] = None
+
+    def start(
+        self,
+        directory: Path,
+        requests: Optional[int] = None,
+        seconds: Optional[float] = None,
+    ) -> None:
+        with self.lock:
+            if self.running:
+                raise RuntimeError("A profiling session is already running")
+            directory.mkdir(parents=True, exist_ok=True)
+            self.directory = directory
+            self.remaining = requests
+            self.n_calls = 0
+            self.threads = set()
+            self.sampler = StackSampler(self.threads, SAMPLING_INTERVAL)
+            self.sampler.start()
+            if seconds is not None:
+                self.timer = threading.Timer(seconds, self.stop)
+                self.timer.daemon = True
+                self.timer.start()
+            self.active = self.running = True
+        print("PROFILE STARTED", directory)
+
+    def stop(self) -> None:
+        """Ends the session once the calls being profiled return"""
+        with self.lock:
+            self.active = False
+            self.lock.wait_for(lambda: not self.running or self.in_progress == 0)
+            if self.running:
+                self._finish()
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        if not self.active:
+            yield
+            return
+        thread_id = threading.get_ident()
+        with self.lock:
+            profiled = self.active
+            if profiled:
+                call_idx = self.n_calls
+                self.n_calls += 1
+                self.in_progress += 1
+                self.threads.add(thread_id)
+                if self.remaining is not None:
+                    self.remaining -= 1
+                    self.active = self.remaining > 0
+        if not profiled:
+            yield
+            return
+        try:
+            # torch.profiler only records the thread it is started on
+            with torch_profile() as trace:
+                yield
+            if trace is not None:
+                trace.export_chrome_trace(
+                    str(self.directory.joinpath(f"{os.getpid()}-{call_idx}.trace.json"))
+                )
+        finally:
+            with self.lock:
+                self.in_progress -= 1
+                self.threads.discard(thread_id)
+                if self.running and not self.active and self.in_progress == 0:
+                    self._finish()
+                self.lock.notify_all()
+
+    def _finish(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.sampler is not None:
+            stacks = self.sampler.stop()
+            self.directory.joinpath(f"{os.getpid()}{STACKS_SUFFIX}").write_text(stacks)
+            self.sampler = None
+        self.running = False
+        print("PROFILE WRITTEN", self.directory, self.n_calls, "calls")
+
+
+def torch_profile() -> Any:
+    if find_spec("torch") is None:
+        return nullcontext()
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    return profile(activities=activities, record_shapes=True)
+
+
+# Generator calls of this process run under this profiler
+PROFILER = Profiler()
+
+
+def profiled() -> Any:
+    return PROFILER.profile()
+
+
+def start_profile(
+    directory: Path, requests: Optional[int] = None, seconds: Optional[float] = None
+) -> None:
+    """Top level, to be run on the model replicas"""
+    PROFILER.start(directory, requests, seconds)
+
+
+def stop_profile() -> None:
+    PROFILER.stop()
+
+
+def authorized(authorization: str, token: str) -> bool:
+    """Whether an Authorization header holds the bearer `token`"""
+    return hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+
+
+async def wait_for_profiles(directory: Path, n_processes: int, timeout: float) -> None:
+    """Waits for `n_processes` sessions writing to `directory` to end"""
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if len(list(directory.glob(f"*{STACKS_SUFFIX}"))) >= n_processes:
+            return
+        await asyncio.sleep(0.1)
+
+
+def archive(directory: Path) -> bytes:
+    """Zip of the traces and stack samples written to `directory`"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for path in sorted(directory.iterdir()):
+            zip_file.write(path, path.name)
+    return buffer.getvalue()
+
+
+async def profile_processes(
+    pool: Any, requests: Optional[int], seconds: float
+) -> bytes:
+    """
+    Profiles the next `requests` generator calls of each process serving the
+    model, for at most `seconds`: this one, or every replica of `pool` when it
+    is not None. Returns the zip of their traces.
+    """
+
+    async def run(function: Callable[..., None], *args: Any) -> int:
+        if pool is None:
+            await asyncio.get_running_loop().run_in_executor(None, function, *args)
+            return 1
+        futures = pool.broadcast(function, *args)
+        await asyncio.gather(*map(asyncio.wrap_future, futures))
+        return len(futures)
+
+    directory = Path(tempfile.mkdtemp(prefix="profile"))
+    try:
+        n_processes = await run(start_profile, directory, requests, seconds)
+        await wait_for_profiles(directory, n_processes, seconds)
+        # Writes the sessions still waiting for a call to return
+        await run(stop_profile)
+        return archive(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,214 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future
+from itertools import count
+from queue import Empty
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+
+READY = -1
+
+
+def split_cores(n_replicas: int) -> List[List[int]]:
+    """Splits the cores this process may run on into one group per replica"""
+    cores = sorted(os.sched_getaffinity(0))
+    if n_replicas > len(cores):
+        return [[cores[idx % len(cores)]] for idx in range(n_replicas)]
+    per_replica = len(cores) // n_replicas
+    return [
+        cores[idx * per_replica : (idx + 1) * per_replica] for idx in range(n_replicas)
+    ]
+
+
+def serve(
+    replica_idx: int,
+    load_model: Callable[[], Callable[..., Any]],
+    cores: List[int],
+    env: Dict[str, str],
+    jobs: "multiprocessing.Queue[Any]",
+    results: "multiprocessing.Queue[Any]",
+) -> None:
+    os.environ.update(env)
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    model = load_model()
+    results.put((READY, True, replica_idx))
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, function, args, kwargs = job
+        try:
+            call = model if function is None else function
+            results.put((job_id, True, call(*args, **kwargs)))
+        except Exception as error:
+            # The original exception might not be picklable
+            results.put(
+                (job_id, False, RuntimeError(f"Replica {replica_idx}: {error!r}"))
+            )
+
+
+class ReplicaPool:
+    """
+    Runs `n_replicas` worker processes, each pinned to its own group of cores
+    and holding the model returned by `load_model` (a top level function, it is
+    pickled to the workers). Calls are routed to the replica with the fewest
+    jobs in flight. When `visible_cores_env` is set (NEURON_RT_VISIBLE_CORES
+    for example), each replica gets its index in that environment variable.
+    """
+
+    def __init__(
+        self,
+        load_model: Callable[[], Callable[..., Any]],
+        n_replicas: int,
+        visible_cores_env: Optional[str] = None,
+    ) -> None:
+        self.load_model = load_model
+        self.n_replicas = n_replicas
+        self.visible_cores_env = visible_cores_env
+        self.context = multiprocessing.get_context("spawn")
+        self.results: "multiprocessing.Queue[Any]" = self.context.Queue()
+        self.processes: List[Any] = []
+        self.jobs: List["multiprocessing.Queue[Any]"] = []
+        self.in_flight = [0] * n_replicas
+        self.ready = [False] * n_replicas
+        self.alive = [True] * n_replicas
+        self.pending: Dict[int, Tuple[int, "Future[Any]"]] = {}
+        self.job_ids = count()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.reader = threading.Thread(target=self._read_results, daemon=True)
+
+    def start(self) -> None:
+        for replica_idx, cores in enumerate(split_cores(self.n_replicas)):
+            env = {}
+            if self.visible_cores_env is not None:
+                env[self.visible_cores_env] = str(replica_idx)
+            jobs: "multiprocessing.Queue[Any]" = self.context.Queue()
+            process = self.context.Process(
+                target=serve,
+                args=(replica_idx, self.load_model, cores, env, jobs, self.results),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+            self.jobs.append(jobs)
+        self.reader.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    def submit(self, *args: Any, **kwargs: Any) -> "Future[Any]":
+        future: "Future[Any]" = Future()
+        with self.lock:
+            replicas = [idx for idx in range(self.n_replicas) if self.alive[idx]]
+            if not replicas:
+                raise RuntimeError("All replicas exited")
+            replica_idx = min(replicas, key=self.in_flight.__getitem__)
+            job_id = self._add_job(replica_idx, future)
+        self.jobs[replica_idx].put((job_id, None, args, kwargs))
+        return future
+
+    def broadcast(
+        self, function: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> List["Future[Any]"]:
+        """
+        Runs `function` (a top level function, it is pickled) once in every
+        live replica, after the jobs already queued there.
+        """
+        jobs: List[Tuple[int, int]] = []
+        futures: List["Future[Any]"] = []
+        with self.lock:
+            for replica_idx in range(self.n_replicas):
+                if self.alive[replica_idx]:
+                    futures.append(Future())
+                    jobs.append((replica_idx, self._add_job(replica_idx, futures[-1])))
+        for replica_idx, job_id in jobs:
+            self.jobs[replica_idx].put((job_id, function, args, kwargs))
+        return futures
+
+    def _add_job(self, replica_idx: int, future: "Future[Any]") -> int:
+        job_id = next(self.job_ids)
+        self.in_flight[replica_idx] += 1
+        self.pending[job_id] = (replica_idx, future)
+        return job_id
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        return self.submit(*args, **kwargs).result()
+
+    def queue_depths(self) -> List[int]:
+        with self.lock:
+            return list(self.in_flight)
+
+    def status(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [
+                {"queue_depth": in_flight, "ready": ready, "alive": alive}
+                for in_flight, ready, alive in zip(
+                    self.in_flight, self.ready, self.alive
+                )
+            ]
+
+    def _read_results(self) -> None:
+        while not self.stopping.is_set():
+            self._fail_dead_replicas()
+            try:
+                job_id, succeeded, value = self.results.get(timeout=1)
+            except Empty:
+                continue
+            except Exception as error:
+                # A result that cannot be unpickled, its job fails with its replica
+                print("REPLICA RESULT DROPPED", repr(error))
+                continue
+            try:
+                self._set_result(job_id, succeeded, value)
+            except Exception as error:
+                # Keeps reading, the other jobs would never complete otherwise
+                print("REPLICA RESULT DROPPED", job_id, repr(error))
+
+    def _set_result(self, job_id: int, succeeded: bool, value: Any) -> None:
+        if job_id == READY:
+            self.ready[value] = True
+            return
+
+        with self.lock:
+            # Already failed when its replica was found dead
+            job = self.pending.pop(job_id, None)
+            if job is None:
+                return
+            replica_idx, future = job
+            self.in_flight[replica_idx] -= 1
+        if future.done():
+            return
+        if succeeded:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _fail_dead_replicas(self) -> None:
+        for replica_idx, process in enumerate(self.processes):
+            if process.is_alive() or not self.alive[replica_idx]:
+                continue
+            with self.lock:
+                self.alive[replica_idx] = False
+                lost = [
+                    job_id
+                    for job_id, (job_replica_idx, _) in self.pending.items()
+                    if job_replica_idx == replica_idx
+                ]
+                futures = [self.pending.pop(job_id)[1] for job_id in lost]
+                self.in_flight[replica_idx] = 0
+            for future in futures:
+                future.set_exception(
+                    RuntimeError(f"Replica {replica_idx} exited ({process.exitcode})")
+                )
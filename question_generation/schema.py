@@ -0,0 +1,34 @@
+from typing import Any, Optional
+
+from pydantic import BaseModel, Field, validator
+
+
+class GenerationParameters(BaseModel):
+    """Generator options a request may override, anything else is rejected"""
+
+    do_sample: Optional[bool] = None
+    top_p: Optional[float] = Field(None, gt=0, le=1)
+    top_k: Optional[int] = Field(None, ge=0, le=1000)
+    temperature: Optional[float] = Field(None, gt=0, le=5)
+
+    class Config:
+        extra = "forbid"
+
+    def options(self) -> dict[str, Any]:
+        return self.dict(exclude_none=True)
+
+
+class Question(BaseModel):
+    """Body of a generation request, from http or from an SQS record"""
+
+    answers: list[list[str]]
+    contexts: list[str]
+    parameters: GenerationParameters = GenerationParameters()
+
+    @validator("contexts")
+    def one_answer_list_per_context(
+        cls, contexts: list[str], values: dict[str, Any]
+    ) -> list[str]:
+        if "answers" in values and len(values["answers"]) != len(contexts):
+            raise ValueError("answers and contexts must have the same length")
+        return contexts
@@ -0,0 +1,118 @@
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from onnxruntime import ExecutionMode, GraphOptimizationLevel, SessionOptions
+
+from .calibration import benchmark
+
+SESSION_PROFILES_FILE = "session_profiles.json"
+
+EXECUTION_MODES = {
+    "sequential": ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ExecutionMode.ORT_PARALLEL,
+}
+GRAPH_OPTIMIZATION_LEVELS = {
+    "basic": GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+@dataclass(frozen=True)
+class SessionProfile:
+    intra_op_num_threads: int
+    inter_op_num_threads: int
+    execution_mode: str
+    graph_optimization_level: str
+
+    def session_options(self) -> SessionOptions:
+        options = SessionOptions()
+        options.intra_op_num_threads = self.intra_op_num_threads
+        options.inter_op_num_threads = self.inter_op_num_threads
+        options.execution_mode = EXECUTION_MODES[self.execution_mode]
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[
+            self.graph_optimization_level
+        ]
+        return options
+
+
+def candidate_profiles(n_cpus: int) -> list[SessionProfile]:
+    thread_counts = sorted({1, max(n_cpus // 2, 1), n_cpus})
+    profiles: list[SessionProfile] = []
+    for graph_optimization_level in ("extended", "all"):
+        for intra_op_num_threads in thread_counts:
+            profiles.append(
+                SessionProfile(
+                    intra_op_num_threads, 1, "sequential", graph_optimization_level
+                )
+            )
+            if n_cpus > 1:
+                # Parallel mode runs independent graph branches on inter op threads
+                profiles.append(
+                    SessionProfile(
+                        intra_op_num_threads, 2, "parallel", graph_optimization_level
+                    )
+                )
+    return profiles
+
+
+def tune(
+    build: Callable[[SessionOptions], Callable[[], Any]],
+    profiles: list[SessionProfile],
+    n_runs: int = 3,
+) -> tuple[SessionProfile, list[dict[str, Any]]]:
+    """
+    Builds a runner with the session options of every profile and returns the
+    fastest one along with the latency of each profile.
+    """
+    results: list[dict[str, Any]] = []
+    for profile in profiles:
+        latency = benchmark(build(profile.session_options()), n_runs)
+        results.append({**asdict(profile), "latency": latency})
+        print("SESSION PROFILE", results[-1])
+
+    best = min(results, key=lambda result: result["latency"])
+    return (
+        SessionProfile(
+            **{key: value for key, value in best.items() if key != "latency"}
+        ),
+        results,
+    )
+
+
+def save_profile(model_dir: Path, profile: SessionProfile, n_cpus: int) -> None:
+    """Records the profile for hosts with `n_cpus` cores next to the model"""
+    profiles_path = model_dir.joinpath(SESSION_PROFILES_FILE)
+    profiles: dict[str, Any] = {}
+    if profiles_path.exists():
+        profiles = json.loads(profiles_path.read_text())
+    profiles[str(n_cpus)] = asdict(profile)
+    profiles_path.write_text(json.dumps(profiles, indent=2))
+
+
+def load_profile(
+    model_dir: Path, n_cpus: Optional[int] = None
+) -> Optional[SessionProfile]:
+    """
+    Profile tuned for `n_cpus` cores (the current host by default). Falls back
+    to the profile of the closest tuned core count, capping its thread counts.
+    """
+    profiles_path = model_dir.joinpath(SESSION_PROFILES_FILE)
+    if not profiles_path.exists():
+        return None
+    profiles: dict[str, Any] = json.loads(profiles_path.read_text())
+    if not profiles:
+        return None
+
+    n_cpus = n_cpus or os.cpu_count() or 1
+    tuned_cpus = min(profiles, key=lambda key: abs(int(key) - n_cpus))
+    profile = SessionProfile(**profiles[tuned_cpus])
+    return SessionProfile(
+        intra_op_num_threads=min(profile.intra_op_num_threads, n_cpus),
+        inter_op_num_threads=min(profile.inter_op_num_threads, n_cpus),
+        execution_mode=profile.execution_mode,
+        graph_optimization_level=profile.graph_optimization_level,
+    )
@@ -0,0 +1,169 @@
+import json
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Protocol
+
+from .schema import Question
+
+GenerateFn = Callable[..., list[list[str]]]
+
+
+@dataclass
+class Job:
+    message_id: str
+    answers: list[list[str]]
+    contexts: list[str]
+    parameters: dict[str, Any]
+    # Optional "id" of the record body, echoed in its result
+    job_id: Optional[str]
+
+
+class Sink(Protocol):
+    def write(self, result: dict[str, Any]) -> None:
+        ...
+
+
+class LogSink:
+    def write(self, result: dict[str, Any]) -> None:
+        print("RESULT", json.dumps(result))
+
+
+class S3Sink:
+    """One json object per record, at <prefix>/<message id>.json"""
+
+    def __init__(self, bucket: str, prefix: str = "", client: Any = None) -> None:
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = client
+
+    def write(self, result: dict[str, Any]) -> None:
+        if self.client is None:
+            import boto3
+
+            self.client = boto3.client("s3")
+        key = f"{result['messageId']}.json"
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}/{key}" if self.prefix else key,
+            Body=json.dumps(result),
+            ContentType="application/json",
+        )
+
+
+class SqsSink:
+    def __init__(self, queue_url: str, client: Any = None) -> None:
+        self.queue_url = queue_url
+        self.client = client
+
+    def write(self, result: dict[str, Any]) -> None:
+        if self.client is None:
+            import boto3
+
+            self.client = boto3.client("sqs")
+        self.client.send_message(
+            QueueUrl=self.queue_url, MessageBody=json.dumps(result)
+        )
+
+
+def make_sink(uri: str) -> Sink:
+    """s3://bucket/prefix, an SQS queue url, or an empty string to log results"""
+    if not uri:
+        return LogSink()
+    if uri.startswith("s3://"):
+        bucket, _, prefix = uri[len("s3://") :].partition("/")
+        return S3Sink(bucket, prefix)
+    if uri.startswith("https://sqs.") or uri.startswith("https://queue."):
+        return SqsSink(uri)
+    raise ValueError(f"Unsupported result sink: {uri}")
+
+
+def is_sqs_event(event: dict[str, Any]) -> bool:
+    records = event.get("Records") or []
+    return bool(records) and records[0].get("eventSource") == "aws:sqs"
+
+
+def parse_record(record: dict[str, Any]) -> Job:
+    """Raises a ValueError (pydantic's ValidationError) for an invalid body"""
+    body = json.loads(record["body"])
+    question = Question.parse_obj(body)
+    return Job(
+        message_id=record["messageId"],
+        answers=question.answers,
+        contexts=question.contexts,
+        parameters=question.parameters.options(),
+        job_id=body.get("id"),
+    )
+
+
+def generate_jobs(generate: GenerateFn, jobs: list[Job]) -> dict[str, list[list[str]]]:
+    """Questions of every job, from a single generate call"""
+    answers: list[list[str]] = []
+    contexts: list[str] = []
+    for job in jobs:
+        answers.extend(job.answers)
+        contexts.extend(job.contexts)
+    questions = generate(answers, contexts, **jobs[0].parameters)
+
+    results: dict[str, list[list[str]]] = {}
+    offset = 0
+    for job in jobs:
+        results[job.message_id] = questions[offset : offset + len(job.contexts)]
+        offset += len(job.contexts)
+    return results
+
+
+def handle_sqs_batch(
+    event: dict[str, Any], generate: GenerateFn, sink: Sink
+) -> dict[str, Any]:
+    """
+    Generates the questions of every record of an SQS batch event and writes
+    them to `sink`. Records sharing generator parameters are merged into one
+    generate call. When that call fails, each record is retried alone so only
+    the faulty ones are reported in batchItemFailures (and redelivered by SQS).
+    A record without a messageId cannot be reported alone, the whole batch
+    fails before any generation.
+    """
+    records = event["Records"]
+    if not all(record.get("messageId") for record in records):
+        raise ValueError("SQS record without a messageId, failing the whole batch")
+
+    failures: list[str] = []
+    groups: dict[str, list[Job]] = {}
+    for record in records:
+        try:
+            job = parse_record(record)
+        except (KeyError, TypeError, ValueError) as error:
+            print("INVALID RECORD", record["messageId"], repr(error))
+            failures.append(record["messageId"])
+            continue
+        parameters_key = json.dumps(job.parameters, sort_keys=True)
+        groups.setdefault(parameters_key, []).append(job)
+
+    for jobs in groups.values():
+        try:
+            results = generate_jobs(generate, jobs)
+        except Exception as error:
+            print("BATCH FAILED", repr(error))
+            results = {}
+            for job in jobs:
+                try:
+                    results.update(generate_jobs(generate, [job]))
+                except Exception as job_error:
+                    print("RECORD FAILED", job.message_id, repr(job_error))
+                    failures.append(job.message_id)
+
+        for job in jobs:
+            if job.message_id not in results:
+                continue
+            try:
+                sink.write(
+                    {
+                        "messageId": job.message_id,
+                        "id": job.job_id,
+                        "questions": results[job.message_id],
+                    }
+                )
+            except Exception as error:
+                print("SINK FAILED", job.message_id, repr(error))
+                failures.append(job.message_id)
+
+    return {"batchItemFailures": [{"itemIdentifier": id_} for id_ in failures]}
@@ -0,0 +1,40 @@
+import json
+import sys
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Iterator
+
+
+class StartupProfiler:
+    """
+    Times the phases of a cold start (imports, tokenizer load, weight load,
+    pipeline construction) and counts the modules each phase imported.
+    `report` prints the breakdown once the model is ready.
+    """
+
+    def __init__(self) -> None:
+        self.start = perf_counter()
+        self.phases: list[dict[str, Any]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        n_modules = len(sys.modules)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append(
+                {
+                    "phase": name,
+                    "seconds": round(perf_counter() - start, 4),
+                    "modules": len(sys.modules) - n_modules,
+                }
+            )
+
+    def report(self) -> dict[str, Any]:
+        report = {
+            "phases": self.phases,
+            "total_seconds": round(perf_counter() - self.start, 4),
+        }
+        print("STARTUP PROFILE", json.dumps(report))
+        return report
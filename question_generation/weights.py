@@ -0,0 +1,226 @@
+import json
+import mmap
+import struct
+import subprocess
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Iterator
+
+import torch
+from transformers.modeling_utils import PreTrainedModel, no_init_weights
+from transformers.models.auto.configuration_auto import AutoConfig
+from transformers.models.auto.modeling_auto import AutoModelForSeq2SeqLM
+
+SAFETENSORS_FILE = "model.safetensors"
+
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def convert(model_directory: Path) -> Path:
+    """
+    Writes the weights of the checkpoint in `model_directory` to a safetensors
+    file next to it. Tied weights are stored once, their other names are kept
+    as aliases in the file metadata.
+    """
+    from safetensors.torch import save_file
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_directory)
+    tensors: dict[str, torch.Tensor] = {}
+    aliases: dict[str, str] = {}
+    names_by_pointer: dict[int, str] = {}
+    for name, tensor in model.state_dict().items():
+        pointer = tensor.data_ptr()
+        if pointer in names_by_pointer:
+            aliases[name] = names_by_pointer[pointer]
+            continue
+        names_by_pointer[pointer] = name
+        tensors[name] = tensor.contiguous()
+
+    path = model_directory.joinpath(SAFETENSORS_FILE)
+    save_file(
+        tensors, str(path), metadata={"format": "pt", "aliases": json.dumps(aliases)}
+    )
+    return path
+
+
+def mmap_safetensors(path: Path) -> dict[str, torch.Tensor]:
+    """
+    Tensors of a safetensors file, backed by a private memory map of it. Nothing
+    is copied: pages are read on first access and shared through the page cache
+    by every process mapping the same file.
+    """
+    with open(path, "rb") as file:
+        # Copy on write since torch wants writable buffers, the file is never
+        # modified and untouched pages stay shared.
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    (header_size,) = struct.unpack("<Q", buffer[:8])
+    header: dict[str, Any] = json.loads(buffer[8 : 8 + header_size])
+    metadata: dict[str, str] = header.pop("__metadata__", {})
+
+    tensors: dict[str, torch.Tensor] = {}
+    for name, info in header.items():
+        dtype = DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        element_size = torch.empty((), dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=(end - begin) // element_size,
+            offset=8 + header_size + begin,
+        ).view(info["shape"])
+
+    for alias, name in json.loads(metadata.get("aliases", "{}")).items():
+        tensors[alias] = tensors[name]
+    return tensors
+
+
+TORCH_INIT_FUNCTIONS = [
+    "uniform_",
+    "normal_",
+    "trunc_normal_",
+    "constant_",
+    "zeros_",
+    "ones_",
+    "xavier_uniform_",
+    "xavier_normal_",
+    "kaiming_uniform_",
+    "kaiming_normal_",
+]
+
+
+@contextmanager
+def _parameters_on_meta() -> Iterator[None]:
+    """Parameters created in this context hold no memory and skip initialization"""
+    register_parameter = torch.nn.Module.register_parameter
+    init_functions = {
+        name: getattr(torch.nn.init, name) for name in TORCH_INIT_FUNCTIONS
+    }
+
+    def register_on_meta(module: torch.nn.Module, name: str, param: Any) -> None:
+        register_parameter(module, name, param)
+        if param is not None:
+            module._parameters[name] = torch.nn.Parameter(
+                param.to("meta"), requires_grad=param.requires_grad
+            )
+
+    torch.nn.Module.register_parameter = register_on_meta  # type: ignore
+    for name in TORCH_INIT_FUNCTIONS:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = register_parameter  # type: ignore
+        for name, function in init_functions.items():
+            setattr(torch.nn.init, name, function)
+
+
+def load_mapped_model(model_directory: Path) -> PreTrainedModel:
+    """
+    Builds the model from its config without allocating weights and points
+    every parameter to the memory mapped safetensors file of `model_directory`.
+    """
+    config = AutoConfig.from_pretrained(model_directory)
+    with no_init_weights(), _parameters_on_meta():
+        model = AutoModelForSeq2SeqLM.from_config(config)
+
+    state_dict = mmap_safetensors(model_directory.joinpath(SAFETENSORS_FILE))
+    for name, tensor in state_dict.items():
+        module_name, _, tensor_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = torch.nn.Parameter(
+                tensor, requires_grad=False
+            )
+        else:
+            module._buffers[tensor_name] = tensor
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise RuntimeError(f"Weights missing from {SAFETENSORS_FILE}: {missing}")
+    model.tie_weights()
+    return model.eval()
+
+
+def memory_mb() -> dict[str, float]:
+    """Resident memory of this process, anonymous and file backed (shareable)"""
+    status = Path("/proc/self/status").read_text()
+    memory: dict[str, float] = {}
+    for line in status.splitlines():
+        key, _, value = line.partition(":")
+        if key in ("VmRSS", "RssAnon", "RssFile"):
+            memory[key] = int(value.split()[0]) / 1024
+    return memory
+
+
+def measure(model_directory: Path, mapped: bool) -> dict[str, Any]:
+    """Load time and memory of one loading path, after a generate call"""
+    start = perf_counter()
+    if mapped:
+        model = load_mapped_model(model_directory)
+    else:
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_directory)
+    load_seconds = perf_counter() - start
+    loaded = memory_mb()
+
+    # Touches every weight, mapped pages become resident as file pages
+    with torch.inference_mode():
+        model.generate(torch.tensor([[0, 1]]), max_length=4)
+    return {
+        "path": "safetensors mmap" if mapped else "from_pretrained",
+        "load_seconds": round(load_seconds, 3),
+        "loaded": loaded,
+        "after_generate": memory_mb(),
+    }
+
+
+def compare(model_directory: Path) -> list[dict[str, Any]]:
+    """
+    Measures both loading paths, each in a fresh process so the numbers do
+    not include the other's allocations. With the mapped path, RssFile pages
+    are shared by every process on the host, RssAnon is the per process cost.
+    """
+    results: list[dict[str, Any]] = []
+    for mode in ("from_pretrained", "mmap"):
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "question_generation.weights",
+                "measure",
+                str(model_directory),
+                mode,
+            ],
+            capture_output=True,
+            check=True,
+        )
+        results.append(json.loads(output.stdout.decode("utf-8").splitlines()[-1]))
+        print("STARTUP COMPARISON", json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    # python -m question_generation.weights convert models
+    # python -m question_generation.weights compare models
+    command, directory = sys.argv[1], Path(sys.argv[2])
+    if command == "convert":
+        print("CONVERTED", convert(directory))
+    elif command == "compare":
+        compare(directory)
+    elif command == "measure":
+        print(json.dumps(measure(directory, mapped=sys.argv[3] == "mmap")))
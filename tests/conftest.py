@@ -0,0 +1,59 @@
+import importlib
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# The apps import their modules as top level ones, from their own directory
+sys.path.insert(0, str(ROOT))
+
+
+def add_app_path(app_directory: str, *shared: str) -> None:
+    """
+    Makes the modules of an app importable, along with the `shared` modules
+    of question_generation its image copies next to them
+    """
+    path = str(ROOT.joinpath(app_directory))
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    for name in shared:
+        # The same module object, not a second import of the file
+        sys.modules[name] = importlib.import_module(f"question_generation.{name}")
+
+
+class WhitespaceTokenizer:
+    """A token per whitespace separated word, and an eos with special tokens"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def __call__(self, texts, add_special_tokens=True):
+        self.calls += 1
+
+        def encode(text):
+            words = text.split()
+            return words + ["</s>"] if add_special_tokens else words
+
+        if isinstance(texts, str):
+            return {"input_ids": encode(texts)}
+        return {"input_ids": [encode(text) for text in texts]}
+
+
+def tiny_t5(vocab_size: int = 64):
+    """Randomly initialized T5 small enough to trace in a test"""
+    import torch
+    from transformers.models.t5.configuration_t5 import T5Config
+    from transformers.models.t5.modeling_t5 import T5ForConditionalGeneration
+
+    torch.manual_seed(0)
+    config = T5Config(
+        vocab_size=vocab_size,
+        d_model=16,
+        d_kv=4,
+        d_ff=32,
+        num_layers=2,
+        num_decoder_layers=2,
+        num_heads=4,
+        decoder_start_token_id=0,
+    )
+    return T5ForConditionalGeneration(config).eval()
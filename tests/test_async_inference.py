@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from conftest import add_app_path  # noqa: E402
+
+add_app_path("app_async/app/code", "context_window")
+
+from inference import ChunkSizeController, is_out_of_memory  # noqa: E402
+
+GB = 1 << 30
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"),
+        RuntimeError(
+            "[enforce fail at alloc_cpu.cpp:75] err == 0. DefaultCPUAllocator: "
+            "can't allocate memory: you tried to allocate 8589934592 bytes."
+        ),
+        MemoryError(),
+    ],
+)
+def test_out_of_memory_errors(error):
+    assert is_out_of_memory(error)
+
+
+def test_other_errors():
+    assert not is_out_of_memory(RuntimeError("shape mismatch"))
+
+
+def test_grows_with_headroom():
+    controller = ChunkSizeController(8, 1, 64, min_free=0.1)
+    # 1 GB per text, 2 extra texts fit in the 8 GB free of 16 GB
+    controller.grow(8, 8 * GB, 8 * GB, 16 * GB)
+    assert controller.size == 10
+    # Unknown chunk memory, only the free share is checked
+    controller.grow(10, None, 8 * GB, 16 * GB)
+    assert controller.size == 12
+
+
+def test_does_not_grow_without_headroom():
+    controller = ChunkSizeController(8, 1, 64, min_free=0.1)
+    # 2 extra texts of 1 GB would leave less than 10% of 16 GB
+    controller.grow(8, 8 * GB, 3 * GB, 16 * GB)
+    assert controller.size == 8
+    controller.grow(8, None, 1 * GB, 16 * GB)
+    assert controller.size == 8
+
+
+def test_growth_capped_after_out_of_memory():
+    controller = ChunkSizeController(32, 1, 64, min_free=0.0)
+    assert controller.shrink(32)
+    assert controller.size == 16
+    for _ in range(10):
+        controller.grow(16, None, 8 * GB, 16 * GB)
+    assert controller.size == 31
+
+
+def test_shrink_at_minimum():
+    controller = ChunkSizeController(4, 1, 64)
+    assert controller.shrink(4) and controller.shrink(2)
+    assert not controller.shrink(1)
+    assert controller.size == 1
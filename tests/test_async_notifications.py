@@ -0,0 +1,189 @@
+"""
+The lambda of the async endpoint waiting for SageMaker's SNS notifications
+through an SQS queue, with S3, SNS and SQS mocked by moto.
+"""
+import asyncio
+import json
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from conftest import add_app_path  # noqa: E402
+
+add_app_path("app_async/sagemaker_lambda")
+
+from completion import split_s3_uri  # noqa: E402
+from fan_out import (  # noqa: E402
+    AsyncInferenceClient,
+    InferenceFailed,
+    NotificationRoute,
+)
+
+INPUT_BUCKET = "inputs"
+OUTPUT_BUCKET = "outputs"
+
+
+class FakeEndpoint:
+    """
+    SageMaker async endpoint: writes the output (or failure) object of an
+    invocation and publishes its notification to the success (or error) topic.
+    """
+
+    def __init__(self, success_topic, error_topic, fail=False, notify=True):
+        self.s3 = boto3.client("s3")
+        self.sns = boto3.client("sns")
+        self.success_topic = success_topic
+        self.error_topic = error_topic
+        self.fail = fail
+        self.notify = notify
+
+    def invoke_endpoint_async(self, EndpointName, InputLocation, InferenceId, **_):
+        bucket, key = split_s3_uri(InputLocation)
+        payload = json.loads(self.s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+        output_location = f"s3://{OUTPUT_BUCKET}/{InferenceId}.out"
+        failure_location = f"s3://{OUTPUT_BUCKET}/failures/{InferenceId}.out"
+        notification = {
+            "eventSource": "aws:sagemaker",
+            "eventName": "InferenceResult",
+            "inferenceId": InferenceId,
+            "requestParameters": {"inputLocation": InputLocation},
+        }
+        if self.fail:
+            self._put(failure_location, "CUDA error")
+            notification["invocationStatus"] = "Failed"
+            notification["failureReason"] = "ClientError: CUDA error"
+            notification["responseParameters"] = {"failureLocation": failure_location}
+            topic = self.error_topic
+        else:
+            outputs = [f"question on {text}" for text in payload["inputs"]]
+            self._put(output_location, json.dumps(outputs))
+            notification["invocationStatus"] = "Completed"
+            notification["responseParameters"] = {"outputLocation": output_location}
+            topic = self.success_topic
+        if self.notify:
+            self.sns.publish(TopicArn=topic, Message=json.dumps(notification))
+        return {
+            "OutputLocation": output_location,
+            "FailureLocation": failure_location,
+            "InferenceId": InferenceId,
+        }
+
+    def _put(self, location, body):
+        bucket, key = split_s3_uri(location)
+        self.s3.put_object(Bucket=bucket, Key=key, Body=body)
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=INPUT_BUCKET)
+        s3.create_bucket(Bucket=OUTPUT_BUCKET)
+        sns = boto3.client("sns")
+        yield [sns.create_topic(Name=name)["TopicArn"] for name in ("success", "error")]
+
+
+def make_client(topics, fail=False, notify=True):
+    client = AsyncInferenceClient(
+        "endpoint", INPUT_BUCKET, topics, "notifications", max_inputs_per_job=2
+    )
+    client.sagemaker = FakeEndpoint(*topics, fail=fail, notify=notify)
+    assert client.waiter is not None
+    client.waiter.wait_seconds = 1
+    return client
+
+
+def queued_messages(client):
+    sqs = boto3.client("sqs")
+    return sqs.receive_message(QueueUrl=client.route.queue_url).get("Messages", [])
+
+
+def test_success_notification(aws, monkeypatch):
+    client = make_client(aws)
+    # The outputs must come from the notifications, not from polling S3
+    monkeypatch.setattr("fan_out.poll_output", pytest.fail)
+
+    outputs = asyncio.run(client.generate(["a", "b", "c"], {}, timeout=10))
+
+    assert outputs == ["question on a", "question on b", "question on c"]
+    # Inputs are deleted once fetched, notifications once received
+    assert "Contents" not in boto3.client("s3").list_objects_v2(Bucket=INPUT_BUCKET)
+    assert queued_messages(client) == []
+
+
+def test_failure_notification(aws, monkeypatch):
+    client = make_client(aws, fail=True)
+    monkeypatch.setattr("fan_out.poll_output", pytest.fail)
+
+    with pytest.raises(InferenceFailed) as failure:
+        asyncio.run(client.generate(["a"], {}, timeout=10))
+
+    completion = failure.value.completion
+    assert not completion.succeeded
+    assert completion.failure_reason == "ClientError: CUDA error"
+    assert completion.failure_location.startswith(f"s3://{OUTPUT_BUCKET}/failures/")
+    assert "Contents" not in boto3.client("s3").list_objects_v2(Bucket=INPUT_BUCKET)
+
+
+def test_timed_out_job_deletes_its_input(aws):
+    client = make_client(aws, notify=False)
+    # Never completes
+    client.sagemaker._put = lambda location, body: None
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(client.generate(["a"], {}, timeout=0.5))
+
+    assert "Contents" not in boto3.client("s3").list_objects_v2(Bucket=INPUT_BUCKET)
+
+
+def test_concurrent_environments_get_their_own_notifications(aws, monkeypatch):
+    clients = [make_client(aws), make_client(aws)]
+    monkeypatch.setattr("fan_out.poll_output", pytest.fail)
+
+    async def main():
+        return await asyncio.gather(
+            clients[0].generate(["a", "b", "c"], {}, timeout=10),
+            clients[1].generate(["d"], {}, timeout=10),
+        )
+
+    first, second = asyncio.run(main())
+    assert first == ["question on a", "question on b", "question on c"]
+    assert second == ["question on d"]
+    assert clients[0].route.queue_url != clients[1].route.queue_url
+
+    # Nothing of the other environment lands in a queue
+    clients[1].sagemaker.notify = False
+    asyncio.run(clients[0].generate(["e"], {}, timeout=10))
+    assert queued_messages(clients[1]) == []
+
+
+def test_lost_notification_falls_back_to_polling(aws):
+    client = make_client(aws, notify=False)
+    client.notification_timeout = 0.5
+
+    outputs = asyncio.run(client.generate(["a", "b", "c"], {}, timeout=10))
+
+    assert outputs == ["question on a", "question on b", "question on c"]
+
+
+def test_stale_queues_are_swept(aws):
+    sqs = boto3.client("sqs")
+    sns = boto3.client("sns")
+    stale = NotificationRoute(sqs, sns, aws, "notifications")
+    stale_url = stale.ensure()
+    fresh = NotificationRoute(sqs, sns, aws, "notifications", stale_seconds=-1)
+    fresh_url = fresh.ensure()
+
+    assert sqs.list_queues(QueueNamePrefix="notifications-")["QueueUrls"] == [fresh_url]
+    for topic in aws:
+        subscriptions = sns.list_subscriptions_by_topic(TopicArn=topic)
+        assert [item["Endpoint"] for item in subscriptions["Subscriptions"]] == [
+            fresh._queue_arn(fresh_url)
+        ]
+    # A swept environment gets a new queue on its next invocation
+    assert stale.ensure() not in (stale_url, fresh_url)
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from conftest import add_app_path
+
+add_app_path("app_gpu")
+
+from batching import MicroBatcher  # noqa: E402
+
+
+class Generator:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, answers, contexts, **options):
+        self.calls.append((answers, contexts))
+        return [
+            [f"{answer} in {context}" for answer in context_answers]
+            for context_answers, context in zip(answers, contexts)
+        ]
+
+
+def run(generate, *requests):
+    async def main():
+        batcher = MicroBatcher(generate, max_wait_ms=5)
+        batcher.start()
+        submits = [batcher.submit(answers, contexts) for answers, contexts in requests]
+        try:
+            return await asyncio.gather(*submits), batcher
+        finally:
+            await batcher.stop()
+
+    return asyncio.run(main())
+
+
+def test_concurrent_requests_share_a_call():
+    generate = Generator()
+    results, batcher = run(
+        generate, ([["a", "b"]], ["x"]), ([["b"], ["c"]], ["x", "y"])
+    )
+
+    assert results == [[["a in x", "b in x"]], [["b in x"], ["c in y"]]]
+    assert len(generate.calls) == 1
+    # (b, x) is generated once for both requests
+    assert batcher.shared_pairs == 1
+
+
+def test_length_mismatch():
+    with pytest.raises(ValueError, match="same length"):
+        run(Generator(), ([["a"], ["b"]], ["x"]))
@@ -0,0 +1,50 @@
+import json
+import os
+
+import pytest
+
+huggingface_hub = pytest.importorskip("huggingface_hub")
+
+from question_generation.build_cache import (  # noqa: E402
+    BUILD_INFO_FILE,
+    resolve_revision,
+)
+
+CHECKPOINT = "owner/model"
+
+
+def write_build(directory, name, info, mtime):
+    build = directory / name
+    build.mkdir(parents=True)
+    info_path = build / BUILD_INFO_FILE
+    info_path.write_text(json.dumps(info))
+    os.utime(info_path, (mtime, mtime))
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    def model_info(checkpoint, revision):
+        raise ConnectionError("offline")
+
+    monkeypatch.setattr(huggingface_hub, "model_info", model_info)
+
+
+def test_online_resolves_the_commit(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        huggingface_hub,
+        "model_info",
+        lambda checkpoint, revision: type("Info", (), {"sha": "abc123"}),
+    )
+    assert resolve_revision(CHECKPOINT, "main", tmp_path) == "abc123"
+
+
+def test_offline_reuses_the_latest_recorded_revision(offline, tmp_path):
+    write_build(tmp_path, "a", {"checkpoint": CHECKPOINT, "revision": "old"}, 100)
+    write_build(tmp_path, "b", {"checkpoint": CHECKPOINT, "revision": "new"}, 200)
+    write_build(tmp_path, "c", {"checkpoint": "other/model", "revision": "x"}, 300)
+    assert resolve_revision(CHECKPOINT, "main", tmp_path) == "new"
+
+
+def test_offline_without_builds_keeps_the_revision(offline, tmp_path):
+    assert resolve_revision(CHECKPOINT, "main", tmp_path / "missing") == "main"
+    assert resolve_revision(CHECKPOINT, "main") == "main"
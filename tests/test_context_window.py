@@ -0,0 +1,109 @@
+"""
+Context windows with a tokenizer of one token per whitespace separated word,
+and an eos token with the special tokens: a prompt template of an answer of n
+words takes n + 3 tokens ("answer:", "context:" and eos).
+"""
+import tarfile
+
+import pytest
+
+from conftest import WhitespaceTokenizer
+from question_generation.context_window import (
+    ContextWindow,
+    covering,
+    expand,
+    windowed_prompts,
+)
+from question_generation.model_archive import pack
+
+CONTEXT = "One two three. Four five six. Seven eight nine. Ten eleven twelve."
+
+
+@pytest.fixture
+def tokenizer():
+    return WhitespaceTokenizer()
+
+
+@pytest.mark.parametrize(
+    "start, end, expected",
+    [(7, 12, (1, 3)), (0, 1, (0, 1)), (6, 10, (1, 2)), (14, 15, (2, 3))],
+)
+def test_covering(start, end, expected):
+    spans = [(0, 5), (6, 10), (11, 15)]
+    assert covering(spans, start, end) == expected
+
+
+@pytest.mark.parametrize(
+    "first, last, budget, expected",
+    [
+        # Next unit first, then the one before
+        (1, 2, 6, (0, 2)),
+        (1, 2, 9, (0, 3)),
+        (0, 4, 10, (0, 4)),
+        # Cut from its end when the answer alone exceeds the budget
+        (0, 4, 5, (0, 2)),
+        (2, 4, 1, (2, 3)),
+    ],
+)
+def test_expand(first, last, budget, expected):
+    assert expand([2, 3, 4, 1], first, last, budget) == expected
+
+
+def test_context_that_fits(tokenizer):
+    window = ContextWindow(tokenizer, CONTEXT, max_tokens=16)
+    assert window.prompt("eight") == f"answer: eight context: {CONTEXT}"
+
+
+def test_sentences_around_the_answer(tokenizer):
+    # 6 tokens left to the context, the answer's sentence and the next one
+    window = ContextWindow(tokenizer, CONTEXT, max_tokens=10)
+    assert window.prompt("Eight") == (
+        "answer: Eight context: Seven eight nine. Ten eleven twelve."
+    )
+    # 5 tokens left, the next sentence no longer fits
+    assert window.prompt("four five") == "answer: four five context: Four five six."
+
+
+def test_answer_missing_from_the_context(tokenizer):
+    window = ContextWindow(tokenizer, CONTEXT, max_tokens=10)
+    assert window.prompt("zebra") == (
+        "answer: zebra context: One two three. Four five six."
+    )
+
+
+def test_words_inside_one_long_sentence(tokenizer):
+    context = "a b c d e f g h i j."
+    window = ContextWindow(tokenizer, context, max_tokens=7)
+    assert window.prompt("f") == "answer: f context: e f g"
+
+
+def test_answer_longer_than_the_budget(tokenizer):
+    context = "a b c d e f g h."
+    window = ContextWindow(tokenizer, context, max_tokens=11)
+    assert window.prompt("c d e f g") == "answer: c d e f g context: c d e"
+
+
+def test_windowed_prompts(tokenizer):
+    assert windowed_prompts(tokenizer, ["two", "twelve"], CONTEXT, 7) == [
+        "answer: two context: One two three.",
+        "answer: twelve context: Ten eleven twelve.",
+    ]
+
+
+def test_model_archive_holds_the_shared_modules(tmp_path):
+    app = tmp_path / "app"
+    (app / "code" / "__pycache__").mkdir(parents=True)
+    (app / "code" / "inference.py").write_text("from context_window import *\n")
+    (app / "code" / "__pycache__" / "inference.pyc").write_bytes(b"")
+    (app / "config.json").write_text("{}")
+
+    archive = pack(app, tmp_path / "zipped_app" / "model.tar.gz")
+    with tarfile.open(archive) as tar:
+        files = {member.name for member in tar.getmembers() if member.isfile()}
+    assert files == {"config.json", "code/inference.py", "code/context_window.py"}
+
+
+def test_short_prompts_skip_tokenization(tokenizer):
+    window = ContextWindow(tokenizer, CONTEXT, max_tokens=512)
+    assert window.prompt("eight") == f"answer: eight context: {CONTEXT}"
+    assert tokenizer.calls == 0
@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from conftest import tiny_t5  # noqa: E402
+from question_generation.engines import (  # noqa: E402
+    ENGINES,
+    Engine,
+    TorchScriptEngine,
+)
+
+
+def test_torchscript_encoder_matches_eager():
+    model = tiny_t5()
+    eager_encoder = model.get_encoder()
+    prepared = TorchScriptEngine(Path()).prepare(model)
+
+    input_ids = torch.tensor([[5, 9, 13, 7, 21, 3, 11, 17, 1], [8, 4, 1] + [0] * 6])
+    attention_mask = (input_ids != 0).long()
+    with torch.no_grad():
+        traced = prepared.get_encoder()(input_ids, attention_mask)
+        eager = eager_encoder(input_ids, attention_mask=attention_mask)
+    assert torch.allclose(traced.last_hidden_state, eager.last_hidden_state, atol=1e-5)
+
+
+class Shifted(torch.nn.Module):
+    """A wrong trace, its outputs are off by one"""
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, input_ids, attention_mask):
+        return self.module(input_ids, attention_mask) + 1
+
+
+def test_torchscript_rejects_diverging_trace(monkeypatch):
+    monkeypatch.setattr(torch.jit, "trace", lambda module, inputs, **_: Shifted(module))
+    with pytest.raises(RuntimeError, match="does not match"):
+        TorchScriptEngine(Path()).prepare(tiny_t5())
+
+
+def test_engines_are_concrete():
+    assert all(not engine.__abstractmethods__ for engine in ENGINES.values())
+
+
+def test_engine_without_load_is_abstract():
+    class Incomplete(Engine):
+        name = "incomplete"
+
+        @classmethod
+        def locate(cls, weights_folder):
+            return weights_folder
+
+    with pytest.raises(TypeError):
+        Engine(Path())
+    with pytest.raises(TypeError):
+        Incomplete(Path())
@@ -0,0 +1,58 @@
+import pytest
+
+from question_generation import generation_cache
+from question_generation.generation_cache import GenerationCache, cache_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(generation_cache, "time", lambda: now[0])
+    return now
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = GenerationCache(max_entries=2)
+    cache.put("a", ["qa"])
+    cache.put("b", ["qb"])
+    assert cache.get("a") == ["qa"]
+    cache.put("c", ["qc"])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == ["qa"]
+    assert cache.get("c") == ["qc"]
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2}
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = GenerationCache(ttl_seconds=10)
+    cache.put("a", ["qa"])
+    clock[0] += 10
+    assert cache.get("a") == ["qa"]
+    clock[0] += 1
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_entries_persist_across_instances(tmp_path, clock):
+    path = tmp_path / "cache" / "generations.sqlite"
+    GenerationCache(disk_path=path).put("a", ["qa", "qa2"])
+
+    cache = GenerationCache(disk_path=path, ttl_seconds=60)
+    assert cache.get("a") == ["qa", "qa2"]
+    # Loaded back in memory
+    assert cache.stats()["size"] == 1
+
+    clock[0] += 61
+    assert GenerationCache(disk_path=path, ttl_seconds=60).get("a") is None
+    # Expired rows are deleted
+    assert GenerationCache(disk_path=path).get("a") is None
+
+
+def test_key_depends_on_the_generation_options():
+    options = {"num_beams": 1, "top_p": 0.92}
+    key = cache_key("answer: a context: x", options)
+    assert key == cache_key("answer: a context: x", dict(reversed(options.items())))
+    assert key != cache_key("answer: a context: x", {**options, "top_p": 0.5})
+    assert key != cache_key("answer: a context: x", {**options, "temperature": 2.0})
+    assert key != cache_key("answer: b context: x", options)
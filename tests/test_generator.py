@@ -0,0 +1,114 @@
+from pathlib import Path
+
+import pytest
+
+from conftest import WhitespaceTokenizer, tiny_t5
+from question_generation.generator import (
+    MAX_BATCH_TOKENS,
+    T5QuestionGenerator,
+    token_budget_batches,
+)
+
+ROOT = Path(__file__).parent.parent
+
+
+@pytest.mark.parametrize(
+    "lengths, budget",
+    [
+        ([5, 3, 8, 1, 8, 2], 16),
+        ([10, 10, 10, 10], 40),
+        ([30, 1, 2], 16),
+        ([], 16),
+    ],
+)
+def test_batches_stay_within_the_token_budget(lengths, budget):
+    batches = token_budget_batches(lengths, budget)
+    assert sorted(idx for batch in batches for idx in batch) == list(
+        range(len(lengths))
+    )
+    for batch in batches:
+        padded = max(lengths[idx] for idx in batch) * len(batch)
+        # Only an input longer than the budget exceeds it, alone
+        assert padded <= budget or len(batch) == 1
+
+
+def test_batches_group_inputs_of_similar_length():
+    assert token_budget_batches([5, 3, 8, 1, 8, 2], 16) == [[3, 5, 1], [0, 2], [4]]
+
+
+class Pipeline:
+    """Whitespace tokens, one question per prompt"""
+
+    def __init__(self):
+        self.tokenizer = WhitespaceTokenizer()
+        self.tokenized = []
+        self.batches = []
+
+    def tokenize(self, texts):
+        self.tokenized.append(texts)
+        return [
+            {"input_ids": [[0] * (len(text.split()) + 1)], "text": text}
+            for text in texts
+        ]
+
+    def __call__(self, inputs, **options):
+        assert options["batch_size"] == len(inputs)
+        self.batches.append(
+            [len(model_inputs["input_ids"][0]) for model_inputs in inputs]
+        )
+        return [f"question of {model_inputs['text']}" for model_inputs in inputs]
+
+
+def generator(max_input_tokens=512):
+    generator = T5QuestionGenerator(
+        ROOT / "models", engine="torch", max_input_tokens=max_input_tokens
+    )
+    generator.pipeline = Pipeline()
+    return generator
+
+
+def test_results_come_back_in_the_original_order():
+    model = generator(max_input_tokens=None)
+    # Prompts of 1004, 904, 14, 14 and 24 tokens
+    contexts = [" ".join(["word"] * length) for length in (1000, 900, 10, 20)]
+    answers = [["a"], ["b"], ["c", "d"], ["e"]]
+    results = model(answers, contexts)
+
+    assert results == [
+        [f"question of answer: {answer} context: {context}" for answer in batch]
+        for batch, context in zip(answers, contexts)
+    ]
+    for batch in model.pipeline.batches:
+        assert max(batch) * len(batch) <= MAX_BATCH_TOKENS or len(batch) == 1
+    assert sorted(model.pipeline.batches) == [[14, 14, 24], [904, 1004]]
+
+
+def test_prompts_are_tokenized_once():
+    model = generator()
+    model([["a", "b"], ["a"]], ["x y", "z"])
+    # Short contexts are not windowed, the pipeline gets the prompts tokenized
+    assert model.pipeline.tokenizer.calls == 0
+    assert model.pipeline.tokenized == [
+        ["answer: a context: x y", "answer: b context: x y", "answer: a context: z"]
+    ]
+
+
+def test_pipeline_takes_tokenized_inputs():
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from question_generation.pipeline import MultipleText2TextGenerationPipeline
+
+    tokenizer = transformers.T5TokenizerFast.from_pretrained(
+        str(ROOT / "app_async" / "app")
+    )
+    pipeline = MultipleText2TextGenerationPipeline(
+        model=tiny_t5(vocab_size=len(tokenizer)), tokenizer=tokenizer
+    )
+    texts = ["answer: a context: short", "answer: b context: a longer context."]
+    options = {"max_length": 6, "num_beams": 1, "batch_size": 2}
+
+    model_inputs = pipeline.tokenize(texts)
+    assert [len(inputs["input_ids"][0]) for inputs in model_inputs] == [
+        len(ids) for ids in tokenizer(texts)["input_ids"]
+    ]
+    assert pipeline(model_inputs, **options) == pipeline(texts, **options)
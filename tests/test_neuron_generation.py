@@ -0,0 +1,184 @@
+"""
+The cached decoding generator and its shape buckets traced with
+torch.jit.trace on CPU, against T5ForConditionalGeneration.generate on a tiny
+random T5.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from conftest import add_app_path, tiny_t5  # noqa: E402
+
+add_app_path("app_inferentia", "metrics")
+
+from neuron_generation import (  # noqa: E402
+    NeuronBucketedGeneration,
+    NeuronCachedGeneration,
+    NeuronGeneration,
+    traced_shapes,
+)
+
+NUM_TEXTS = 2
+MAX_ENCODER_LENGTH = 8
+MAX_DECODER_LENGTH = 6
+
+
+def cpu_trace(module, inputs):
+    return torch.jit.trace(module, inputs)
+
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_t5()
+
+
+@pytest.fixture(scope="module")
+def inputs():
+    input_ids = torch.tensor([[5, 9, 13, 7, 21, 3, 11, 1], [8, 17, 4, 1, 0, 0, 0, 0]])
+    return input_ids, (input_ids != 0).long()
+
+
+def strip(sequences):
+    return [[token for token in sequence if token != 0] for sequence in sequences]
+
+
+def reference(model, inputs, **generate_kwargs):
+    input_ids, attention_mask = inputs
+    with torch.no_grad():
+        output = model.generate(
+            inputs=input_ids,
+            attention_mask=attention_mask,
+            max_length=MAX_DECODER_LENGTH,
+            **generate_kwargs,
+        )
+    return strip(output.tolist())
+
+
+def traced(model, num_beams):
+    generation = NeuronCachedGeneration(model.config)
+    with torch.no_grad():
+        generation.trace(
+            model,
+            num_texts=NUM_TEXTS,
+            num_beams=num_beams,
+            max_encoder_length=MAX_ENCODER_LENGTH,
+            max_decoder_length=MAX_DECODER_LENGTH,
+            trace_fn=cpu_trace,
+        )
+    return generation
+
+
+@pytest.mark.parametrize("num_beams", [1, 3])
+def test_matches_generate(model, inputs, num_beams):
+    generation = traced(model, num_beams)
+    input_ids, attention_mask = inputs
+    generate_kwargs = dict(num_beams=num_beams, num_return_sequences=num_beams)
+    with torch.no_grad():
+        output = generation.generate(
+            inputs=input_ids,
+            attention_mask=attention_mask,
+            max_length=MAX_DECODER_LENGTH,
+            **generate_kwargs,
+        )
+    assert strip(output.tolist()) == reference(model, inputs, **generate_kwargs)
+
+
+def test_cached_decoder_round_trip(model, inputs, tmp_path):
+    generation = traced(model, 1)
+    generation.save_pretrained(str(tmp_path))
+    loaded = NeuronGeneration.from_pretrained(str(tmp_path))
+    assert isinstance(loaded, NeuronCachedGeneration)
+    input_ids, attention_mask = inputs
+    with torch.no_grad():
+        output = loaded.generate(
+            inputs=input_ids,
+            attention_mask=attention_mask,
+            max_length=MAX_DECODER_LENGTH,
+        )
+    assert strip(output.tolist()) == reference(model, inputs)
+
+
+BUCKET_SHAPES = [(1, 4), (1, 8), (2, 4)]
+
+
+@pytest.fixture(scope="module")
+def buckets(model):
+    with torch.no_grad():
+        return NeuronBucketedGeneration.trace(
+            model,
+            shapes=BUCKET_SHAPES,
+            num_beams=1,
+            max_decoder_length=MAX_DECODER_LENGTH,
+            trace_fn=cpu_trace,
+        )
+
+
+@pytest.mark.parametrize(
+    "num_texts, length, bucket",
+    [(1, 3, (1, 4)), (2, 4, (2, 4)), (1, 5, (1, 8)), (1, 8, (1, 8))],
+)
+def test_select_bucket(buckets, num_texts, length, bucket):
+    assert buckets.select_bucket(num_texts, length) == bucket
+
+
+def test_select_bucket_without_fit(buckets):
+    with pytest.raises(ValueError):
+        buckets.select_bucket(2, 8)
+
+
+def test_generate_routes_texts_by_length(buckets, model, monkeypatch):
+    calls = []
+    for shape, generation in buckets.buckets.items():
+
+        def generate(*args, shape=shape, generate=generation.generate, **kwargs):
+            calls.append(shape)
+            return generate(*args, **kwargs)
+
+        monkeypatch.setattr(generation, "generate", generate)
+
+    input_ids = torch.tensor(
+        [[5, 9, 1, 0, 0, 0, 0], [8, 17, 4, 13, 7, 21, 1], [6, 1, 0, 0, 0, 0, 0]]
+    )
+    attention_mask = (input_ids != 0).long()
+    with torch.no_grad():
+        output = buckets.generate(
+            input_ids, attention_mask=attention_mask, max_length=MAX_DECODER_LENGTH
+        )
+
+    # The long text alone in the long bucket, both short ones together
+    assert calls == [(1, 8), (2, 4)]
+    expected = [
+        reference(model, (ids[None, mask.bool()], mask[None, mask.bool()]))[0]
+        for ids, mask in zip(input_ids, attention_mask)
+    ]
+    assert strip(output.tolist()) == expected
+
+
+def test_generate_rejects_oversized_inputs(buckets):
+    input_ids = torch.ones((1, 9), dtype=torch.long)
+    with pytest.raises(ValueError, match="longer than the largest bucket"):
+        buckets.generate(input_ids, max_length=MAX_DECODER_LENGTH)
+
+
+def test_single_shape_fallback(model, tmp_path):
+    traced(model, 1).save_pretrained(str(tmp_path))
+    with pytest.raises(FileNotFoundError):
+        NeuronBucketedGeneration.from_pretrained(str(tmp_path))
+    loaded = NeuronBucketedGeneration.from_pretrained(
+        str(tmp_path), single_shape=(NUM_TEXTS, MAX_ENCODER_LENGTH)
+    )
+    assert list(loaded.buckets) == [(NUM_TEXTS, MAX_ENCODER_LENGTH)]
+
+
+def test_traced_shapes(buckets, model, tmp_path):
+    single = tmp_path / "single"
+    traced(model, 1).save_pretrained(str(single))
+    with pytest.raises(FileNotFoundError):
+        traced_shapes(str(single))
+    assert traced_shapes(str(single), single_shape=(1, 8)) == [(1, 8)]
+
+    bucketed = tmp_path / "bucketed"
+    buckets.save_pretrained(str(bucketed))
+    # Read from the manifest, the single shape only applies without one
+    assert sorted(traced_shapes(str(bucketed), single_shape=(1, 8))) == BUCKET_SHAPES
@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("pydantic")
+
+from pydantic import ValidationError  # noqa: E402
+
+from question_generation.schema import Question  # noqa: E402
+
+
+def test_parameters_options():
+    question = Question.parse_obj(
+        {
+            "answers": [["a"]],
+            "contexts": ["x"],
+            "parameters": {"do_sample": True, "top_k": 50},
+        }
+    )
+    assert question.parameters.options() == {"do_sample": True, "top_k": 50}
+    assert (
+        Question.parse_obj({"answers": [], "contexts": []}).parameters.options() == {}
+    )
+
+
+@pytest.mark.parametrize(
+    "parameters",
+    [
+        {"max_length": 100000},
+        {"num_beams": 64},
+        {"num_return_sequences": 100},
+        {"top_p": 0},
+        {"top_k": 5000},
+        {"temperature": 100},
+    ],
+)
+def test_rejected_parameters(parameters):
+    with pytest.raises(ValidationError):
+        Question.parse_obj(
+            {"answers": [["a"]], "contexts": ["x"], "parameters": parameters}
+        )
+
+
+def test_length_mismatch():
+    with pytest.raises(ValidationError, match="same length"):
+        Question.parse_obj({"answers": [["a"], ["b"]], "contexts": ["x"]})
+
+
+def test_invalid_json():
+    with pytest.raises(ValidationError):
+        Question.parse_raw("not json")
@@ -0,0 +1,187 @@
+import json
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from question_generation.sqs_batch import (  # noqa: E402
+    LogSink,
+    S3Sink,
+    SqsSink,
+    handle_sqs_batch,
+    is_sqs_event,
+    make_sink,
+)
+
+BUCKET = "results"
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        yield
+
+
+@pytest.fixture
+def s3(aws):
+    client = boto3.client("s3")
+    client.create_bucket(Bucket=BUCKET)
+    return client
+
+
+def record(message_id, contexts, answers=None, parameters=None, body=None):
+    if body is None:
+        body = json.dumps(
+            {
+                "id": f"job-{message_id}",
+                "answers": answers or [["answer"] for _ in contexts],
+                "contexts": contexts,
+                "parameters": parameters or {},
+            }
+        )
+    return {"messageId": message_id, "eventSource": "aws:sqs", "body": body}
+
+
+class Generator:
+    """Questions echoing their context, fails on contexts containing "boom" """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, answers, contexts, **parameters):
+        self.calls.append(contexts)
+        if any("boom" in context for context in contexts):
+            raise RuntimeError("generation failed")
+        return [[f"question on {context}"] for context in contexts]
+
+
+def stored(s3):
+    objects = s3.list_objects_v2(Bucket=BUCKET).get("Contents", [])
+    return {
+        item["Key"]: json.loads(
+            s3.get_object(Bucket=BUCKET, Key=item["Key"])["Body"].read()
+        )
+        for item in objects
+    }
+
+
+def test_batch_in_a_single_call(s3):
+    generate = Generator()
+    event = {"Records": [record("1", ["a", "b"]), record("2", ["c"])]}
+
+    response = handle_sqs_batch(event, generate, S3Sink(BUCKET, "questions"))
+
+    assert response == {"batchItemFailures": []}
+    assert generate.calls == [["a", "b", "c"]]
+    assert stored(s3) == {
+        "questions/1.json": {
+            "messageId": "1",
+            "id": "job-1",
+            "questions": [["question on a"], ["question on b"]],
+        },
+        "questions/2.json": {
+            "messageId": "2",
+            "id": "job-2",
+            "questions": [["question on c"]],
+        },
+    }
+
+
+def test_partial_failure(s3):
+    generate = Generator()
+    event = {
+        "Records": [
+            record("1", ["a"]),
+            record("2", ["boom"]),
+            record("3", ["b"], parameters={"top_k": 5}),
+            record("4", [], body="not json"),
+            record("5", ["c", "d"], answers=[["x"]]),
+        ]
+    }
+
+    response = handle_sqs_batch(event, generate, make_sink(f"s3://{BUCKET}"))
+
+    assert response == {
+        "batchItemFailures": [
+            {"itemIdentifier": "4"},
+            {"itemIdentifier": "5"},
+            {"itemIdentifier": "2"},
+        ]
+    }
+    # One call per parameters, then each record of the failed call alone
+    assert generate.calls == [["a", "boom"], ["a"], ["boom"], ["b"]]
+    assert sorted(stored(s3)) == ["1.json", "3.json"]
+
+
+def test_invalid_parameters(s3):
+    generate = Generator()
+    event = {
+        "Records": [
+            record("1", ["a"], parameters={"num_beams": 100}),
+            record("2", ["b"], parameters={"top_p": 2}),
+            record("3", ["c"], parameters={"do_sample": True, "top_p": 0.5}),
+        ]
+    }
+
+    response = handle_sqs_batch(event, generate, S3Sink(BUCKET))
+
+    assert response == {
+        "batchItemFailures": [{"itemIdentifier": "1"}, {"itemIdentifier": "2"}]
+    }
+    assert generate.calls == [["c"]]
+    assert sorted(stored(s3)) == ["3.json"]
+
+
+def test_sink_failure(aws):
+    # The bucket does not exist
+    event = {"Records": [record("1", ["a"])]}
+
+    response = handle_sqs_batch(event, Generator(), S3Sink(BUCKET))
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "1"}]}
+
+
+def test_sqs_sink(aws):
+    client = boto3.client("sqs")
+    queue_url = client.create_queue(QueueName="results")["QueueUrl"]
+    event = {"Records": [record("1", ["a"])]}
+
+    response = handle_sqs_batch(event, Generator(), SqsSink(queue_url))
+
+    assert response == {"batchItemFailures": []}
+    (message,) = client.receive_message(QueueUrl=queue_url)["Messages"]
+    assert json.loads(message["Body"]) == {
+        "messageId": "1",
+        "id": "job-1",
+        "questions": [["question on a"]],
+    }
+
+
+def test_record_without_message_id(s3):
+    generate = Generator()
+    event = {"Records": [record("1", ["a"]), {"body": record("2", ["b"])["body"]}]}
+
+    with pytest.raises(ValueError, match="messageId"):
+        handle_sqs_batch(event, generate, S3Sink(BUCKET))
+    assert generate.calls == []
+
+
+def test_make_sink():
+    assert isinstance(make_sink(""), LogSink)
+    sink = make_sink("s3://bucket/some/prefix/")
+    assert isinstance(sink, S3Sink)
+    assert (sink.bucket, sink.prefix) == ("bucket", "some/prefix")
+    queue_url = "https://sqs.us-east-1.amazonaws.com/123456789012/results"
+    assert isinstance(make_sink(queue_url), SqsSink)
+    with pytest.raises(ValueError):
+        make_sink("ftp://results")
+
+
+def test_is_sqs_event():
+    assert is_sqs_event({"Records": [record("1", ["a"])]})
+    assert not is_sqs_event({"body": "{}"})
+    assert not is_sqs_event({"Records": []})
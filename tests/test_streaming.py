@@ -0,0 +1,54 @@
+import asyncio
+import importlib.util
+import json
+
+import pytest
+
+from conftest import ROOT, add_app_path
+from question_generation.schema import Question
+
+add_app_path("app_gpu")
+
+
+@pytest.fixture
+def gpu_app(monkeypatch, tmp_path):
+    pytest.importorskip("fastapi")
+    # Replicas are only started with the server, no model is loaded
+    monkeypatch.setenv("N_REPLICAS", "1")
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    spec = importlib.util.spec_from_file_location(
+        "gpu_app", ROOT / "app_gpu" / "app.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Batcher:
+    async def submit(self, answers, contexts, **options):
+        if contexts[0] == "broken":
+            raise RuntimeError("CUDA out of memory")
+        return [[f"{answer}?" for answer in answers[0]]]
+
+
+def stream(gpu_app, answers, contexts):
+    async def lines():
+        question = Question(answers=answers, contexts=contexts)
+        return [json.loads(line) async for line in gpu_app.stream_questions(question)]
+
+    gpu_app.batcher = Batcher()
+    return asyncio.run(lines())
+
+
+def test_stream_yields_a_line_per_context(gpu_app):
+    lines = stream(gpu_app, [["a"], ["b", "c"]], ["x", "y"])
+    assert sorted(lines, key=lambda line: line["index"]) == [
+        {"index": 0, "questions": ["a?"]},
+        {"index": 1, "questions": ["b?", "c?"]},
+    ]
+
+
+def test_stream_ends_with_an_error_line(gpu_app):
+    lines = stream(gpu_app, [["a"], ["b"]], ["x", "broken"])
+    assert lines[-1] == {"error": "CUDA out of memory"}
+    assert all("error" not in line for line in lines[:-1])
@@ -0,0 +1,134 @@
+"""
+Host side tokenization cost per request of the Neuron backends (inferentia,
+sagemaker): the SentencePiece T5Tokenizer decoding one sequence at a time
+(before) against the Rust T5TokenizerFast with batch_decode (after).
+
+    python tokenizer_benchmark.py --mix 1x1,4x1,8x4 --requests 200
+
+A request encodes its prompts padded to the longest one and decodes
+`--num-beams` sequences per prompt, as `infer` of app_inferentia does.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from load_test import make_payload, parse_mix, percentile
+from question_generation.context_window import prompt
+from question_generation.generator import MODEL_CHECKPOINT
+
+ROOT = Path(__file__).parent
+
+# tokenizer.json of the checkpoint, saved with the async endpoint model
+FAST_TOKENIZER_DIRECTORY = ROOT.joinpath("app_async", "app")
+
+
+def slow_decode(tokenizer: Any, output: Any) -> list[str]:
+    return [tokenizer.decode(t, skip_special_tokens=True) for t in output]
+
+
+def fast_decode(tokenizer: Any, output: Any) -> list[str]:
+    return tokenizer.batch_decode(output, skip_special_tokens=True)
+
+
+def summary(latencies: list[float]) -> dict[str, float]:
+    latencies = sorted(latency * 1000 for latency in latencies)
+    return {
+        "p50": round(percentile(latencies, 0.50), 3),
+        "p95": round(percentile(latencies, 0.95), 3),
+        "mean": round(sum(latencies) / len(latencies), 3),
+    }
+
+
+def measure(
+    tokenizer: Any,
+    decode: Callable[[Any, Any], list[str]],
+    requests: list[tuple[list[str], Any]],
+    max_encoder_length: int,
+) -> dict[str, Any]:
+    encode_latencies: list[float] = []
+    decode_latencies: list[float] = []
+    for texts, output in requests:
+        start = time.perf_counter()
+        tokenizer(
+            texts,
+            max_length=max_encoder_length,
+            truncation=True,
+            padding=True,
+            return_tensors="pt",
+        )
+        encode_latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        decode(tokenizer, output)
+        decode_latencies.append(time.perf_counter() - start)
+    total = [a + b for a, b in zip(encode_latencies, decode_latencies)]
+    return {
+        "encode_ms": summary(encode_latencies),
+        "decode_ms": summary(decode_latencies),
+        "total_ms": summary(total),
+    }
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--slow", default=MODEL_CHECKPOINT, help="spiece.model")
+    parser.add_argument("--fast", default=str(FAST_TOKENIZER_DIRECTORY))
+    parser.add_argument("--mix", default="1x1,4x1,8x4", help="e.g. 1x1,8x4")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--num-beams", type=int, default=4)
+    parser.add_argument("--max-encoder-length", type=int, default=128)
+    parser.add_argument("--max-decoder-length", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=5)
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str]) -> None:
+    args = parse_args(argv)
+    from transformers.models.t5.tokenization_t5 import T5Tokenizer
+    from transformers.models.t5.tokenization_t5_fast import T5TokenizerFast
+
+    slow = T5Tokenizer.from_pretrained(args.slow)
+    fast = T5TokenizerFast.from_pretrained(args.fast)
+
+    results: list[dict[str, Any]] = []
+    for shape in parse_mix(args.mix):
+        requests: list[tuple[list[str], Any]] = []
+        for number in range(args.warmup + args.requests):
+            payload = make_payload(shape, number, unique=True)
+            texts = [
+                prompt(answer, context)
+                for answers, context in zip(payload["answers"], payload["contexts"])
+                for answer in answers
+            ]
+            # Stand in for the generated sequences: num_beams per prompt
+            output = fast(
+                [text for text in texts for _ in range(args.num_beams)],
+                max_length=args.max_decoder_length,
+                truncation=True,
+                padding="max_length",
+                return_tensors="pt",
+            )["input_ids"]
+            requests.append((texts, output))
+
+        measured: dict[str, dict[str, Any]] = {}
+        for name, tokenizer, decode in (
+            ("before", slow, slow_decode),
+            ("after", fast, fast_decode),
+        ):
+            measure(tokenizer, decode, requests[: args.warmup], args.max_encoder_length)
+            measured[name] = measure(
+                tokenizer, decode, requests[args.warmup :], args.max_encoder_length
+            )
+        speedup = (
+            measured["before"]["total_ms"]["mean"]
+            / measured["after"]["total_ms"]["mean"]
+        )
+        results.append({"shape": shape.name, **measured, "speedup": round(speedup, 2)})
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])